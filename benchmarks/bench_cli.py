@@ -0,0 +1,81 @@
+"""
+Benchmarks of the bulk CLI operations (``insert`` and ``export``) against the in-process RethinkDB stand-in.
+
+Usage:
+    python benchmarks/bench_cli.py [-o results.json] [--quick]
+"""
+from argparse import ArgumentParser
+import os
+from os import path
+import shutil
+import tempfile
+import time
+from typing import List
+
+from cxflow_rethinkdb.bulk import bulk_insert, export_table
+
+from fake_rethinkdb import FakeStats, fake_connection, fake_pool
+from common import result, write_results
+
+CREDENTIALS = {'host': 'localhost', 'port': 28015, 'user': 'admin', 'password': ''}
+
+
+def _documents(n_documents: int) -> List[dict]:
+    """Create run-like documents."""
+    return [{'id': '{:08}'.format(i), 'user': 'benchmark', 'config': {'model': {'name': 'benchmark', 'lr': 0.1}},
+             'training': [{'epoch_id': epoch_id, 'epoch_data': {'train': {'loss': {'mean': 1. / (epoch_id + 1)}}}}
+                          for epoch_id in range(10)]}
+            for i in range(n_documents)]
+
+
+def bench_bulk_insert(quick: bool) -> List[dict]:
+    """Measure the bulk insert throughput vs. the batch size and the number of workers."""
+    results = []
+    documents = _documents(2000 if quick else 20000)
+    for batch_size in [1, 100, 1000]:
+        for workers in [1, 4]:
+            stats = FakeStats()
+            pool = fake_pool(CREDENTIALS, stats, max_size=workers)
+            start = time.perf_counter()
+            bulk_insert(CREDENTIALS, 'db', 'table', iter(documents), batch_size=batch_size, workers=workers,
+                        report_interval=float('inf'), pool=pool)
+            elapsed = time.perf_counter() - start
+            params = {'batch_size': batch_size, 'workers': workers}
+            results.append(result('bulk_insert_throughput', params, len(documents) / elapsed, 'docs/s'))
+            results.append(result('bulk_insert_queries', params, stats.queries, 'queries'))
+    return results
+
+
+def bench_export(tmpdir: str, quick: bool) -> List[dict]:
+    """Measure the export throughput and the output size (plain vs. gzip-compressed JSONL)."""
+    results = []
+    documents = _documents(2000 if quick else 20000)
+    for output_name in ['export.jsonl', 'export.jsonl.gz']:
+        output_file = path.join(tmpdir, output_name)
+        conn = fake_connection(FakeStats(), rows=documents)
+        start = time.perf_counter()
+        export_table(CREDENTIALS, 'db', 'table', output_file, conn=conn)
+        elapsed = time.perf_counter() - start
+        params = {'compressed': output_name.endswith('.gz')}
+        results.append(result('export_throughput', params, len(documents) / elapsed, 'docs/s'))
+        results.append(result('export_size', params, os.path.getsize(output_file), 'B'))
+    return results
+
+
+def main():
+    parser = ArgumentParser('bench_cli')
+    parser.add_argument('-o', '--output', help='path to the JSON results file (stdout if not specified)')
+    parser.add_argument('--quick', action='store_true', help='run fewer iterations')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        results = bench_bulk_insert(args.quick)
+        results += bench_export(tmpdir, args.quick)
+    finally:
+        shutil.rmtree(tmpdir)
+    write_results(results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+"""
+Benchmarks of the ``RethinkDBHook`` hot path against the in-process RethinkDB stand-in.
+
+Measured:
+    - ``after_epoch`` latency vs. the number of epochs (for both storage modes)
+    - ``after_epoch`` latency and query size vs. the payload (scalars vs. large arrays, list vs. binary encoding)
+    - ``after_epoch`` latency vs. the variable filter width
+    - ``_to_json_serializable`` and ``_build_data_dict`` (compiled serialization plan) throughput
+    - ``after_batch`` latency and the stored volume vs. the downsampling method
+
+Usage:
+    python benchmarks/bench_hook.py [-o results.json] [--quick]
+"""
+from argparse import ArgumentParser
+import json
+from os import path
+import shutil
+import tempfile
+import time
+from typing import List
+
+import numpy as np
+
+from cxflow_rethinkdb import RethinkDBHook
+from cxflow_rethinkdb.array_codec import ArrayCodec
+from cxflow_rethinkdb.batch_buffer import BatchBuffer
+from cxflow_rethinkdb.connection_pool import close_pools, get_pool
+
+from fake_rethinkdb import FakeStats, fake_connection
+from common import result, write_results
+
+CREDENTIALS = {'host': 'localhost', 'port': 28015, 'user': 'admin', 'password': ''}
+
+
+def _epoch_data(n_variables: int, array_size: int=0) -> dict:
+    """Create epoch data with the given number of variables in `train` and `test` streams."""
+    def variable(i):
+        value = {'mean': float(i), 'std': np.float32(i)}
+        if array_size:
+            value['hist'] = np.random.rand(array_size).astype(np.float32)
+        return value
+    return {stream: {'var{}'.format(i): variable(i) for i in range(n_variables)} for stream in ['train', 'test']}
+
+
+def _create_hook(tmpdir: str, stats: FakeStats, **kwargs) -> RethinkDBHook:
+    """Create the hook writing to a fresh fake backend."""
+    close_pools()
+    get_pool(CREDENTIALS, connection_factory=lambda: fake_connection(stats))
+    credentials_file = path.join(tmpdir, 'credentials.json')
+    with open(credentials_file, 'w') as file:
+        json.dump(CREDENTIALS, file)
+    with open(path.join(tmpdir, 'config.yaml'), 'w') as file:
+        json.dump({'model': {'name': 'benchmark'}}, file)
+    return RethinkDBHook(output_dir=tmpdir, credentials_file=credentials_file, db='db', table='table', **kwargs)
+
+
+def _time_epochs(hook: RethinkDBHook, epoch_data: dict, n_epochs: int) -> List[float]:
+    """Run ``after_epoch`` repeatedly and return the latencies in seconds."""
+    latencies = []
+    for epoch_id in range(n_epochs):
+        start = time.perf_counter()
+        hook.after_epoch(epoch_id=epoch_id, epoch_data=epoch_data)
+        latencies.append(time.perf_counter() - start)
+    hook.after_training()
+    return latencies
+
+
+def bench_epoch_count(tmpdir: str, quick: bool) -> List[dict]:
+    """Measure the ``after_epoch`` latency vs. the number of epochs."""
+    results = []
+    epoch_data = _epoch_data(n_variables=10)
+    for storage in RethinkDBHook.STORAGE_MODES:
+        stats = FakeStats()
+        hook = _create_hook(tmpdir, stats, storage=storage)
+        latencies = _time_epochs(hook, epoch_data, 100 if quick else 1000)
+        for start, end in [(0, 10), (90, 100)] if quick else [(0, 10), (90, 100), (990, 1000)]:
+            params = {'storage': storage, 'epochs': '{}-{}'.format(start, end)}
+            results.append(result('after_epoch_latency_vs_epoch', params, np.median(latencies[start:end]) * 1e6,
+                                  'us'))
+    return results
+
+
+def bench_payload(tmpdir: str, quick: bool) -> List[dict]:
+    """Measure the ``after_epoch`` latency and query size vs. the payload."""
+    results = []
+    for array_size in [0, 1000, 100000]:
+        for encoding in ArrayCodec.ENCODINGS:
+            if array_size == 0 and encoding != 'list':
+                continue
+            stats = FakeStats()
+            hook = _create_hook(tmpdir, stats, array_encoding=encoding)
+            stats.reset()
+            latencies = _time_epochs(hook, _epoch_data(n_variables=10, array_size=array_size), 5 if quick else 20)
+            params = {'array_size': array_size, 'array_encoding': encoding}
+            results.append(result('after_epoch_latency_vs_payload', params, np.median(latencies) * 1e6, 'us'))
+            results.append(result('after_epoch_query_size_vs_payload', params, np.median(stats.query_sizes), 'B'))
+    return results
+
+
+def bench_filter_width(tmpdir: str, quick: bool) -> List[dict]:
+    """Measure the ``after_epoch`` latency vs. the number of logged variables (out of 200)."""
+    results = []
+    epoch_data = _epoch_data(n_variables=200)
+    for width in [1, 10, 100, 200]:
+        stats = FakeStats()
+        hook = _create_hook(tmpdir, stats, variables=['var{}'.format(i) for i in range(width)])
+        latencies = _time_epochs(hook, epoch_data, 10 if quick else 50)
+        results.append(result('after_epoch_latency_vs_filter_width', {'variables': width},
+                              np.median(latencies) * 1e6, 'us'))
+    return results
+
+
+def bench_serialization(quick: bool) -> List[dict]:
+    """Measure the ``_to_json_serializable`` throughput."""
+    results = []
+    for n_variables in [10, 100]:
+        data = _epoch_data(n_variables=n_variables)
+        repeats = 20 if quick else 200
+        start = time.perf_counter()
+        for _ in range(repeats):
+            RethinkDBHook._to_json_serializable(data)  # pylint: disable=protected-access
+        elapsed = time.perf_counter() - start
+        results.append(result('to_json_serializable_throughput', {'variables': n_variables}, repeats / elapsed,
+                              'epochs/s'))
+    return results
+
+
+def bench_build_data_dict(tmpdir: str, quick: bool) -> List[dict]:
+    """Measure the ``_build_data_dict`` throughput (with the serialization plan compiled in the first epoch)."""
+    results = []
+    hook = _create_hook(tmpdir, FakeStats())
+    for n_variables in [10, 100, 500]:
+        data = _epoch_data(n_variables=n_variables)
+        repeats = 20 if quick else 200
+        hook._build_data_dict(data)  # pylint: disable=protected-access
+        start = time.perf_counter()
+        for _ in range(repeats):
+            hook._build_data_dict(data)  # pylint: disable=protected-access
+        elapsed = time.perf_counter() - start
+        results.append(result('build_data_dict_throughput', {'variables': n_variables}, repeats / elapsed,
+                              'epochs/s'))
+    hook.after_training()
+    return results
+
+
+def bench_batches(tmpdir: str, quick: bool) -> List[dict]:
+    """Measure the ``after_batch`` latency and the stored volume vs. the downsampling method."""
+    results = []
+    n_batches = 10000 if quick else 100000
+    batch_data = {'loss': np.random.rand(32), 'accuracy': np.random.rand(32)}
+    for downsampling in sorted(BatchBuffer.DOWNSAMPLING_METHODS):
+        stats = FakeStats()
+        hook = _create_hook(tmpdir, stats, log_batches=True, batch_downsampling=downsampling)
+        stats.reset()
+        start = time.perf_counter()
+        for _ in range(n_batches):
+            hook.after_batch(stream_name='train', batch_data=batch_data)
+        elapsed = time.perf_counter() - start
+        hook.after_training()
+        params = {'downsampling': downsampling, 'batches': n_batches}
+        results.append(result('after_batch_latency', params, elapsed / n_batches * 1e6, 'us'))
+        results.append(result('after_batch_queries', params, stats.queries, 'queries'))
+        results.append(result('after_batch_bytes_sent', params, stats.bytes_sent, 'B'))
+    return results
+
+
+def main():
+    parser = ArgumentParser('bench_hook')
+    parser.add_argument('-o', '--output', help='path to the JSON results file (stdout if not specified)')
+    parser.add_argument('--quick', action='store_true', help='run fewer iterations')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        results = bench_serialization(args.quick)
+        results += bench_build_data_dict(tmpdir, args.quick)
+        results += bench_epoch_count(tmpdir, args.quick)
+        results += bench_payload(tmpdir, args.quick)
+        results += bench_filter_width(tmpdir, args.quick)
+        results += bench_batches(tmpdir, args.quick)
+    finally:
+        close_pools()
+        shutil.rmtree(tmpdir)
+    write_results(results, args.output)
+
+
+if __name__ == '__main__':
+    main()
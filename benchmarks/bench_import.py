@@ -0,0 +1,49 @@
+"""
+Benchmark of the import time of the package entry points (each measured in a fresh interpreter).
+
+Usage:
+    python benchmarks/bench_import.py [-o results.json] [--quick]
+"""
+from argparse import ArgumentParser
+import subprocess
+import sys
+import time
+from typing import List
+
+import numpy as np
+
+from common import result, write_results
+
+MODULES = ['rethinkdb', 'cxflow_rethinkdb', 'cxflow_rethinkdb.cli', 'cxflow_rethinkdb.utils',
+           'cxflow_rethinkdb.rethinkdb_hook']
+"""Measured modules; `rethinkdb` (the driver) is the lower bound of the others."""
+
+
+def _import_time(module: str) -> float:
+    """Measure the time (in seconds) of the interpreter start and the module import."""
+    start = time.perf_counter()
+    subprocess.check_call([sys.executable, '-W', 'ignore', '-c', 'import {}'.format(module)])
+    return time.perf_counter() - start
+
+
+def bench_import(quick: bool) -> List[dict]:
+    """Measure the import time of the package entry points relative to a bare interpreter start."""
+    results = []
+    repeats = 3 if quick else 10
+    baseline = np.median([_import_time('sys') for _ in range(repeats)])
+    for module in MODULES:
+        elapsed = np.median([_import_time(module) for _ in range(repeats)]) - baseline
+        results.append(result('import_time', {'module': module}, elapsed * 1e3, 'ms'))
+    return results
+
+
+def main():
+    parser = ArgumentParser('bench_import')
+    parser.add_argument('-o', '--output', help='path to the JSON results file (stdout if not specified)')
+    parser.add_argument('--quick', action='store_true', help='run fewer iterations')
+    args = parser.parse_args()
+    write_results(bench_import(args.quick), args.output)
+
+
+if __name__ == '__main__':
+    main()
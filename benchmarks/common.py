@@ -0,0 +1,21 @@
+"""Common helpers of the benchmarks."""
+import json
+import platform
+import sys
+from typing import List, Optional
+
+
+def result(benchmark: str, params: dict, value: float, unit: str) -> dict:
+    """Create a single machine-readable benchmark result."""
+    return {'benchmark': benchmark, 'params': params, 'value': float(value), 'unit': unit}
+
+
+def write_results(results: List[dict], output: Optional[str]=None) -> None:
+    """Write the results as JSON to the given file (or to stdout)."""
+    report = {'python': platform.python_version(), 'platform': platform.platform(), 'results': results}
+    if output is None:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        with open(output, 'w') as file:
+            json.dump(report, file, indent=2)
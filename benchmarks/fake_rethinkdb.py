@@ -0,0 +1,99 @@
+"""
+In-process RethinkDB stand-in for the benchmarks.
+
+The queries are built and serialized by the real driver (exactly as they would be sent over the wire); instead of
+sending them to a server, the fake connection instance records their size and answers them with a canned response.
+Hence, the benchmarks measure the client-side cost only.
+"""
+import threading
+from typing import List, Optional
+
+import rethinkdb as r
+
+from cxflow_rethinkdb.connection_pool import ConnectionPool
+
+
+class FakeStats:
+    """Thread-safe statistics of the queries answered by the fake connections."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.connections = 0
+        self.queries = 0
+        self.bytes_sent = 0
+        self.query_sizes = []  # type: List[int]
+
+    def record(self, size: int) -> None:
+        """Record a single query of the given serialized size."""
+        with self._lock:
+            self.queries += 1
+            self.bytes_sent += size
+            self.query_sizes.append(size)
+
+    def reset(self) -> None:
+        """Reset all the counters."""
+        with self._lock:
+            self.connections = self.queries = self.bytes_sent = 0
+            self.query_sizes = []
+
+
+class FakeConnectionInstance:
+    """Connection instance (see ``rethinkdb.net.ConnectionInstance``) answering the queries without a server."""
+
+    def __init__(self, parent: r.net.Connection, stats: FakeStats, rows: Optional[List[dict]]=None):
+        """
+        Create a closed connection instance.
+
+        :param parent: the driver connection
+        :param stats: statistics to be updated
+        :param rows: documents returned by the sequence queries (e.g. ``table``, ``between``)
+        """
+        self._parent = parent
+        self._stats = stats
+        self._rows = rows if rows is not None else []
+        self._open = False
+
+    def connect(self, timeout) -> r.net.Connection:
+        self._open = True
+        self._stats.connections += 1
+        return self._parent
+
+    def is_open(self) -> bool:
+        return self._open
+
+    def close(self, noreply_wait=False, token=None) -> None:
+        self._open = False
+
+    def client_port(self):
+        return None
+
+    def client_address(self):
+        return None
+
+    def run_query(self, query, noreply: bool):
+        """Serialize the query as the driver would do and answer it."""
+        self._stats.record(len(query.serialize(self._parent._get_json_encoder(query))))
+        if noreply:
+            return None
+
+        term = type(query.term).__name__
+        if term == 'Insert':
+            inserted = len(query.term._args[1]._args) if type(query.term._args[1]).__name__ == 'MakeArray' else 1
+            return {'errors': 0, 'inserted': inserted, 'replaced': 0, 'unchanged': 0, 'skipped': 0, 'deleted': 0}
+        if term == 'Update':
+            return {'errors': 0, 'inserted': 0, 'replaced': 1, 'unchanged': 0, 'skipped': 0, 'deleted': 0}
+        if term in ('Table', 'Between', 'OrderBy', 'Filter', 'Map', 'GetAll'):
+            return list(self._rows)
+        return None
+
+
+def fake_connection(stats: FakeStats, rows: Optional[List[dict]]=None) -> r.net.Connection:
+    """Open a new fake connection."""
+    conn = r.net.Connection(FakeConnectionInstance, 'localhost', 28015, None, None, 'admin', '', 20, {}, 10,
+                            stats=stats, rows=rows)
+    return conn.reconnect(timeout=20)
+
+
+def fake_pool(credentials: dict, stats: FakeStats, rows: Optional[List[dict]]=None, **kwargs) -> ConnectionPool:
+    """Create a connection pool of fake connections."""
+    return ConnectionPool(credentials, connection_factory=lambda: fake_connection(stats, rows), **kwargs)
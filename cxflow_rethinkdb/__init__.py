@@ -1 +1,31 @@
-from .rethinkdb_hook import RethinkDBHook
+"""
+RethinkDB plugin for cxflow.
+
+The public attributes are imported on the first access, hence importing the package (e.g. by the ``cx-rethinkdb``
+CLI or ``cxflow_rethinkdb.utils``) does not import `cxflow`, `numpy` and the other dependencies of the hook.
+"""
+import importlib
+import sys
+import types
+
+_LAZY_ATTRIBUTES = {'RethinkDBHook': 'rethinkdb_hook'}
+"""Public attribute name -> name of the submodule defining it."""
+
+
+class _LazyModule(types.ModuleType):
+    """Package module importing the submodules defining the public attributes on their first access."""
+
+    def __getattr__(self, name: str):
+        if name not in _LAZY_ATTRIBUTES:
+            raise AttributeError('module `{}` has no attribute `{}`'.format(self.__name__, name))
+        value = getattr(importlib.import_module('.' + _LAZY_ATTRIBUTES[name], self.__name__), name)
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(super().__dir__()) | set(_LAZY_ATTRIBUTES))
+
+
+__all__ = ['RethinkDBHook']
+
+sys.modules[__name__].__class__ = _LazyModule
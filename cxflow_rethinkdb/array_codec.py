@@ -0,0 +1,120 @@
+import zlib
+from typing import Any, Optional
+
+import numpy as np
+import rethinkdb as r
+
+
+ARRAY_MARKER = '__ndarray__'
+"""Key identifying the binary-encoded numpy arrays."""
+
+
+def _compress(payload: bytes, compression: Optional[str]) -> bytes:
+    """Compress the payload with the given compression."""
+    if compression is None:
+        return payload
+    elif compression == 'zlib':
+        return zlib.compress(payload)
+    elif compression == 'lz4':
+        import lz4.frame  # optional dependency
+        return lz4.frame.compress(payload)
+    raise ValueError('Unknown compression `{}`'.format(compression))
+
+
+def _decompress(payload: bytes, compression: Optional[str]) -> bytes:
+    """Decompress the payload compressed with the given compression."""
+    if compression is None:
+        return payload
+    elif compression == 'zlib':
+        return zlib.decompress(payload)
+    elif compression == 'lz4':
+        import lz4.frame  # optional dependency
+        return lz4.frame.decompress(payload)
+    raise ValueError('Unknown compression `{}`'.format(compression))
+
+
+class ArrayCodec:
+    """
+    Encode numpy arrays either as (nested) lists or as compact binary documents.
+
+    -------------------------------------------------------
+    The binary-encoded array structure:
+    -------------------------------------------------------
+    {
+        __ndarray__: true
+        dtype: numpy dtype string, e.g. `<f4`
+        shape: list of dimensions
+        compression: null, `zlib` or `lz4`
+        data: r.binary with the (compressed) raw array bytes in C order
+    }
+    -------------------------------------------------------
+
+    Use ``decode_arrays`` to convert the selected documents back to numpy arrays.
+    """
+
+    ENCODINGS = ['list', 'binary']
+    """Possible array encodings."""
+
+    COMPRESSIONS = [None, 'zlib', 'lz4']
+    """Possible compressions of the binary-encoded arrays."""
+
+    def __init__(self, encoding: str='list', compression: Optional[str]=None, threshold: int=1024):
+        """
+        Create new array codec.
+
+        :param encoding: ``list`` (plain JSON lists) or ``binary`` (raw dtype, shape and bytes via ``r.binary``)
+        :param compression: compression of the binary-encoded arrays, one of ``COMPRESSIONS``;
+                            ``lz4`` requires the `lz4` package
+        :param threshold: arrays smaller than this number of bytes are always encoded as lists
+        """
+        assert encoding in ArrayCodec.ENCODINGS
+        assert compression in ArrayCodec.COMPRESSIONS
+
+        if compression == 'lz4':
+            import lz4.frame  # pylint: disable=unused-import; fail early if the optional dependency is missing
+
+        self._encoding = encoding
+        self._compression = compression
+        self._threshold = threshold
+
+    def encode(self, array: np.ndarray) -> Any:
+        """
+        Encode the given array.
+
+        :param array: numpy array to be encoded
+        :return: nested list or binary-encoded array document
+        """
+        if self._encoding == 'list' or array.nbytes < self._threshold or array.dtype.hasobject:
+            return array.tolist()
+        return {ARRAY_MARKER: True,
+                'dtype': array.dtype.str,
+                'shape': list(array.shape),
+                'compression': self._compression,
+                'data': r.binary(_compress(np.ascontiguousarray(array).tobytes(), self._compression))}
+
+
+def decode_array(document: dict) -> np.ndarray:
+    """
+    Decode a single binary-encoded array document (as returned from the database).
+
+    :param document: binary-encoded array document
+    :return: read-only numpy array
+    """
+    payload = _decompress(bytes(document['data']), document['compression'])
+    return np.frombuffer(payload, dtype=np.dtype(document['dtype'])).reshape(document['shape'])
+
+
+def decode_arrays(data: Any) -> Any:
+    """
+    Recursively replace the binary-encoded array documents with numpy arrays.
+
+    :param data: (part of) a document selected from the database
+    :return: the data with numpy arrays in place of the binary-encoded array documents
+    """
+    if isinstance(data, dict):
+        if data.get(ARRAY_MARKER) is True:
+            return decode_array(data)
+        return {key: decode_arrays(value) for key, value in data.items()}
+    elif isinstance(data, list):
+        return [decode_arrays(value) for value in data]
+    return data
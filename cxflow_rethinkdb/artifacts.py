@@ -0,0 +1,237 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import hashlib
+import logging
+import os
+import threading
+from typing import BinaryIO, Callable, Iterator, List, Optional
+
+import pytz
+import rethinkdb as r
+
+from .connection_pool import ConnectionPool
+from .utils import connect, insert
+
+CHUNK_SIZE = 1024 * 1024
+"""Default size of the artifact chunks in bytes."""
+
+
+def _chunks_table(table_name: str) -> str:
+    """Name of the table with the chunks of the artifacts stored in the given table."""
+    return '{}_chunks'.format(table_name)
+
+
+def _file_digest(file_path: str, chunk_size: int) -> str:
+    """Compute the hex SHA-256 digest of the file reading it in chunks."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for data in iter(lambda: file.read(chunk_size), b''):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def _stored_chunks(artifact_id: list, chunks_table: str, db_name: str, conn: r.net.Connection) -> List[int]:
+    """Indices of the already stored chunks of the artifact."""
+    return list(r.db(db_name).table(chunks_table)
+                .between([artifact_id, r.minval], [artifact_id, r.maxval], index='id')
+                .map(lambda chunk: chunk['index'])
+                .run(conn))
+
+
+def upload_artifact(credentials: dict, db_name: str, run_id: str, name: str, file_path: str,
+                    table_name: str='artifacts', chunk_size: int=CHUNK_SIZE, workers: int=4,
+                    pool: Optional[ConnectionPool]=None) -> dict:
+    """
+    Store the file as an artifact split into ``r.binary`` chunks uploaded concurrently.
+
+    The artifact document (with the primary key ``[run_id, name]``) is stored in the ``table_name`` table; the chunks
+    (with the primary key ``[[run_id, name], index]``) in the ``<table_name>_chunks`` table. An interrupted upload of
+    the same file content is resumed: only the missing chunks are uploaded. An already complete upload of the same
+    content is skipped. At most ``2 * workers`` chunks are held in memory at once.
+
+    -------------------------------------------------------
+    The artifact document structure:
+    -------------------------------------------------------
+    {
+        id: [run id, artifact name]
+        run_id: the run id
+        name: the artifact name
+        size: file size in bytes
+        sha256: hex SHA-256 digest of the file
+        chunk_size: size of the chunks in bytes
+        n_chunks: number of chunks
+        complete: whether all the chunks are stored
+        timestamp: upload timestamp
+    }
+    -------------------------------------------------------
+
+    :param credentials: dict containing at least `host`, `port`, `user` and `password` keys
+    :param db_name: name of the database with the artifact tables
+    :param run_id: ID of the run the artifact belongs to (any namespace string)
+    :param name: name of the artifact, e.g. the path relative to the output directory
+    :param file_path: path to the file to be uploaded
+    :param table_name: name of the table with the artifact documents
+    :param chunk_size: size of the chunks in bytes
+    :param workers: number of concurrently uploaded chunks (and connections)
+    :param pool: optional connection pool; a dedicated pool with ``workers`` connections is used if not specified
+    :raise ValueError: if some of the chunks could not be stored
+    :return: the artifact document
+    """
+    artifact_id = [run_id, name]
+    chunks_table = _chunks_table(table_name)
+    size = os.path.getsize(file_path)
+    document = {'id': artifact_id, 'run_id': run_id, 'name': name, 'size': size,
+                'sha256': _file_digest(file_path, chunk_size), 'chunk_size': chunk_size,
+                'n_chunks': (size + chunk_size - 1) // chunk_size, 'complete': False,
+                'timestamp': datetime.now(pytz.utc)}
+
+    own_pool = pool is None
+    if own_pool:
+        pool = ConnectionPool(credentials, max_size=workers)
+    try:
+        with pool.connection() as conn:
+            existing = r.db(db_name).table(table_name).get(artifact_id).run(conn)
+            same_content = existing is not None and \
+                all(existing[key] == document[key] for key in ['size', 'sha256', 'chunk_size'])
+            if same_content and existing['complete']:
+                logging.info('Artifact `%s` of run `%s` is already stored', name, run_id)
+                return existing
+            if same_content:
+                stored = set(_stored_chunks(artifact_id, chunks_table, db_name, conn))
+                logging.info('Resuming the upload of artifact `%s` (%d/%d chunks stored)', name, len(stored),
+                             document['n_chunks'])
+            else:
+                stored = set()
+                r.db(db_name).table(chunks_table)\
+                    .between([artifact_id, r.minval], [artifact_id, r.maxval], index='id').delete().run(conn)
+                insert(credentials=credentials, db_name=db_name, table_name=table_name, document=document, conn=conn,
+                       conflict='replace')
+
+        errors = []
+        in_flight = threading.BoundedSemaphore(2 * workers)
+
+        def upload_chunk(index: int, data: bytes) -> None:
+            """Store a single chunk."""
+            try:
+                with pool.connection() as chunk_conn:
+                    response = insert(credentials=credentials, db_name=db_name, table_name=chunks_table,
+                                      document={'id': [artifact_id, index], 'artifact_id': artifact_id,
+                                                'index': index, 'data': r.binary(data)},
+                                      conn=chunk_conn, conflict='replace', durability='soft')
+                if response['errors'] > 0:
+                    errors.append(response.get('first_error'))
+            except Exception as ex:  # pylint: disable=broad-except
+                errors.append(str(ex))
+            finally:
+                in_flight.release()
+
+        logging.info('Uploading artifact `%s` of run `%s` (%d bytes)', name, run_id, size)
+        with ThreadPoolExecutor(max_workers=workers) as executor, open(file_path, 'rb') as file:
+            for index in range(document['n_chunks']):
+                if index in stored:
+                    continue
+                in_flight.acquire()
+                file.seek(index * chunk_size)
+                executor.submit(upload_chunk, index, file.read(chunk_size))
+
+        if errors:
+            raise ValueError('Failed to store {} chunk(s) of artifact `{}`: {}'.format(len(errors), name, errors[0]))
+
+        with pool.connection() as conn:
+            r.db(db_name).table(chunks_table).sync().run(conn)
+            r.db(db_name).table(table_name).get(artifact_id).update({'complete': True}).run(conn)
+        document['complete'] = True
+        return document
+    finally:
+        if own_pool:
+            pool.close()
+
+
+def list_artifacts(credentials: dict, db_name: str, run_id: str, table_name: str='artifacts',
+                   conn: Optional[r.net.Connection]=None) -> List[dict]:
+    """
+    Select the artifact documents of the specified run ordered by their name.
+
+    :param credentials: dict containing at least `host`, `port`, `user` and `password` keys
+    :param db_name: name of the database with the artifact tables
+    :param run_id: ID of the run the artifacts belong to
+    :param table_name: name of the table with the artifact documents
+    :param conn: optional open (e.g. pooled) connection; a new connection is opened if not specified
+    :return: list of artifact documents
+    """
+    with connect(credentials, conn, db=db_name) as conn:
+        return list(r.db(db_name).table(table_name)
+                    .between([run_id, r.minval], [run_id, r.maxval], index='id')
+                    .order_by(index='id')
+                    .run(conn))
+
+
+def iter_artifact(credentials: dict, db_name: str, run_id: str, name: str, table_name: str='artifacts',
+                  conn: Optional[r.net.Connection]=None,
+                  on_document: Optional[Callable[[dict], None]]=None) -> Iterator[bytes]:
+    """
+    Stream the chunks of the artifact in order; at most a single chunk is fetched in a round trip.
+
+    :param credentials: dict containing at least `host`, `port`, `user` and `password` keys
+    :param db_name: name of the database with the artifact tables
+    :param run_id: ID of the run the artifact belongs to
+    :param name: name of the artifact
+    :param table_name: name of the table with the artifact documents
+    :param conn: optional open (e.g. pooled) connection; a new connection is opened if not specified
+    :param on_document: optional function called with the artifact document (e.g. to verify the streamed data
+                        against its `size` and `sha256`) before the first chunk is fetched
+    :raise KeyError: if the artifact does not exist
+    :raise ValueError: if the artifact upload is not complete or a chunk is missing
+    :return: iterator of the chunk data
+    """
+    artifact_id = [run_id, name]
+    with connect(credentials, conn, db=db_name) as conn:
+        document = r.db(db_name).table(table_name).get(artifact_id).run(conn)
+        if document is None:
+            raise KeyError('Artifact `{}` of run `{}` was not found in `{}.{}`'.format(name, run_id, db_name,
+                                                                                      table_name))
+        if not document['complete']:
+            raise ValueError('Artifact `{}` of run `{}` is not completely uploaded'.format(name, run_id))
+        if on_document is not None:
+            on_document(document)
+
+        chunks = r.db(db_name).table(_chunks_table(table_name))\
+            .between([artifact_id, r.minval], [artifact_id, r.maxval], index='id')\
+            .order_by(index='id')
+        for expected, chunk in enumerate(chunks.run(conn, max_batch_rows=1)):
+            if chunk['index'] != expected:
+                raise ValueError('Chunk {} of artifact `{}` is missing'.format(expected, name))
+            yield chunk['data']
+
+
+def download_artifact(credentials: dict, db_name: str, run_id: str, name: str, output: BinaryIO,
+                      table_name: str='artifacts', conn: Optional[r.net.Connection]=None) -> int:
+    """
+    Write the artifact to the given binary file and verify its size and digest against the artifact document read
+    by ``iter_artifact``.
+
+    :param credentials: dict containing at least `host`, `port`, `user` and `password` keys
+    :param db_name: name of the database with the artifact tables
+    :param run_id: ID of the run the artifact belongs to
+    :param name: name of the artifact
+    :param output: binary file opened for writing
+    :param table_name: name of the table with the artifact documents
+    :param conn: optional open (e.g. pooled) connection; a new connection is opened if not specified
+    :raise KeyError: if the artifact does not exist
+    :raise ValueError: if the artifact is not complete or corrupted
+    :return: number of written bytes
+    """
+    logging.info('Downloading artifact `%s` of run `%s`', name, run_id)
+    documents = []
+    digest = hashlib.sha256()
+    written = 0
+    for data in iter_artifact(credentials=credentials, db_name=db_name, run_id=run_id, name=name,
+                              table_name=table_name, conn=conn, on_document=documents.append):
+        digest.update(data)
+        output.write(data)
+        written += len(data)
+
+    document = documents[0]
+    if written != document['size'] or digest.hexdigest() != document['sha256']:
+        raise ValueError('Artifact `{}` of run `{}` is corrupted'.format(name, run_id))
+    return written
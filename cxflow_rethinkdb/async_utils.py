@@ -0,0 +1,337 @@
+"""
+Asyncio counterparts of the ``cxflow_rethinkdb.utils`` functions.
+
+The functions are coroutines running their queries on the driver's asyncio connections. Contrary to
+``r.set_loop_type('asyncio')``, the loop type of ``r.connect`` is never switched, hence the blocking ``utils`` keep
+working in the same process (and its other threads).
+
+-------------------------------------------------------
+Example usage
+-------------------------------------------------------
+loop = asyncio.new_event_loop()
+try:
+    documents = loop.run_until_complete(select_by_ids(credentials, 'my_database', 'my_table', run_ids))
+finally:
+    loop.close()
+-------------------------------------------------------
+"""
+import asyncio
+import importlib.util
+import logging
+from os import path
+import sys
+from typing import Callable, List, Optional, Sequence, Union
+
+import rethinkdb as r
+
+from .utils import _rehydrate_config
+
+_connection_type = None
+"""The driver's asyncio connection class (loaded on the first connect)."""
+
+
+def _asyncio_connection_type() -> type:
+    """
+    Import the asyncio connection class of the driver.
+
+    The process-wide loop type of ``r.connect`` (``r.set_loop_type``) is never touched, hence the blocking connections
+    may be opened concurrently from the other threads.
+    """
+    global _connection_type  # pylint: disable=global-statement
+    if _connection_type is None:
+        try:
+            from rethinkdb.asyncio_net.net_asyncio import Connection
+        except ImportError:
+            # drivers before 2.4 import the module relatively to the `rethinkdb` package (as ``r.set_loop_type`` does)
+            module = sys.modules.get('rethinkdb.net_asyncio')
+            if module is None:
+                spec = importlib.util.spec_from_file_location(
+                    'rethinkdb.net_asyncio', path.join(path.dirname(r.__file__), 'asyncio_net', 'net_asyncio.py'))
+                module = importlib.util.module_from_spec(spec)
+                spec.loader.exec_module(module)
+                sys.modules['rethinkdb.net_asyncio'] = module
+            Connection = module.Connection  # pylint: disable=invalid-name
+        _connection_type = Connection
+    return _connection_type
+
+
+async def connect(credentials: dict, **kwargs):
+    """
+    Open a new asyncio connection.
+
+    :param credentials: dict containing at least `host`, `port`, `user` and `password` keys
+    :param kwargs: additional ``r.connect`` arguments, e.g. ``db``
+    :return: open connection; to be closed with ``await conn.close()``
+    """
+    kwargs = dict(credentials, **kwargs)
+    conn = _asyncio_connection_type()(kwargs.pop('host', 'localhost'), kwargs.pop('port', r.DEFAULT_PORT),
+                                      kwargs.pop('db', None), kwargs.pop('auth_key', None),
+                                      kwargs.pop('user', 'admin'), kwargs.pop('password', None),
+                                      kwargs.pop('timeout', 20), kwargs.pop('ssl', {}), 10, **kwargs)
+    return await conn.reconnect(timeout=conn.connect_timeout)
+
+
+class _Connection:
+    """Async context manager using the given asyncio connection or opening a new one which is closed afterwards."""
+
+    def __init__(self, credentials: dict, conn=None, **kwargs):
+        self._credentials = credentials
+        self._conn = conn
+        self._kwargs = kwargs
+        self._own = conn is None
+
+    async def __aenter__(self):
+        if self._own:
+            self._conn = await connect(self._credentials, **self._kwargs)
+        return self._conn
+
+    async def __aexit__(self, *_):
+        if self._own:
+            await self._conn.close()
+
+
+async def create_db(credentials: dict, db_name: str, conn=None) -> dict:
+    """
+    Create a database.
+
+    :param credentials: dict containing at least `host`, `port`, `user` and `password` keys
+    :param db_name: name of the database to be created
+    :param conn: optional open asyncio connection; a new connection is opened if not specified
+    :return: RethinkDB response
+    """
+    logging.info('Creating database `%s`', db_name)
+
+    async with _Connection(credentials, conn) as conn:
+        return await r.db_create(db_name).run(conn)
+
+
+async def create_table(credentials: dict, db_name: str, table_name: str, conn=None) -> dict:
+    """
+    Create a table.
+
+    :param credentials: dict containing at least `host`, `port`, `user` and `password` keys
+    :param db_name: name of the database in which the table will be created
+    :param table_name: name of the table to be created
+    :param conn: optional open asyncio connection; a new connection is opened if not specified
+    :return: RethinkDB response
+    """
+    logging.info('Creating table `%s.%s`', db_name, table_name)
+
+    async with _Connection(credentials, conn, db=db_name) as conn:
+        return await r.db(db_name).table_create(table_name).run(conn)
+
+
+async def create_user(credentials: dict, user: str, password: str, conn=None) -> dict:
+    """
+    Create a user.
+
+    :param credentials: dict containing at least `host`, `port`, `user` and `password` keys
+    :param user: name of new user to be created
+    :param password: password to be set to the new user
+    :param conn: optional open asyncio connection; a new connection is opened if not specified
+    :return: RethinkDB response
+    """
+    logging.info('Creating user `%s`', user)
+
+    async with _Connection(credentials, conn) as conn:
+        return await r.db('rethinkdb').table('users').insert({'id': user, 'password': password}).run(conn)
+
+
+async def grant_permission(credentials: dict, user: str, permissions: dict, db_name: str,
+                           table_name: Optional[str]=None, conn=None) -> dict:
+    """
+    Grant permission to a user.
+
+    If `table_name` is set to `None`, permission is granted to the whole database.
+
+    :param credentials: dict containing at least `host`, `port`, `user` and `password` keys
+    :param user: name of the user to which the permissions will be granted
+    :param permissions: dict of standard RethinkDB permissions, e.g. `{'read': true, 'write': true}`
+    :param db_name: name of the database to which the permissions will be granted
+    :param table_name: name of the table to which the permissions will be granted. If `None`, the permissions will
+                       be applied to the whole database.
+    :param conn: optional open asyncio connection; a new connection is opened if not specified
+    :return: RethinkDB response
+    """
+    logging.info('Grating user `%s` permissions `%s` to `%s.%s`', user, permissions, db_name, table_name)
+
+    query = r.db(db_name)
+    if table_name is not None:
+        query = query.table(table_name)
+    async with _Connection(credentials, conn) as conn:
+        return await query.grant(user, permissions).run(conn)
+
+
+async def insert(credentials: dict, db_name: str, table_name: str, document: Union[dict, List[dict]], conn=None,
+                 conflict: Union[str, Callable]='error', durability: str='hard', **run_kwargs) -> dict:
+    """
+    Create new document in the specified table.
+
+    :param credentials: dict containing at least `host`, `port`, `user` and `password` keys
+    :param db_name: name of the database in which the document will be inserted
+    :param table_name: name of the table in which the document will be inserted
+    :param document: document (or list of documents) to be inserted
+    :param conn: optional open asyncio connection; a new connection is opened if not specified
+    :param conflict: standard RethinkDB conflict resolution (`error`, `replace`, `update` or a function)
+    :param durability: `hard` (acknowledge the write once it is on disk) or `soft` (once it is in memory)
+    :param run_kwargs: additional ``run`` arguments, e.g. ``json_encoder``
+    :return: RethinkDB response
+    """
+    logging.info('Inserting a document to %s.%s', db_name, table_name)
+
+    async with _Connection(credentials, conn, db=db_name) as conn:
+        return await r.db(db_name).table(table_name).insert(document, conflict=conflict, durability=durability)\
+            .run(conn, **run_kwargs)
+
+
+def _by_id_query(db_name: str, table_name: str, doc_id: str, rehydrate_config: bool):
+    """ReQL query selecting the document (optionally with the rehydrated config) by its ID."""
+    query = r.db(db_name).table(table_name).get(doc_id)
+    if rehydrate_config:
+        query = query.do(lambda document: r.branch(document.eq(None), None, _rehydrate_config(db_name, document)))
+    return query
+
+
+async def select_by_id(credentials: dict, db_name: str, table_name: str, doc_id: str, conn=None,
+                       decode_arrays: bool=False, rehydrate_config: bool=False) -> dict:
+    """
+    Select a document with a specified ID (from the specified table).
+
+    :param credentials: dict containing at least `host`, `port`, `user` and `password` keys
+    :param db_name: name of the database from which the document will be selected
+    :param table_name: name of the table from which the document will be selected
+    :param doc_id: document ID
+    :param conn: optional open asyncio connection; a new connection is opened if not specified
+    :param decode_arrays: convert the binary-encoded arrays (see ``ArrayCodec``) to numpy arrays
+    :param rehydrate_config: fill the `config` of a run document stored with a deduplicated config
+    :raise KeyError: if the document does not exist
+    :return: RethinkDB response
+    """
+    logging.info('Selecting document with ID `%s` from %s.%s', doc_id, db_name, table_name)
+
+    async with _Connection(credentials, conn, db=db_name) as conn:
+        document = await _by_id_query(db_name, table_name, doc_id, rehydrate_config).run(conn)
+
+    if document is None:
+        raise KeyError('Document with ID `{}` was not found in `{}.{}`'.format(doc_id, db_name, table_name))
+    if decode_arrays:
+        from .array_codec import decode_arrays as _decode_arrays  # imported lazily, see the package docstring
+        document = _decode_arrays(document)
+    return document
+
+
+async def select_by_ids(credentials: dict, db_name: str, table_name: str, doc_ids: Sequence[str],
+                        concurrency: int=64, conn=None, decode_arrays: bool=False,
+                        rehydrate_config: bool=False) -> List[Optional[dict]]:
+    """
+    Select the documents with the specified IDs concurrently over a single connection.
+
+    At most ``concurrency`` queries are in flight at once, hence fetching ``n`` documents costs about
+    ``n / concurrency`` round trips instead of ``n`` sequential ones.
+
+    :param credentials: dict containing at least `host`, `port`, `user` and `password` keys
+    :param db_name: name of the database from which the documents will be selected
+    :param table_name: name of the table from which the documents will be selected
+    :param doc_ids: document IDs
+    :param concurrency: maximal number of concurrently running queries
+    :param conn: optional open asyncio connection; a new connection is opened if not specified
+    :param decode_arrays: convert the binary-encoded arrays (see ``ArrayCodec``) to numpy arrays
+    :param rehydrate_config: fill the `config` of the run documents stored with a deduplicated config
+    :return: list of the documents in the order of ``doc_ids``; `None` for the missing ones
+    """
+    assert concurrency > 0
+    logging.info('Selecting %d document(s) from %s.%s', len(doc_ids), db_name, table_name)
+
+    semaphore = asyncio.Semaphore(concurrency)
+    async with _Connection(credentials, conn, db=db_name) as conn:
+
+        async def select(doc_id: str) -> Optional[dict]:
+            """Select a single document once a slot is free."""
+            async with semaphore:
+                return await _by_id_query(db_name, table_name, doc_id, rehydrate_config).run(conn)
+
+        documents = await asyncio.gather(*[select(doc_id) for doc_id in doc_ids])
+
+    if decode_arrays:
+        from .array_codec import decode_arrays as _decode_arrays  # imported lazily, see the package docstring
+        documents = [None if document is None else _decode_arrays(document) for document in documents]
+    return list(documents)
+
+
+class _Documents:
+    """
+    Async iterator of the documents selected by the query.
+
+    The connection is closed once the iterator is exhausted. When the iteration is left early (e.g. by ``break``), the
+    iterator must be closed by ``aclose``; using it as an async context manager does so automatically.
+    """
+
+    def __init__(self, query, connection: _Connection):
+        self._query = query
+        self._connection = connection
+        self._conn = None
+        self._cursor = None
+        self._closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        await self.aclose()
+
+    async def __anext__(self) -> dict:
+        if self._closed:
+            raise StopAsyncIteration
+        try:
+            if self._cursor is None:
+                self._conn = await self._connection.__aenter__()
+                self._cursor = await self._query.run(self._conn)
+            if await self._cursor.fetch_next():
+                return await self._cursor.next()
+        except BaseException:
+            await self.aclose()
+            raise
+        await self.aclose()
+        raise StopAsyncIteration
+
+    async def aclose(self) -> None:
+        """Stop the iteration and release the connection (or the cursor of the given connection); idempotent."""
+        if self._closed:
+            return
+        self._closed = True
+        if self._conn is None:
+            return
+        if self._connection._own:  # pylint: disable=protected-access
+            await self._connection.__aexit__(None, None, None)
+        elif self._cursor is not None:
+            self._cursor.close()
+
+
+def select_all(credentials: dict, db_name: str, table_name: str, conn=None) -> _Documents:
+    """
+    Select all documents from the specified table.
+
+    The documents are streamed; the connection is kept open until the returned async iterator is exhausted or closed
+    with ``aclose``. Use it as an async context manager if the iteration may be left early.
+
+    -------------------------------------------------------
+    Example usage
+    -------------------------------------------------------
+    async with select_all(credentials, 'my_database', 'my_table') as documents:
+        async for document in documents:
+            if document['user'] == 'my_user':
+                break
+    -------------------------------------------------------
+
+    :param credentials: dict containing at least `host`, `port`, `user` and `password` keys
+    :param db_name: name of the database from which the documents will be selected
+    :param table_name: name of the table from which the documents will be selected
+    :param conn: optional open asyncio connection; a new connection is opened if not specified
+    :return: async iterator of documents
+    """
+    logging.info('Selecting all documents from %s.%s', db_name, table_name)
+
+    return _Documents(r.db(db_name).table(table_name), _Connection(credentials, conn, db=db_name))
@@ -0,0 +1,116 @@
+from collections import deque
+import logging
+import threading
+from typing import Any, Callable, List
+
+
+class BackgroundWriter:
+    """
+    Write items to the database in a dedicated thread fed by a bounded queue.
+
+    The items are passed to the ``write_fn`` in batches (lists). Usually, each batch contains a single item; with the
+    ``coalesce`` policy, the items put to a full queue are merged into the newest pending batch.
+
+    -------------------------------------------------------
+    Backpressure policies (applied when the queue is full):
+    -------------------------------------------------------
+    block:       wait until the writer thread makes room in the queue
+    drop_oldest: discard the oldest pending batch (and log a warning)
+    coalesce:    append the item to the newest pending batch
+    -------------------------------------------------------
+    """
+
+    BACKPRESSURE_POLICIES = ['block', 'drop_oldest', 'coalesce']
+    """Possible actions to take when the queue is full."""
+
+    def __init__(self, write_fn: Callable[[List[Any]], None], max_queue_size: int=100, backpressure: str='block',
+                 name: str='rethinkdb-writer'):
+        """
+        Create the queue and start the writer thread.
+
+        :param write_fn: function writing a list of items; exceptions raised from it are logged and the batch is lost
+        :param max_queue_size: maximal number of pending batches
+        :param backpressure: action taken when the queue is full, one of ``BACKPRESSURE_POLICIES``
+        :param name: name of the writer thread
+        """
+        assert backpressure in BackgroundWriter.BACKPRESSURE_POLICIES
+        assert max_queue_size > 0
+
+        self._write_fn = write_fn
+        self._max_queue_size = max_queue_size
+        self._backpressure = backpressure
+
+        self._pending = deque()
+        self._in_flight = False
+        self._closed = False
+        self._dropped = 0
+        self._condition = threading.Condition()
+
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    @property
+    def dropped(self) -> int:
+        """Number of items discarded by the ``drop_oldest`` policy."""
+        return self._dropped
+
+    def put(self, item: Any) -> None:
+        """
+        Enqueue the item to be written by the writer thread.
+
+        :param item: item to be written
+        :raise RuntimeError: if the writer is already closed
+        """
+        with self._condition:
+            if self._closed:
+                raise RuntimeError('Can not put an item to a closed writer.')
+
+            if len(self._pending) >= self._max_queue_size:
+                if self._backpressure == 'block':
+                    while len(self._pending) >= self._max_queue_size:
+                        self._condition.wait()
+                elif self._backpressure == 'drop_oldest':
+                    dropped = self._pending.popleft()
+                    self._dropped += len(dropped)
+                    logging.warning('RethinkDB writer queue is full, dropping %d oldest item(s)', len(dropped))
+                elif self._backpressure == 'coalesce':
+                    self._pending[-1].append(item)
+                    self._condition.notify_all()
+                    return
+
+            self._pending.append([item])
+            self._condition.notify_all()
+
+    def flush(self) -> None:
+        """Block until all the pending items are written."""
+        with self._condition:
+            while self._pending or self._in_flight:
+                self._condition.wait()
+
+    def close(self) -> None:
+        """Write all the pending items and join the writer thread. Calling ``close`` repeatedly is safe."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+
+    def _run(self) -> None:
+        """Writer thread loop: write the pending batches until the writer is closed and the queue is empty."""
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if not self._pending:
+                    return
+                batch = self._pending.popleft()
+                self._in_flight = True
+                self._condition.notify_all()
+
+            try:
+                self._write_fn(batch)
+            except Exception:  # pylint: disable=broad-except
+                logging.exception('RethinkDB writer failed to write %d item(s)', len(batch))
+            finally:
+                with self._condition:
+                    self._in_flight = False
+                    self._condition.notify_all()
@@ -0,0 +1,156 @@
+import math
+from typing import Dict, List, Optional
+
+import numpy as np
+
+
+def downsample_every_k(batch_ids: np.ndarray, values: np.ndarray, points: int) -> dict:
+    """
+    Keep every k-th value so that at most ``points`` values are kept.
+
+    :param batch_ids: batch ids
+    :param values: values of a single variable
+    :param points: maximal number of the kept values
+    :return: dict with `batch_ids` and `values` lists
+    """
+    step = max(1, int(math.ceil(len(values) / points)))
+    return {'batch_ids': batch_ids[::step].tolist(), 'values': values[::step].tolist()}
+
+
+def downsample_buckets(batch_ids: np.ndarray, values: np.ndarray, points: int) -> dict:
+    """
+    Split the values to ``points`` consecutive buckets and keep their min, max and mean.
+
+    :param batch_ids: batch ids
+    :param values: values of a single variable
+    :param points: maximal number of the buckets
+    :return: dict with `batch_ids` (the first batch id of each bucket), `min`, `max` and `mean` lists
+    """
+    starts = np.unique(np.linspace(0, len(values), min(points, len(values)), endpoint=False).astype(np.int64))
+    return {'batch_ids': batch_ids[starts].tolist(),
+            'min': np.minimum.reduceat(values, starts).tolist(),
+            'max': np.maximum.reduceat(values, starts).tolist(),
+            'mean': (np.add.reduceat(values, starts) / np.diff(np.append(starts, len(values)))).tolist()}
+
+
+def downsample_lttb(batch_ids: np.ndarray, values: np.ndarray, points: int) -> dict:
+    """
+    Keep ``points`` values selected by the Largest-Triangle-Three-Buckets algorithm which preserves the visual shape
+    of the curve.
+
+    :param batch_ids: batch ids
+    :param values: values of a single variable
+    :param points: maximal number of the kept values (at least 3)
+    :return: dict with `batch_ids` and `values` lists
+    """
+    n_values = len(values)
+    if n_values <= points:
+        return {'batch_ids': batch_ids.tolist(), 'values': values.tolist()}
+
+    x = batch_ids.astype(np.float64)
+    edges = np.linspace(1, n_values - 1, points - 1).astype(np.int64)
+    selected = np.empty(points, dtype=np.int64)
+    selected[0], selected[-1] = 0, n_values - 1
+    previous = 0
+    for i in range(points - 2):
+        start, end = edges[i], edges[i + 1]
+        next_start, next_end = (edges[i + 1], edges[i + 2]) if i + 2 < len(edges) else (n_values - 1, n_values)
+        next_x, next_y = x[next_start:next_end].mean(), values[next_start:next_end].mean()
+        areas = np.abs((x[previous] - next_x) * (values[start:end] - values[previous]) -
+                       (x[previous] - x[start:end]) * (next_y - values[previous]))
+        previous = start + int(np.argmax(areas))
+        selected[i + 1] = previous
+    return {'batch_ids': batch_ids[selected].tolist(), 'values': values[selected].tolist()}
+
+
+class BatchBuffer:
+    """
+    Fixed-size array-backed buffer of batch-level scalars which are downsampled when the buffer is reduced.
+
+    The arrays are allocated once; appending a batch only writes a single row, hence the per-batch cost does not
+    depend on the number of batches.
+
+    -------------------------------------------------------
+    Downsampling methods:
+    -------------------------------------------------------
+    every_k: keep every k-th value
+    buckets: keep min, max and mean of consecutive buckets
+    lttb:    keep the values selected by Largest-Triangle-Three-Buckets
+    -------------------------------------------------------
+    """
+
+    DOWNSAMPLING_METHODS = {'every_k': downsample_every_k, 'buckets': downsample_buckets, 'lttb': downsample_lttb}
+    """Possible downsampling methods."""
+
+    def __init__(self, variables: List[str], capacity: int=1000, downsampling: str='buckets', points: int=100):
+        """
+        Allocate the buffer.
+
+        :param variables: names of the buffered variables
+        :param capacity: maximal number of buffered batches
+        :param downsampling: downsampling method, one of ``DOWNSAMPLING_METHODS``
+        :param points: number of values (or buckets) kept per variable when the buffer is reduced
+        """
+        assert downsampling in BatchBuffer.DOWNSAMPLING_METHODS
+        assert capacity > 0
+        assert points >= 3 or downsampling != 'lttb'
+
+        self._variables = list(variables)
+        self._downsampling = downsampling
+        self._points = points
+        self._batch_ids = np.empty(capacity, dtype=np.int64)
+        self._values = np.empty((capacity, len(self._variables)), dtype=np.float64)
+        self._count = 0
+
+    @property
+    def variables(self) -> List[str]:
+        """Names of the buffered variables."""
+        return self._variables
+
+    @property
+    def full(self) -> bool:
+        """Whether the buffer has to be reduced before appending another batch."""
+        return self._count == len(self._batch_ids)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def append(self, batch_id: int, values: Dict[str, float]) -> None:
+        """
+        Append a single batch.
+
+        :param batch_id: id of the batch
+        :param values: dict of variable name -> value; missing variables are recorded as NaN and skipped later
+        :raise IndexError: if the buffer is full
+        """
+        if self.full:
+            raise IndexError('The batch buffer is full.')
+        self._batch_ids[self._count] = batch_id
+        row = self._values[self._count]
+        for i, variable in enumerate(self._variables):
+            row[i] = values.get(variable, np.nan)
+        self._count += 1
+
+    def reduce(self) -> Optional[dict]:
+        """
+        Downsample the buffered batches and empty the buffer.
+
+        :return: None if the buffer is empty, dict with `first_batch`, `last_batch`, `count` and `variables`
+                 (variable name -> downsampled values, see the downsampling functions) otherwise
+        """
+        if self._count == 0:
+            return None
+
+        batch_ids = self._batch_ids[:self._count]
+        downsample = BatchBuffer.DOWNSAMPLING_METHODS[self._downsampling]
+        variables = {}
+        for i, variable in enumerate(self._variables):
+            values = self._values[:self._count, i]
+            valid = ~np.isnan(values)
+            if valid.any():
+                variables[variable] = downsample(batch_ids[valid], values[valid], self._points)
+
+        chunk = {'first_batch': int(batch_ids[0]), 'last_batch': int(batch_ids[-1]), 'count': self._count,
+                 'variables': variables}
+        self._count = 0
+        return chunk
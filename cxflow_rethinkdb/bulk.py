@@ -0,0 +1,215 @@
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import json
+import logging
+import os
+from os import path
+import sys
+import threading
+import time
+from typing import Iterable, Iterator, List, Optional
+
+import rethinkdb as r
+
+from .connection_pool import ConnectionPool
+from .utils import insert, iter_table
+
+
+def _iter_jsonl(file) -> Iterator[dict]:
+    """Iterate the documents of an opened JSONL file (one document per line)."""
+    for line in file:
+        if line.strip():
+            yield json.loads(line)
+
+
+def _iter_file(file_path: str) -> Iterator[dict]:
+    """Iterate the documents of a JSONL file or a JSON file containing either a document or a list of documents."""
+    with open(file_path, 'r') as file:
+        if file_path.endswith('.jsonl'):
+            yield from _iter_jsonl(file)
+        else:
+            data = json.load(file)
+            if isinstance(data, list):
+                yield from data
+            else:
+                yield data
+
+
+def iter_documents(source: str) -> Iterator[dict]:
+    """
+    Stream the documents from the given source.
+
+    :param source: path to a JSON file (a document or a list of documents), a JSONL file (one document per line),
+                   a directory (all the `.json` and `.jsonl` files inside, recursively) or `-` for JSONL on stdin
+    :return: iterator of documents
+    """
+    if source == '-':
+        yield from _iter_jsonl(sys.stdin)
+    elif path.isdir(source):
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for file_name in sorted(files):
+                if file_name.endswith('.json') or file_name.endswith('.jsonl'):
+                    yield from _iter_file(path.join(root, file_name))
+    else:
+        yield from _iter_file(source)
+
+
+def _batches(documents: Iterable[dict], batch_size: int) -> Iterator[List[dict]]:
+    """Group the documents to lists of at most ``batch_size`` documents."""
+    batch = []
+    for document in documents:
+        batch.append(document)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class _Progress:
+    """Thread-safe counters of the bulk insert with periodic logging."""
+
+    def __init__(self, report_interval: float):
+        """Create zero counters; the progress is logged every ``report_interval`` seconds."""
+        self._lock = threading.Lock()
+        self._start = time.time()
+        self._last_report = self._start
+        self._report_interval = report_interval
+        self.inserted = 0
+        self.errors = 0
+
+    def update(self, inserted: int, errors: int) -> None:
+        """Add the results of a single batch and log the progress if it was not logged recently."""
+        with self._lock:
+            self.inserted += inserted
+            self.errors += errors
+            now = time.time()
+            if now - self._last_report >= self._report_interval:
+                self._last_report = now
+                self.report()
+
+    def report(self) -> None:
+        """Log the current progress."""
+        elapsed = max(time.time() - self._start, 1e-9)
+        logging.info('Inserted %d documents (%.0f docs/s), %d errors', self.inserted, self.inserted / elapsed,
+                     self.errors)
+
+
+def bulk_insert(credentials: dict, db_name: str, table_name: str, documents: Iterable[dict], batch_size: int=200,
+                workers: int=4, durability: str='hard', report_interval: float=5.,
+                pool: Optional[ConnectionPool]=None) -> dict:
+    """
+    Insert the (streamed) documents in batches, running several batches concurrently.
+
+    At most ``2 * workers`` batches are held in memory at once, so arbitrarily large sources may be inserted.
+
+    :param credentials: dict containing at least `host`, `port`, `user` and `password` keys
+    :param db_name: name of the database in which the documents will be inserted
+    :param table_name: name of the table in which the documents will be inserted
+    :param documents: iterable of documents, e.g. ``iter_documents(source)``
+    :param batch_size: number of documents inserted by a single query
+    :param workers: number of concurrently inserted batches (and connections)
+    :param durability: `hard` or `soft` (faster, acknowledged once the documents are in memory)
+    :param report_interval: log the progress every this number of seconds
+    :param pool: optional connection pool; a dedicated pool with ``workers`` connections is used if not specified
+    :return: dict with the total number of `inserted` documents and `errors`
+    """
+    logging.info('Inserting documents to %s.%s', db_name, table_name)
+
+    own_pool = pool is None
+    if own_pool:
+        pool = ConnectionPool(credentials, max_size=workers)
+    progress = _Progress(report_interval)
+    in_flight = threading.BoundedSemaphore(2 * workers)
+
+    def insert_batch(batch: List[dict]) -> None:
+        """Insert a single batch and account its results."""
+        try:
+            with pool.connection() as conn:
+                response = insert(credentials=credentials, db_name=db_name, table_name=table_name, document=batch,
+                                  conn=conn, durability=durability)
+            if response['errors'] > 0:
+                logging.error('Failed to insert %d document(s): %s', response['errors'], response.get('first_error'))
+            progress.update(response['inserted'], response['errors'])
+        except Exception as ex:  # pylint: disable=broad-except
+            logging.error('Failed to insert a batch of %d document(s): %s', len(batch), ex)
+            progress.update(0, len(batch))
+        finally:
+            in_flight.release()
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for batch in _batches(documents, batch_size):
+                in_flight.acquire()
+                executor.submit(insert_batch, batch)
+    finally:
+        if own_pool:
+            pool.close()
+
+    progress.report()
+    return {'inserted': progress.inserted, 'errors': progress.errors}
+
+
+def export_table(credentials: dict, db_name: str, table_name: str, output_file: str, resume: bool=False,
+                 batch_size: int=1000, conn: Optional[r.net.Connection]=None) -> int:
+    """
+    Export all documents from the specified table to a JSONL file (gzip-compressed if it ends with `.gz`).
+
+    The documents are streamed ordered by their primary key at constant memory. After every ``batch_size`` documents,
+    the written data are completed (as a separate gzip member) and a checkpoint with the last exported primary key is
+    saved to ``<output_file>.checkpoint``. With ``resume``, the export continues right after the last checkpoint.
+    The times and binaries are exported as RethinkDB pseudo types, so the file may be imported back with
+    ``bulk_insert``.
+
+    :param credentials: dict containing at least `host`, `port`, `user` and `password` keys
+    :param db_name: name of the database from which the documents will be exported
+    :param table_name: name of the table from which the documents will be exported
+    :param output_file: path to the output file
+    :param resume: continue the interrupted export from the last checkpoint
+    :param batch_size: number of documents fetched in a single round trip and written between two checkpoints
+    :param conn: optional open (e.g. pooled) connection; a new connection is opened if not specified
+    :return: number of exported documents (excluding the ones exported before resuming)
+    """
+    checkpoint_file = output_file + '.checkpoint'
+    start_after, offset = None, 0
+    if resume and path.exists(checkpoint_file):
+        with open(checkpoint_file, 'r') as file:
+            checkpoint = json.load(file)
+        start_after, offset = checkpoint['last_id'], checkpoint['offset']
+        logging.info('Resuming the export after `%s`', start_after)
+    compress = gzip.compress if output_file.endswith('.gz') else (lambda data: data)
+
+    exported = 0
+    with open(output_file, 'r+b' if offset else 'wb') as file:
+        file.truncate(offset)
+        file.seek(offset)
+
+        def write_chunk(lines: List[str], last_id) -> None:
+            """Write the lines and save the checkpoint."""
+            file.write(compress(''.join(lines).encode('utf-8')))
+            file.flush()
+            os.fsync(file.fileno())
+            tmp_file = checkpoint_file + '.tmp'
+            with open(tmp_file, 'w') as checkpoint_f:
+                json.dump({'last_id': last_id, 'offset': file.tell()}, checkpoint_f)
+            os.replace(tmp_file, checkpoint_file)
+
+        lines = []
+        last_id = start_after
+        for document in iter_table(credentials=credentials, db_name=db_name, table_name=table_name,
+                                   start_after=start_after, batch_size=batch_size, conn=conn, time_format='raw',
+                                   binary_format='raw'):
+            lines.append(json.dumps(document) + '\n')
+            last_id = document['id']
+            if len(lines) >= batch_size:
+                write_chunk(lines, last_id)
+                exported += len(lines)
+                lines = []
+                logging.info('Exported %d documents', exported)
+        if lines:
+            write_chunk(lines, last_id)
+            exported += len(lines)
+
+    logging.info('Exported %d documents to `%s`', exported, output_file)
+    return exported
@@ -1,8 +1,14 @@
 from argparse import ArgumentParser
+from datetime import datetime, timedelta
 import logging
 import json
+import os
+from os import path
+import sys
 
-from .utils import create_db, create_table, create_user, grant_permission, insert, select_all, select_by_id
+from .connection_pool import get_pool
+from .utils import create_db, create_table, create_user, grant_permission, select_all, select_by_id, \
+    select_leaderboard, select_metrics, watch_runs
 
 
 def main():
@@ -41,7 +47,14 @@ def main():
     insert_parser.set_defaults(subcommand='insert')
     insert_parser.add_argument('db_name', help='name of the db to which the document will be inserted')
     insert_parser.add_argument('table_name', help='name of the table to which the document will be inserted')
-    insert_parser.add_argument('document', help='path to the JSON document to be inserted')
+    insert_parser.add_argument('document', help='path to the JSON document (or list of documents), JSONL file or '
+                                                'directory of those to be inserted; `-` reads JSONL from stdin')
+    insert_parser.add_argument('-b', '--batch-size', type=int, default=200,
+                               help='number of documents inserted by a single query')
+    insert_parser.add_argument('-w', '--workers', type=int, default=4,
+                               help='number of concurrently inserted batches')
+    insert_parser.add_argument('-s', '--soft', action='store_true',
+                               help='use soft durability (faster, acknowledged once the documents are in memory)')
 
     # create select-all subparser
     select_all_parser = subparsers.add_parser('select-all')
@@ -54,11 +67,128 @@ def main():
     select_by_id_parser.set_defaults(subcommand='select-by-id')
     select_by_id_parser.add_argument('db_name', help='name of the db from which documents will be selected')
     select_by_id_parser.add_argument('table_name', help='name of the table from which documents will be selected')
-    select_by_id_parser.add_argument('id', help='document ID')
+    select_by_id_parser.add_argument('ids', nargs='+', metavar='id',
+                                     help='document ID; multiple documents are selected concurrently')
+    select_by_id_parser.add_argument('--concurrency', type=int, default=64,
+                                     help='maximal number of concurrently selected documents')
+    select_by_id_parser.add_argument('--config', action='store_true', dest='rehydrate_config',
+                                     help='fill the deduplicated config of a run document')
+
+    # create metrics subparser
+    metrics_parser = subparsers.add_parser('metrics')
+    metrics_parser.set_defaults(subcommand='metrics')
+    metrics_parser.add_argument('db_name', help='name of the db from which the metrics will be selected')
+    metrics_parser.add_argument('table_name', help='name of the table from which the metrics will be selected')
+    metrics_parser.add_argument('metrics', nargs='+', help='metric paths, e.g. `test/accuracy/mean`')
+    metrics_parser.add_argument('-i', '--id', dest='run_ids', action='append', help='run document ID (repeatable)')
+    metrics_parser.add_argument('-u', '--user', help='select only the runs of this user')
+    metrics_parser.add_argument('--since', help='select only the runs created at or after this ISO 8601 time')
+    metrics_parser.add_argument('--until', help='select only the runs created before this ISO 8601 time')
+    metrics_parser.add_argument('-o', '--output', help='save the run IDs and the metric matrices to this .npz file')
+
+    # create leaderboard subparser
+    leaderboard_parser = subparsers.add_parser('leaderboard')
+    leaderboard_parser.set_defaults(subcommand='leaderboard')
+    leaderboard_parser.add_argument('db_name', help='name of the db with the runs to be ranked')
+    leaderboard_parser.add_argument('table_name', help='name of the table with the runs to be ranked')
+    leaderboard_parser.add_argument('metric', help='ranking metric path, e.g. `test/accuracy/mean`')
+    leaderboard_parser.add_argument('--mode', choices=['min', 'max'], default='max',
+                                    help='whether the higher (max) or the lower (min) values are better')
+    leaderboard_parser.add_argument('-k', '--top', type=int, default=10, help='number of the best runs to be listed')
+    leaderboard_parser.add_argument('--columns', nargs='+', default=[], metavar='METRIC',
+                                    help='other metric paths to be listed from the best epoch')
+    leaderboard_parser.add_argument('-u', '--user', help='rank only the runs of this user')
+    leaderboard_parser.add_argument('--since', help='rank only the runs created at or after this ISO 8601 time')
+    leaderboard_parser.add_argument('--until', help='rank only the runs created before this ISO 8601 time')
+
+    # create watch subparser
+    watch_parser = subparsers.add_parser('watch')
+    watch_parser.set_defaults(subcommand='watch')
+    watch_parser.add_argument('db_name', help='name of the db with the runs to be watched')
+    watch_parser.add_argument('table_name', help='name of the table with the runs to be watched')
+    watch_parser.add_argument('-i', '--id', dest='run_ids', action='append', help='run document ID (repeatable)')
+    watch_parser.add_argument('-u', '--user', help='watch only the runs of this user')
+    watch_parser.add_argument('--epochs-table', help='table with the epoch documents of the runs stored with '
+                                                     '`storage: epochs`')
+    watch_parser.add_argument('--no-initial', action='store_false', dest='include_initial',
+                              help='report only the epochs appended from now on')
+
+    # create export subparser
+    export_parser = subparsers.add_parser('export')
+    export_parser.set_defaults(subcommand='export')
+    export_parser.add_argument('db_name', help='name of the db from which documents will be exported')
+    export_parser.add_argument('table_name', help='name of the table from which documents will be exported')
+    export_parser.add_argument('output_file', help='path to the output JSONL file '
+                                                   '(gzip-compressed if it ends with `.gz`)')
+    export_parser.add_argument('-b', '--batch-size', type=int, default=1000,
+                               help='number of documents fetched in a single round trip')
+    export_parser.add_argument('-r', '--resume', action='store_true', help='resume the interrupted export')
+
+    # create replay subparser
+    replay_parser = subparsers.add_parser('replay')
+    replay_parser.set_defaults(subcommand='replay')
+    replay_parser.add_argument('output_dir',
+                               help='training output directory with the spool journals (of all the worker ranks)')
+    replay_parser.add_argument('-b', '--batch-size', type=int, default=100,
+                               help='maximal number of training items stored in a single write')
+
+    # create get-artifact subparser
+    get_artifact_parser = subparsers.add_parser('get-artifact')
+    get_artifact_parser.set_defaults(subcommand='get-artifact')
+    get_artifact_parser.add_argument('db_name', help='name of the db with the artifacts')
+    get_artifact_parser.add_argument('run_id', help='ID of the run the artifact belongs to')
+    get_artifact_parser.add_argument('name', help='name of the artifact')
+    get_artifact_parser.add_argument('-o', '--output', help='path to the output file (`-` for stdout); '
+                                                            'defaults to the artifact file name')
+    get_artifact_parser.add_argument('-t', '--table', default='artifacts', help='name of the table with the artifacts')
+
+    # create apply subparser
+    apply_parser = subparsers.add_parser('apply')
+    apply_parser.set_defaults(subcommand='apply')
+    apply_parser.add_argument('manifest', help='path to the YAML manifest with the dbs, tables (shards, replicas and '
+                                               'indexes), users and grants')
+
+    # create sync subparser
+    sync_parser = subparsers.add_parser('sync')
+    sync_parser.set_defaults(subcommand='sync')
+    sync_parser.add_argument('local_dir', help='directory with the local mirror')
+    sync_parser.add_argument('db_name', help='name of the db with the runs to be mirrored')
+    sync_parser.add_argument('table_name', help='name of the table with the runs to be mirrored')
+    sync_parser.add_argument('-b', '--batch-size', type=int, default=100,
+                             help='number of runs fetched in a single round trip')
+    sync_parser.add_argument('--overlap', type=float, default=60.,
+                             help='number of seconds the high-water mark is moved back by (to include the writes '
+                                  'in flight)')
+
+    # create compact subparser
+    compact_parser = subparsers.add_parser('compact')
+    compact_parser.set_defaults(subcommand='compact')
+    compact_parser.add_argument('db_name', help='name of the db with the runs to be compacted')
+    compact_parser.add_argument('table_name', help='name of the table with the runs to be compacted')
+    compact_parser.add_argument('--older-than', type=float, required=True, metavar='DAYS',
+                                help='compact only the runs created (and, when archiving, last updated) more than this '
+                                     'number of days ago')
+    compact_parser.add_argument('-u', '--user', help='compact only the runs of this user')
+    compact_parser.add_argument('--keep-last', type=int, help='keep this number of the last epochs and downsample '
+                                                              'the others')
+    compact_parser.add_argument('--keep-best', type=int, default=0,
+                                help='keep this number of the best epochs (according to --metric) when downsampling')
+    compact_parser.add_argument('--metric', help='metric path selecting the best epochs, e.g. `test/accuracy/mean`')
+    compact_parser.add_argument('--mode', choices=['min', 'max'], default='max', help='optimization direction '
+                                                                                      'of the metric')
+    compact_parser.add_argument('--every', type=int, default=10,
+                                help='keep also every n-th epoch when downsampling (0 to keep none)')
+    compact_parser.add_argument('--drop-variables', nargs='+', metavar='VARIABLE',
+                                help='variable paths to be removed from all the epochs, e.g. `train/histogram`')
+    compact_parser.add_argument('--archive', metavar='DIR', help='move the runs to compressed files in this directory')
+    compact_parser.add_argument('-b', '--batch-size', type=int, default=100,
+                                help='number of runs processed by a single query')
 
     # add common arguments
     for parser in [main_parser, create_db_parser, create_table_parser, create_user_parser, grant_permission_parser,
-                   insert_parser, select_all_parser, select_by_id_parser]:
+                   insert_parser, select_all_parser, select_by_id_parser, metrics_parser, leaderboard_parser,
+                   watch_parser, export_parser, replay_parser, get_artifact_parser, apply_parser, sync_parser,
+                   compact_parser]:
         parser.add_argument('-c', '--credentials', help='path to the credentials file')
         parser.add_argument('-v', '--verbose', action='store_true', help='increase verbosity do level DEBUG')
 
@@ -71,28 +201,133 @@ def main():
     with open(args.credentials, 'r') as file:
         credentials = json.load(file)
 
-    if args.subcommand == 'create-db':
-        create_db(credentials=credentials, db_name=args.db_name)
-    elif args.subcommand == 'create-table':
-        create_table(credentials=credentials, db_name=args.db_name, table_name=args.table_name)
-    elif args.subcommand == 'create-user':
-        create_user(credentials=credentials, user=args.user, password=args.password)
-    elif args.subcommand == 'grant-permission':
-        permissions = json.loads(args.permissions)
-        grant_permission(credentials=credentials, user=args.user, db_name=args.db_name, table_name=args.table_name, permissions=permissions)
-    elif args.subcommand == 'insert':
-        with open(args.document, 'r') as file:
-            document = json.load(file)
-        insert(credentials=credentials, db_name=args.db_name, table_name=args.table_name, document=document)
-    elif args.subcommand == 'select-all':
-        cursor = select_all(credentials=credentials, db_name=args.db_name, table_name=args.table_name)
-        for document in cursor:
-            print(document)
-    elif args.subcommand == 'select-by-id':
-        document = select_by_id(credentials=credentials, db_name=args.db_name, table_name=args.table_name, doc_id=args.id)
-        print(document)
-    else:
-        pass
+    # the heavier modules (numpy, bulk operations, spool, artifacts) are imported by the subcommands needing them
+    with get_pool(credentials).connection() as conn:
+        if args.subcommand == 'create-db':
+            create_db(credentials=credentials, db_name=args.db_name, conn=conn)
+        elif args.subcommand == 'create-table':
+            create_table(credentials=credentials, db_name=args.db_name, table_name=args.table_name, conn=conn)
+        elif args.subcommand == 'create-user':
+            create_user(credentials=credentials, user=args.user, password=args.password, conn=conn)
+        elif args.subcommand == 'grant-permission':
+            permissions = json.loads(args.permissions)
+            grant_permission(credentials=credentials, user=args.user, db_name=args.db_name,
+                             table_name=args.table_name, permissions=permissions, conn=conn)
+        elif args.subcommand == 'insert':
+            from .bulk import bulk_insert, iter_documents
+            result = bulk_insert(credentials=credentials, db_name=args.db_name, table_name=args.table_name,
+                                 documents=iter_documents(args.document), batch_size=args.batch_size,
+                                 workers=args.workers, durability='soft' if args.soft else 'hard')
+            if result['errors'] > 0:
+                sys.exit(1)
+        elif args.subcommand == 'select-all':
+            cursor = select_all(credentials=credentials, db_name=args.db_name, table_name=args.table_name, conn=conn)
+            for document in cursor:
+                print(document)
+        elif args.subcommand == 'select-by-id':
+            if len(args.ids) == 1:
+                document = select_by_id(credentials=credentials, db_name=args.db_name, table_name=args.table_name,
+                                        doc_id=args.ids[0], conn=conn, rehydrate_config=args.rehydrate_config)
+                print(document)
+            else:
+                import asyncio
+                from .async_utils import select_by_ids
+                loop = asyncio.new_event_loop()
+                try:
+                    documents = loop.run_until_complete(
+                        select_by_ids(credentials=credentials, db_name=args.db_name, table_name=args.table_name,
+                                      doc_ids=args.ids, concurrency=args.concurrency,
+                                      rehydrate_config=args.rehydrate_config))
+                finally:
+                    loop.close()
+                for document in documents:
+                    print(document)
+        elif args.subcommand == 'metrics':
+            run_ids, matrices = select_metrics(credentials=credentials, db_name=args.db_name,
+                                               table_name=args.table_name, metrics=args.metrics, run_ids=args.run_ids,
+                                               user=args.user, since=args.since, until=args.until, conn=conn)
+            if args.output is not None:
+                import numpy as np
+                np.savez(args.output, run_ids=np.array(run_ids), **matrices)
+            else:
+                for metric, matrix in matrices.items():
+                    print(metric)
+                    for run_id, row in zip(run_ids, matrix):
+                        print(run_id, ' '.join('{:.6g}'.format(value) for value in row))
+        elif args.subcommand == 'leaderboard':
+            rows = select_leaderboard(credentials=credentials, db_name=args.db_name, table_name=args.table_name,
+                                      metric=args.metric, mode=args.mode, top=args.top, columns=args.columns,
+                                      user=args.user, since=args.since, until=args.until, conn=conn)
+            print('rank', 'id', 'user', 'epoch', args.metric, *args.columns)
+            for rank, row in enumerate(rows, 1):
+                print(rank, row['id'], row['user'], row['epoch_id'], '{:.6g}'.format(row['value']),
+                      *[row['columns'][column] for column in args.columns])
+        elif args.subcommand == 'watch':
+            deltas = watch_runs(credentials=credentials, db_name=args.db_name, table_name=args.table_name,
+                                run_ids=args.run_ids, user=args.user, epochs_table=args.epochs_table,
+                                include_initial=args.include_initial, conn=conn)
+            try:
+                for delta in deltas:
+                    print(json.dumps(delta, default=str), flush=True)
+            except KeyboardInterrupt:
+                pass
+        elif args.subcommand == 'export':
+            from .bulk import export_table
+            export_table(credentials=credentials, db_name=args.db_name, table_name=args.table_name,
+                         output_file=args.output_file, resume=args.resume, batch_size=args.batch_size, conn=conn)
+        elif args.subcommand == 'replay':
+            from .spool import Spool
+            for spool in Spool.open_all(args.output_dir):
+                logging.info('Replaying %d spooled record(s) of `%s`', spool.pending_count, spool.journal_path)
+                stored = spool.drain(credentials=credentials, conn=conn, batch_size=args.batch_size)
+                logging.info('Stored %d record(s), %d pending', stored, spool.pending_count)
+        elif args.subcommand == 'get-artifact':
+            from .artifacts import download_artifact
+            output = args.output if args.output is not None else path.basename(args.name)
+            if output == '-':
+                download_artifact(credentials=credentials, db_name=args.db_name, run_id=args.run_id, name=args.name,
+                                  output=sys.stdout.buffer, table_name=args.table, conn=conn)
+            else:
+                try:
+                    with open(output + '.tmp', 'wb') as file:
+                        written = download_artifact(credentials=credentials, db_name=args.db_name, run_id=args.run_id,
+                                                    name=args.name, output=file, table_name=args.table, conn=conn)
+                except BaseException:
+                    if path.exists(output + '.tmp'):
+                        os.remove(output + '.tmp')
+                    raise
+                os.replace(output + '.tmp', output)
+                logging.info('Written %d bytes to `%s`', written, output)
+        elif args.subcommand == 'apply':
+            from .provision import apply_manifest, load_manifest
+            summary = apply_manifest(credentials=credentials, manifest=load_manifest(args.manifest), conn=conn)
+            for kind, names in summary.items():
+                logging.info('%s: %s', kind.capitalize(), ', '.join(names) if names else '-')
+        elif args.subcommand == 'sync':
+            from .mirror import LocalMirror
+            mirror = LocalMirror(args.local_dir)
+            try:
+                mirrored = mirror.sync(credentials=credentials, db_name=args.db_name, table_name=args.table_name,
+                                       batch_size=args.batch_size, overlap=args.overlap, conn=conn)
+            finally:
+                mirror.close()
+            logging.info('Mirrored %d new or changed run(s) to `%s`', mirrored, args.local_dir)
+        elif args.subcommand == 'compact':
+            from .compact import archive_runs, downsample_runs, drop_variables
+            import pytz
+            until = datetime.now(pytz.utc) - timedelta(days=args.older_than)
+            selection = dict(credentials=credentials, db_name=args.db_name, table_name=args.table_name,
+                             user=args.user, until=until, batch_size=args.batch_size, conn=conn)
+            if args.archive is not None:
+                logging.info('Archived %d run(s)', archive_runs(archive_dir=args.archive, **selection))
+            else:
+                if args.drop_variables is not None:
+                    drop_variables(variables=args.drop_variables, **selection)
+                if args.keep_last is not None:
+                    downsample_runs(keep_last=args.keep_last, keep_best=args.keep_best, metric=args.metric,
+                                    mode=args.mode, every=args.every, **selection)
+        else:
+            pass
 
 
 if __name__ == '__main__':
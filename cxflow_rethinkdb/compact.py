@@ -0,0 +1,220 @@
+from datetime import datetime
+import gzip
+import json
+import logging
+import os
+from os import path
+from typing import Iterator, List, Optional, Union
+
+import rethinkdb as r
+
+from .utils import _merge_ranks, _metric_value, _run_filter, _time, _training_items, connect
+
+MODES = ['min', 'max']
+"""Possible optimization directions of the metric selecting the best epochs."""
+
+
+def _iter_run_batches(db_name: str, table_name: str, conn: r.net.Connection, batch_size: int,
+                      user: Optional[str]=None, until: Optional[Union[datetime, str]]=None) -> Iterator[List[dict]]:
+    """Stream the (`id`, `epochs_table`, `batches_table`, `shared`) projections of the selected runs in batches."""
+    query = _run_filter(r.db(db_name).table(table_name), user=user, until=until)\
+        .pluck('id', 'epochs_table', 'batches_table', 'shared')
+    batch = []
+    for run in query.run(conn, max_batch_rows=batch_size):
+        batch.append(run)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _run_epochs(db_name: str, run: dict):
+    """ReQL selection of the epoch documents of the run stored with ``storage: epochs``."""
+    return r.db(db_name).table(run['epochs_table']).between([run['id'], r.minval], [run['id'], r.maxval], index='id')
+
+
+def _run_items(db_name: str, run: dict):
+    """ReQL array of the training items in the epochs table of the run, a single merged item per epoch if shared."""
+    epochs = _run_epochs(db_name, run).coerce_to('array')
+    return _merge_ranks(epochs) if run.get('shared', False) else epochs
+
+
+def _check(response: dict, action: str) -> None:
+    """Raise if the write query reports any error."""
+    if response['errors'] > 0:
+        raise ValueError('Failed to {}: {}'.format(action, response.get('first_error')))
+
+
+def _selector(variables: List[str]) -> dict:
+    """Convert the `/`-separated variable paths to a nested ``without`` selector."""
+    selector = {}
+    for variable in variables:
+        node = selector
+        keys = variable.split('/')
+        for key in keys[:-1]:
+            node = node.setdefault(key, {})
+        node[keys[-1]] = True
+    return selector
+
+
+def _kept_epoch_ids(items, keep_last: int, keep_best: int, metric: Optional[str], mode: str):
+    """ReQL expression of the ids of the last and the best epochs among the training items."""
+    kept = items.order_by(r.desc('epoch_id')).limit(keep_last)['epoch_id']
+    if keep_best > 0:
+        order = r.desc if mode == 'max' else r.asc
+        best = items.filter(lambda item: _metric_value(item, metric).ne(None))\
+            .order_by(order(lambda item: _metric_value(item, metric))).limit(keep_best)['epoch_id']
+        kept = kept.set_union(best)
+    return kept
+
+
+def downsample_runs(credentials: dict, db_name: str, table_name: str, keep_last: int=0, keep_best: int=0,
+                    metric: Optional[str]=None, mode: str='max', every: int=10, user: Optional[str]=None,
+                    until: Optional[Union[datetime, str]]=None, batch_size: int=100,
+                    conn: Optional[r.net.Connection]=None) -> int:
+    """
+    Keep the last and the best epochs of the selected runs at full resolution and every n-th epoch of the rest.
+
+    The epochs are removed by server-side update functions (in batches of runs), hence the compaction may run online.
+
+    :param credentials: dict containing at least `host`, `port`, `user` and `password` keys
+    :param db_name: name of the database with the run documents
+    :param table_name: name of the table with the run documents
+    :param keep_last: number of the last epochs to be kept
+    :param keep_best: number of the best epochs (according to the ``metric``) to be kept
+    :param metric: `/`-separated path of the metric in the `epoch_data`, e.g. ``test/accuracy/mean``
+    :param mode: whether the best epochs maximize or minimize the ``metric``, one of ``MODES``
+    :param every: keep the epochs with `epoch_id` divisible by this number as well (0 to drop all the other epochs)
+    :param user: compact only the runs of this user
+    :param until: compact only the runs created before this time
+    :param batch_size: number of runs updated by a single query
+    :param conn: optional open (e.g. pooled) connection; a new connection is opened if not specified
+    :return: number of processed runs
+    """
+    assert mode in MODES
+    assert keep_best == 0 or metric is not None
+
+    def dropped(item, kept):
+        """ReQL predicate of the training items to be removed."""
+        condition = kept.contains(item['epoch_id']).not_()
+        if every > 0:
+            condition = condition.and_(item['epoch_id'].mod(every).ne(0))
+        return condition
+
+    processed = 0
+    with connect(credentials, conn, db=db_name) as conn:
+        for runs in _iter_run_batches(db_name, table_name, conn, batch_size, user=user, until=until):
+            response = r.db(db_name).table(table_name).get_all(*[run['id'] for run in runs]).update(
+                lambda run: {'training': _kept_epoch_ids(run['training'], keep_last, keep_best, metric, mode)
+                             .do(lambda kept: run['training'].filter(lambda item: dropped(item, kept).not_())),
+                             'modified': r.now()})\
+                .run(conn)
+            _check(response, 'downsample the training of {} run(s)'.format(len(runs)))
+            for run in runs:
+                if 'epochs_table' in run:
+                    epochs = _run_epochs(db_name, run)
+                    response = _kept_epoch_ids(_run_items(db_name, run), keep_last, keep_best, metric, mode)\
+                        .do(lambda kept: epochs.filter(lambda item: dropped(item, kept)).delete())\
+                        .run(conn)
+                    _check(response, 'downsample the epochs of run `{}`'.format(run['id']))
+            processed += len(runs)
+            logging.info('Downsampled %d run(s)', processed)
+    return processed
+
+
+def drop_variables(credentials: dict, db_name: str, table_name: str, variables: List[str],
+                   user: Optional[str]=None, until: Optional[Union[datetime, str]]=None, batch_size: int=100,
+                   conn: Optional[r.net.Connection]=None) -> int:
+    """
+    Remove the given variables from the `epoch_data` of all the epochs of the selected runs.
+
+    The variables are removed by server-side replace functions (in batches of runs), hence the compaction may run
+    online.
+
+    :param credentials: dict containing at least `host`, `port`, `user` and `password` keys
+    :param db_name: name of the database with the run documents
+    :param table_name: name of the table with the run documents
+    :param variables: `/`-separated paths of the variables in the `epoch_data`, e.g. ``train/histogram``
+    :param user: compact only the runs of this user
+    :param until: compact only the runs created before this time
+    :param batch_size: number of runs updated by a single query
+    :param conn: optional open (e.g. pooled) connection; a new connection is opened if not specified
+    :return: number of processed runs
+    """
+    selector = {'epoch_data': _selector(variables)}
+    processed = 0
+    with connect(credentials, conn, db=db_name) as conn:
+        for runs in _iter_run_batches(db_name, table_name, conn, batch_size, user=user, until=until):
+            response = r.db(db_name).table(table_name).get_all(*[run['id'] for run in runs]).update(
+                lambda run: {'training': run['training'].map(lambda item: item.without(selector)),
+                             'modified': r.now()}).run(conn)
+            _check(response, 'drop the variables of {} run(s)'.format(len(runs)))
+            for run in runs:
+                if 'epochs_table' in run:
+                    response = _run_epochs(db_name, run).replace(lambda item: item.without(selector)).run(conn)
+                    _check(response, 'drop the variables of run `{}`'.format(run['id']))
+            processed += len(runs)
+            logging.info('Dropped the variables of %d run(s)', processed)
+    return processed
+
+
+def archive_runs(credentials: dict, db_name: str, table_name: str, archive_dir: str, user: Optional[str]=None,
+                 until: Optional[Union[datetime, str]]=None, batch_size: int=100,
+                 conn: Optional[r.net.Connection]=None) -> int:
+    """
+    Move the selected runs to gzip-compressed JSON files ``<archive_dir>/<run_id>.json.gz`` and delete them.
+
+    Every archive contains the run document with the `training` list rebuilt (see ``select_run``) and, if the run
+    logged the batch chunks, their list under the `batches` key. The times and binaries are stored as RethinkDB pseudo
+    types. A run is deleted only after its archive is completely written. Artifacts are not archived. If ``until`` is
+    specified, the runs with a training item (i.e. an epoch) newer than it are considered running and are skipped.
+
+    :param credentials: dict containing at least `host`, `port`, `user` and `password` keys
+    :param db_name: name of the database with the run documents
+    :param table_name: name of the table with the run documents
+    :param archive_dir: directory in which the archives will be stored
+    :param user: archive only the runs of this user
+    :param until: archive only the runs created and last updated before this time
+    :param batch_size: number of runs fetched in a single round trip
+    :param conn: optional open (e.g. pooled) connection; a new connection is opened if not specified
+    :raise ValueError: if a run could not be deleted
+    :return: number of archived runs
+    """
+    os.makedirs(archive_dir, exist_ok=True)
+    archived = 0
+    with connect(credentials, conn, db=db_name) as conn:
+        for runs in _iter_run_batches(db_name, table_name, conn, batch_size, user=user, until=until):
+            for run in runs:
+                query = r.db(db_name).table(table_name).get(run['id']).do(
+                    lambda doc: doc.merge({'training': _training_items(db_name, doc)}))
+                if until is not None:
+                    query = query.do(lambda doc: r.branch(
+                        doc['training']['timestamp'].append(doc['timestamp']).max().lt(_time(until)), doc, None))
+                document = query.run(conn, time_format='raw', binary_format='raw')
+                if document is None:
+                    logging.info('Skipping run `%s` updated after %s', run['id'], until)
+                    continue
+                if 'batches_table' in run:
+                    document['batches'] = list(r.db(db_name).table(run['batches_table'])
+                                               .between([run['id'], r.minval], [run['id'], r.maxval], index='id')
+                                               .order_by(index='id')
+                                               .run(conn, time_format='raw', binary_format='raw'))
+
+                archive_file = path.join(archive_dir, '{}.json.gz'.format(run['id']))
+                with gzip.open(archive_file + '.tmp', 'wt', encoding='utf-8') as file:
+                    json.dump(document, file)
+                os.replace(archive_file + '.tmp', archive_file)
+
+                if 'epochs_table' in run:
+                    _check(_run_epochs(db_name, run).delete().run(conn),
+                           'delete the epochs of run `{}`'.format(run['id']))
+                if 'batches_table' in run:
+                    response = r.db(db_name).table(run['batches_table'])\
+                        .between([run['id'], r.minval], [run['id'], r.maxval], index='id').delete().run(conn)
+                    _check(response, 'delete the batches of run `{}`'.format(run['id']))
+                _check(r.db(db_name).table(table_name).get(run['id']).delete().run(conn),
+                       'delete run `{}`'.format(run['id']))
+                archived += 1
+            logging.info('Archived %d run(s) to `%s`', archived, archive_dir)
+    return archived
@@ -0,0 +1,199 @@
+import atexit
+from contextlib import contextmanager
+import logging
+import threading
+import time
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+import rethinkdb as r
+
+
+class ConnectionPool:
+    """
+    Pool of persistent RethinkDB connections sharing the same credentials.
+
+    Every connection is used exclusively by the one who acquired it until it is released back to the pool.
+    Idle connections are health-checked before they are handed out again; the broken ones are reconnected with an
+    exponential backoff.
+
+    -------------------------------------------------------
+    Example usage
+    -------------------------------------------------------
+    pool = get_pool(credentials)
+    with pool.connection() as conn:
+        insert(credentials, 'my_database', 'my_table', document, conn=conn)
+        select_all(credentials, 'my_database', 'my_table', conn=conn)
+    -------------------------------------------------------
+    """
+
+    def __init__(self, credentials: dict, max_size: int=4, max_retries: int=5, backoff: float=0.1,
+                 max_backoff: float=10., health_check_interval: float=30.,
+                 connection_factory: Optional[Callable[[], r.net.Connection]]=None):
+        """
+        Create an empty pool; the connections are opened lazily.
+
+        :param credentials: dict containing at least `host`, `port`, `user` and `password` keys
+        :param max_size: maximal number of open connections; ``acquire`` blocks when all of them are in use
+        :param max_retries: number of (re)connection attempts before the error is propagated
+        :param backoff: delay (in seconds) after the first failed (re)connection attempt; doubled after each failure
+        :param max_backoff: maximal delay (in seconds) between two (re)connection attempts
+        :param health_check_interval: idle connections unused for longer than this number of seconds are pinged
+                                      before they are handed out
+        :param connection_factory: function opening a new connection; defaults to ``r.connect(**credentials)``;
+                                   allows to plug in a different backend, e.g. for benchmarks
+        """
+        assert max_size > 0
+
+        self._credentials = credentials
+        self._max_size = max_size
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._health_check_interval = health_check_interval
+        self._connection_factory = connection_factory or (lambda: r.connect(**credentials))
+
+        self._idle = []  # list of (connection, time of release)
+        self._size = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    @property
+    def size(self) -> int:
+        """Number of currently open connections (both idle and in use)."""
+        return self._size
+
+    def _with_retries(self, fn, description: str, retry: bool=True):
+        """Call the given function and retry it with an exponential backoff when it raises ``ReqlDriverError``."""
+        delay = self._backoff
+        max_retries = self._max_retries if retry else 1
+        for attempt in range(1, max_retries + 1):
+            try:
+                return fn()
+            except r.ReqlDriverError as ex:
+                if attempt == max_retries:
+                    raise
+                logging.warning('Failed to %s (attempt %d/%d): %s; retrying in %.2fs',
+                                description, attempt, max_retries, ex, delay)
+                time.sleep(delay)
+                delay = min(2 * delay, self._max_backoff)
+
+    def _connect(self, retry: bool=True) -> r.net.Connection:
+        """Open a new connection."""
+        logging.debug('Opening a new RethinkDB connection to %s:%s', self._credentials.get('host'),
+                      self._credentials.get('port'))
+        return self._with_retries(self._connection_factory, 'connect to RethinkDB', retry)
+
+    def _ensure_healthy(self, conn: r.net.Connection, released_at: float, retry: bool=True) -> r.net.Connection:
+        """Check the idle connection and reconnect it if it is broken."""
+        if conn.is_open() and time.time() - released_at < self._health_check_interval:
+            return conn
+        try:
+            if conn.is_open():
+                r.expr(True).run(conn)
+                return conn
+        except r.ReqlDriverError:
+            pass
+        logging.info('RethinkDB connection is broken, reconnecting')
+        return self._with_retries(lambda: conn.reconnect(noreply_wait=False), 'reconnect to RethinkDB', retry)
+
+    def acquire(self, timeout: Optional[float]=None, retry: bool=True) -> r.net.Connection:
+        """
+        Take a connection from the pool (open a new one if no idle connection is available).
+
+        :param timeout: maximal time (in seconds) to wait for a connection when the pool is exhausted
+        :param retry: retry the failed (re)connection with a backoff; if ``False``, fail after the first attempt
+        :raise TimeoutError: if no connection became available within ``timeout``
+        :raise RuntimeError: if the pool is closed
+        :return: connection to be released with ``release``
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._closed or self._idle or self._size < self._max_size,
+                                            timeout=timeout):
+                raise TimeoutError('No RethinkDB connection available within {}s'.format(timeout))
+            if self._closed:
+                raise RuntimeError('Can not acquire a connection from a closed pool.')
+            if self._idle:
+                conn, released_at = self._idle.pop()
+            else:
+                conn, released_at = None, None
+                self._size += 1
+
+        try:
+            if conn is None:
+                return self._connect(retry)
+            return self._ensure_healthy(conn, released_at, retry)
+        except Exception:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+
+    def release(self, conn: r.net.Connection) -> None:
+        """
+        Return the connection to the pool.
+
+        :param conn: connection previously obtained by ``acquire``
+        """
+        with self._condition:
+            if self._closed or not conn.is_open():
+                self._size -= 1
+                conn.close(noreply_wait=False)
+            else:
+                self._idle.append((conn, time.time()))
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self, timeout: Optional[float]=None, retry: bool=True) -> Iterator[r.net.Connection]:
+        """Context manager acquiring a connection and releasing it afterwards."""
+        conn = self.acquire(timeout=timeout, retry=retry)
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self) -> None:
+        """Close all the idle connections; the connections in use are closed once released."""
+        with self._condition:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._condition.notify_all()
+        for conn, _ in idle:
+            try:
+                conn.close(noreply_wait=False)
+            except r.ReqlDriverError:
+                pass
+
+
+_POOLS = {}  # type: Dict[Tuple, ConnectionPool]
+_POOLS_LOCK = threading.Lock()
+
+
+def _pool_key(credentials: dict) -> Tuple:
+    """Make a hashable key identifying the given credentials."""
+    return tuple(sorted((key, repr(value)) for key, value in credentials.items()))
+
+
+def get_pool(credentials: dict, **kwargs) -> ConnectionPool:
+    """
+    Get the process-wide connection pool for the given credentials (create it if it does not exist yet).
+
+    :param credentials: dict containing at least `host`, `port`, `user` and `password` keys
+    :param kwargs: ``ConnectionPool`` arguments; effective only when the pool is created
+    :return: connection pool shared by all the callers with the same credentials
+    """
+    key = _pool_key(credentials)
+    with _POOLS_LOCK:
+        if key not in _POOLS:
+            _POOLS[key] = ConnectionPool(credentials, **kwargs)
+        return _POOLS[key]
+
+
+@atexit.register
+def close_pools() -> None:
+    """Close all the process-wide connection pools."""
+    with _POOLS_LOCK:
+        pools = list(_POOLS.values())
+        _POOLS.clear()
+    for pool in pools:
+        pool.close()
@@ -0,0 +1,95 @@
+from collections import deque
+from contextlib import contextmanager
+import threading
+import time
+from typing import Iterator
+
+import rethinkdb as r
+
+
+class HookStats:
+    """
+    Rolling statistics of the ``RethinkDBHook`` hot path.
+
+    -------------------------------------------------------
+    Recorded phases:
+    -------------------------------------------------------
+    serialize:     building the JSON-serializable epoch data
+    connect:       acquiring a (pooled) connection
+    query:         running the write query (including the round trip)
+    bytes_sent:    size of the serialized write queries
+    document_size: size of the run document in bytes of its JSON (measured on demand)
+    -------------------------------------------------------
+    """
+
+    PHASES = ['serialize', 'connect', 'query', 'bytes_sent', 'document_size']
+    """Recorded phases."""
+
+    def __init__(self, window: int=100):
+        """
+        Create empty statistics.
+
+        :param window: number of the most recent measurements the `mean` and `max` are computed from
+        """
+        self._lock = threading.Lock()
+        self._values = {phase: deque(maxlen=window) for phase in HookStats.PHASES}
+        self._totals = {phase: 0. for phase in HookStats.PHASES}
+        self._counts = {phase: 0 for phase in HookStats.PHASES}
+        self._json_encoder = self._create_json_encoder()
+
+    def record(self, phase: str, value: float) -> None:
+        """
+        Record a single measurement.
+
+        :param phase: one of ``PHASES``
+        :param value: measured time (in seconds) or size (in bytes)
+        """
+        with self._lock:
+            self._values[phase].append(value)
+            self._totals[phase] += value
+            self._counts[phase] += 1
+
+    @contextmanager
+    def timer(self, phase: str) -> Iterator[None]:
+        """Context manager recording the duration of its body."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(phase, time.perf_counter() - start)
+
+    def _create_json_encoder(self) -> type:
+        """Create the ReQL encoder class recording the size of the serialized queries to these statistics."""
+        stats = self
+
+        class CountingEncoder(r.ast.ReQLEncoder):
+            """ReQL encoder recording the size of the encoded queries."""
+
+            def encode(self, o) -> str:
+                encoded = super().encode(o)
+                stats.record('bytes_sent', len(encoded.encode('utf-8')))
+                return encoded
+
+        return CountingEncoder
+
+    def json_encoder(self) -> type:
+        """The ``json_encoder`` for ``run`` which records the size of the serialized queries (created once)."""
+        return self._json_encoder
+
+    def summary(self) -> dict:
+        """
+        Summarize the statistics.
+
+        :return: dict of phase -> dict with `last`, `mean` and `max` of the recent measurements, `total` and `count`
+        """
+        with self._lock:
+            result = {}
+            for phase, values in self._values.items():
+                if not values:
+                    continue
+                result[phase] = {'last': values[-1],
+                                 'mean': sum(values) / len(values),
+                                 'max': max(values),
+                                 'total': self._totals[phase],
+                                 'count': self._counts[phase]}
+            return result
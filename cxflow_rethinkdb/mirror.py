@@ -0,0 +1,261 @@
+from datetime import datetime
+import json
+import logging
+import os
+from os import path
+import re
+import sqlite3
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Tuple, Union
+
+import pytz
+import rethinkdb as r
+
+from .utils import _metric_matrices, _rehydrate_config, _training_items, connect
+
+if TYPE_CHECKING:
+    import numpy as np  # annotations only; imported lazily, see the package docstring
+
+
+def _epoch_seconds(value: Union[datetime, str]) -> float:
+    """Convert the timezone-aware datetime or ISO 8601 string (UTC if no timezone is specified) to epoch seconds."""
+    if isinstance(value, datetime):
+        return value.timestamp()
+    value = re.sub(r'([+-]\d\d):(\d\d)$', r'\1\2', value.replace('Z', '+0000'))
+    for time_format in ['%Y-%m-%dT%H:%M:%S.%f%z', '%Y-%m-%dT%H:%M:%S%z', '%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S',
+                        '%Y-%m-%d']:
+        try:
+            parsed = datetime.strptime(value, time_format)
+        except ValueError:
+            continue
+        return (parsed if parsed.tzinfo is not None else pytz.utc.localize(parsed)).timestamp()
+    raise ValueError('Time `{}` is not in the ISO 8601 format'.format(value))
+
+
+def _metric_value(epoch_data: dict, metric: str):
+    """Value of the metric (`/`-separated path) in the epoch data (or None)."""
+    for key in metric.split('/'):
+        if not isinstance(epoch_data, dict) or key not in epoch_data:
+            return None
+        epoch_data = epoch_data[key]
+    return epoch_data
+
+
+class LocalMirror:
+    """
+    Incrementally synchronized local SQLite mirror of the run documents serving the repeated reads from the disk.
+
+    Every ``sync`` ships only the runs created or updated (a training item appended) after the persisted high-water
+    mark, i.e. the server time of the previous synchronization, minus the ``overlap``. The changes are found by the
+    `modified` field set to the server time by every write of ``RethinkDBHook`` (and ``compact``), hence the late
+    (e.g. spooled) writes and the clock skew of the training machines do not matter. The runs table and the epochs
+    tables should have a secondary index on the `modified` field (see ``provision``); the tables without it are
+    scanned. The runs are mirrored with their `training` list rebuilt (see ``utils.select_run``) and their
+    deduplicated config filled. The runs deleted from the database (e.g. archived by ``compact``) are kept in the
+    mirror.
+
+    -------------------------------------------------------
+    Example usage
+    -------------------------------------------------------
+    mirror = LocalMirror('mirror_dir')
+    mirror.sync(credentials, 'my_database', 'my_table')
+    run_ids, matrices = mirror.select_metrics('my_database', 'my_table', ['test/accuracy/mean'], user='my_user')
+    -------------------------------------------------------
+    """
+
+    DB_FILE = 'mirror.sqlite3'
+    """Name of the SQLite file in the mirror directory."""
+
+    def __init__(self, local_dir: str):
+        """
+        Open (or create) the mirror in the given directory.
+
+        :param local_dir: directory with the mirror
+        """
+        os.makedirs(local_dir, exist_ok=True)
+        self._db = sqlite3.connect(path.join(local_dir, LocalMirror.DB_FILE))
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS runs (db TEXT, tbl TEXT, id TEXT, user TEXT, timestamp REAL, '
+                             'document TEXT, PRIMARY KEY (db, tbl, id))')
+            self._db.execute('CREATE INDEX IF NOT EXISTS runs_user_timestamp ON runs (db, tbl, user, timestamp)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS marks (db TEXT, tbl TEXT, high_water_mark REAL, '
+                             'PRIMARY KEY (db, tbl))')
+            self._db.execute('CREATE TABLE IF NOT EXISTS epochs_tables (db TEXT, tbl TEXT, epochs_table TEXT, '
+                             'PRIMARY KEY (db, tbl, epochs_table))')
+
+    def close(self) -> None:
+        """Close the mirror."""
+        self._db.close()
+
+    def high_water_mark(self, db_name: str, table_name: str) -> Optional[float]:
+        """
+        The server time (in epoch seconds) of the last synchronization of the specified table.
+
+        :param db_name: name of the database with the run documents
+        :param table_name: name of the table with the run documents
+        :return: the high-water mark or `None` if the table was never synchronized
+        """
+        row = self._db.execute('SELECT high_water_mark FROM marks WHERE db = ? AND tbl = ?',
+                               (db_name, table_name)).fetchone()
+        return None if row is None else row[0]
+
+    @staticmethod
+    def _modified_since(db_name: str, table_name: str, since: float, conn: r.net.Connection):
+        """ReQL selection of the documents modified at or after the given time (by the `modified` index if any)."""
+        table = r.db(db_name).table(table_name)
+        if 'modified' in table.index_list().run(conn):
+            return table.between(r.epoch_time(since), r.maxval, index='modified')
+        logging.warning('Table `%s.%s` has no `modified` index, scanning it', db_name, table_name)
+        return table.filter(lambda document: document['modified'].ge(r.epoch_time(since)), default=False)
+
+    def _changed_run_ids(self, db_name: str, table_name: str, since: Optional[float],
+                         conn: r.net.Connection) -> List[str]:
+        """IDs of the runs created or updated after the given time (all of them if not specified)."""
+        if since is None:
+            return list(r.db(db_name).table(table_name)['id'].run(conn))
+
+        changed = {}
+        for run in LocalMirror._modified_since(db_name, table_name, since, conn).pluck('id', 'epochs_table').run(conn):
+            changed[run['id']] = run.get('epochs_table')
+        epochs_tables = {row[0] for row in self._db.execute(
+            'SELECT epochs_table FROM epochs_tables WHERE db = ? AND tbl = ?', (db_name, table_name))}
+        epochs_tables.update(epochs_table for epochs_table in changed.values() if epochs_table is not None)
+        run_ids = set(changed)
+        for epochs_table in sorted(epochs_tables):
+            run_ids.update(LocalMirror._modified_since(db_name, epochs_table, since, conn)['run_id'].distinct()
+                           .run(conn))
+        return sorted(run_ids)
+
+    def _store(self, db_name: str, table_name: str, documents: List[dict]) -> None:
+        """Store the (raw format) run documents and remember their epochs tables."""
+        with self._db:
+            self._db.executemany('INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?)',
+                                 [(db_name, table_name, document['id'], document.get('user'),
+                                   document['timestamp']['epoch_time'] if 'timestamp' in document else None,
+                                   json.dumps(document)) for document in documents])
+            self._db.executemany('INSERT OR IGNORE INTO epochs_tables VALUES (?, ?, ?)',
+                                 {(db_name, table_name, document['epochs_table']) for document in documents
+                                  if 'epochs_table' in document})
+
+    def sync(self, credentials: dict, db_name: str, table_name: str, batch_size: int=100, overlap: float=60.,
+             conn: Optional[r.net.Connection]=None) -> int:
+        """
+        Ship the runs created or updated since the last synchronization to the mirror.
+
+        The filtering is evaluated by the server, so only the new and changed runs are transferred. The high-water mark
+        (the server time at the start) is stored after all the runs are mirrored; an interrupted synchronization is
+        thus simply repeated.
+
+        :param credentials: dict containing at least `host`, `port`, `user` and `password` keys
+        :param db_name: name of the database with the run documents
+        :param table_name: name of the table with the run documents
+        :param batch_size: number of runs fetched in a single round trip
+        :param overlap: number of seconds the high-water mark is moved back by to include the writes which were in
+                        flight during the last synchronization
+        :param conn: optional open (e.g. pooled) connection; a new connection is opened if not specified
+        :return: number of the mirrored runs
+        """
+        high_water_mark = self.high_water_mark(db_name, table_name)
+        since = None if high_water_mark is None else high_water_mark - overlap
+        logging.info('Synchronizing %s.%s (since %s)', db_name, table_name,
+                     'the beginning' if since is None else datetime.fromtimestamp(since, pytz.utc).isoformat())
+
+        with connect(credentials, conn, db=db_name) as conn:
+            started = r.now().to_epoch_time().run(conn)
+            run_ids = self._changed_run_ids(db_name, table_name, since, conn)
+            for start in range(0, len(run_ids), batch_size):
+                documents = list(r.db(db_name).table(table_name).get_all(*run_ids[start:start + batch_size])
+                                 .map(lambda run: _rehydrate_config(db_name, run)
+                                      .merge({'training': _training_items(db_name, run)}))
+                                 .run(conn, time_format='raw', binary_format='raw'))
+                self._store(db_name, table_name, documents)
+                logging.info('Mirrored %d/%d run(s)', start + len(documents), len(run_ids))
+
+        with self._db:
+            self._db.execute('INSERT OR REPLACE INTO marks VALUES (?, ?, ?)', (db_name, table_name, started))
+        return len(run_ids)
+
+    @staticmethod
+    def _decode(document: str, decode_arrays: bool) -> dict:
+        """Decode the mirrored document to the same types as returned by the driver."""
+        document = json.loads(document, cls=r.net.ReQLDecoder)
+        if decode_arrays:
+            from .array_codec import decode_arrays as _decode_arrays  # imported lazily, see the package docstring
+            document = _decode_arrays(document)
+        return document
+
+    def select_by_id(self, db_name: str, table_name: str, doc_id: str, decode_arrays: bool=False) -> dict:
+        """
+        Select the mirrored run document with the specified ID.
+
+        :param db_name: name of the database with the run documents
+        :param table_name: name of the table with the run documents
+        :param doc_id: document ID
+        :param decode_arrays: convert the binary-encoded arrays (see ``ArrayCodec``) to numpy arrays
+        :raise KeyError: if the document is not mirrored
+        :return: the run document with the `training` list filled
+        """
+        row = self._db.execute('SELECT document FROM runs WHERE db = ? AND tbl = ? AND id = ?',
+                               (db_name, table_name, doc_id)).fetchone()
+        if row is None:
+            raise KeyError('Document with ID `{}` was not found in the mirror of `{}.{}`'.format(doc_id, db_name,
+                                                                                              table_name))
+        return LocalMirror._decode(row[0], decode_arrays)
+
+    def _select(self, db_name: str, table_name: str, user: Optional[str]=None,
+                since: Optional[Union[datetime, str]]=None,
+                until: Optional[Union[datetime, str]]=None) -> Iterator[Tuple[str, str]]:
+        """Iterate the (id, document) rows of the mirrored runs filtered by the user and the creation timestamp."""
+        query, params = 'SELECT id, document FROM runs WHERE db = ? AND tbl = ?', [db_name, table_name]
+        if user is not None:
+            query, params = query + ' AND user = ?', params + [user]
+        if since is not None:
+            query, params = query + ' AND timestamp >= ?', params + [_epoch_seconds(since)]
+        if until is not None:
+            query, params = query + ' AND timestamp < ?', params + [_epoch_seconds(until)]
+        return self._db.execute(query + ' ORDER BY id', params)
+
+    def select_all(self, db_name: str, table_name: str, user: Optional[str]=None,
+                   since: Optional[Union[datetime, str]]=None,
+                   until: Optional[Union[datetime, str]]=None) -> Iterator[dict]:
+        """
+        Iterate the mirrored run documents ordered by their ID.
+
+        :param db_name: name of the database with the run documents
+        :param table_name: name of the table with the run documents
+        :param user: select only the runs of this user
+        :param since: select only the runs created at or after this time (timezone-aware datetime or ISO 8601 string)
+        :param until: select only the runs created before this time (timezone-aware datetime or ISO 8601 string)
+        :return: iterator of the run documents with the `training` list filled
+        """
+        for _, document in self._select(db_name, table_name, user=user, since=since, until=until):
+            yield LocalMirror._decode(document, False)
+
+    def select_metrics(self, db_name: str, table_name: str, metrics: List[str], run_ids: Optional[List[str]]=None,
+                       user: Optional[str]=None, since: Optional[Union[datetime, str]]=None,
+                       until: Optional[Union[datetime, str]]=None) -> Tuple[List[str], Dict[str, 'np.ndarray']]:
+        """
+        Select the given metrics of the mirrored runs as dense (runs x epochs) matrices.
+
+        Same as ``utils.select_metrics``, but served from the mirror.
+
+        :param db_name: name of the database with the run documents
+        :param table_name: name of the table with the run documents
+        :param metrics: list of metric paths, e.g. ``test/accuracy/mean``
+        :param run_ids: select only the runs with these IDs (in this order)
+        :param user: select only the runs of this user
+        :param since: select only the runs created at or after this time (timezone-aware datetime or ISO 8601 string)
+        :param until: select only the runs created before this time (timezone-aware datetime or ISO 8601 string)
+        :return: tuple of the list of run IDs (matrix rows) and dict of metric matrices
+        """
+        selected = None if run_ids is None else set(run_ids)
+        rows = []
+        for run_id, document in self._select(db_name, table_name, user=user, since=since, until=until):
+            if selected is None or run_id in selected:
+                training = json.loads(document)['training']
+                rows.append({'id': run_id, 'values': [[item['epoch_id']] +
+                                                      [_metric_value(item['epoch_data'], metric) for metric in metrics]
+                                                      for item in training]})
+        if run_ids is not None:
+            order = {run_id: i for i, run_id in enumerate(run_ids)}
+            rows.sort(key=lambda row: order[row['id']])
+        return [row['id'] for row in rows], _metric_matrices(rows, metrics)
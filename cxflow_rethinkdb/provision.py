@@ -0,0 +1,241 @@
+"""
+Declarative provisioning of the databases, tables, indexes, users and permissions.
+
+-------------------------------------------------------
+Example manifest
+-------------------------------------------------------
+databases:
+  my_database:
+    tables:
+      runs:
+        shards: 2
+        replicas: 2
+        indexes:
+          user: user
+          timestamp: timestamp
+          modified: modified
+          user_timestamp: [user, timestamp]
+      runs_epochs:
+        indexes:
+          modified: modified
+users:
+  my_user:
+    password: secret
+grants:
+  - user: my_user
+    db: my_database
+    table: runs
+    permissions: {read: true, write: true}
+-------------------------------------------------------
+"""
+import logging
+import re
+from typing import Dict, List, Optional, Tuple, Union
+
+import rethinkdb as r
+
+from .utils import connect
+
+TABLE_KEYS = ['shards', 'replicas', 'primary_key', 'indexes']
+"""Keys allowed in the table specification."""
+
+
+def load_manifest(manifest_file: str) -> dict:
+    """
+    Load and validate the YAML manifest.
+
+    :param manifest_file: path to the manifest
+    :raise ValueError: if the manifest is invalid
+    :return: the manifest
+    """
+    import yaml  # imported lazily, see the package docstring
+    with open(manifest_file, 'r') as file:
+        manifest = yaml.safe_load(file) or {}
+    validate_manifest(manifest)
+    return manifest
+
+
+def validate_manifest(manifest: dict) -> None:
+    """
+    Check the structure of the manifest before anything is applied.
+
+    :param manifest: manifest to be checked (see the module docstring)
+    :raise ValueError: if the manifest is invalid
+    """
+    unknown = set(manifest) - {'databases', 'users', 'grants'}
+    if unknown:
+        raise ValueError('Unknown manifest section(s) {}'.format(sorted(unknown)))
+    for db_name, db_spec in (manifest.get('databases') or {}).items():
+        for table_name, table_spec in ((db_spec or {}).get('tables') or {}).items():
+            unknown = set(table_spec or {}) - set(TABLE_KEYS)
+            if unknown:
+                raise ValueError('Unknown key(s) {} of table `{}.{}`'.format(sorted(unknown), db_name, table_name))
+            for index_name, fields in ((table_spec or {}).get('indexes') or {}).items():
+                if not isinstance(fields, (str, list)) or not fields:
+                    raise ValueError('Index `{}` of table `{}.{}` must be a field name or a non-empty list of them'
+                                     .format(index_name, db_name, table_name))
+    for user_name, user_spec in (manifest.get('users') or {}).items():
+        if 'password' not in (user_spec or {}):
+            raise ValueError('User `{}` has no password'.format(user_name))
+    for grant in manifest.get('grants') or []:
+        if not {'user', 'db', 'permissions'} <= set(grant):
+            raise ValueError('Grant {} must specify `user`, `db` and `permissions`'.format(grant))
+
+
+def _index_function(fields: Union[str, List[str]]):
+    """Index function of a single (possibly nested, `/`-separated) field or a compound index of multiple fields."""
+    def field(document, name: str):
+        """ReQL expression of the field value."""
+        for key in name.split('/'):
+            document = document[key]
+        return document
+
+    if isinstance(fields, str):
+        return lambda document: field(document, fields)
+    return lambda document: [field(document, name) for name in fields]
+
+
+def _index_definition(fields: Union[str, List[str]]) -> Tuple[bool, List[str]]:
+    """Whether the index is compound and the keys of its (nested) fields in the order of their appearance."""
+    names = [fields] if isinstance(fields, str) else fields
+    return not isinstance(fields, str), [key for name in names for key in name.split('/')]
+
+
+def _printed_definition(query: str) -> Optional[Tuple[bool, List[str]]]:
+    """
+    Parse the index definition (as ``_index_definition``) from the index creation query printed by the server,
+    e.g. ``indexCreate('user_timestamp', function(var1) { return [var1('user'), var1('timestamp')]; })``.
+
+    :return: the definition or `None` if the query is not understood
+    """
+    literals = list(re.finditer(r"'((?:[^'\\]|\\.)*)'|\"((?:[^\"\\]|\\.)*)\"", query))
+    if len(literals) < 2:
+        return None
+    body = query[literals[0].end():]
+    compound = re.search(r'\[|\barray\b|\bmake_?array\b', body, re.IGNORECASE) is not None
+    return compound, [literal.group(1) if literal.group(1) is not None else literal.group(2)
+                      for literal in literals[1:]]
+
+
+def _check_indexes(db_name: str, table_name: str, indexes: Dict[str, Union[str, List[str]]],
+                   conn: r.net.Connection) -> None:
+    """Check the definitions of the existing indexes (as printed by the server) match the manifest."""
+    if not indexes:
+        return
+    for status in r.db(db_name).table(table_name).index_status(*indexes).run(conn):
+        printed = _printed_definition(status.get('query', ''))
+        if printed is None:
+            logging.warning('Definition of index `%s` of table `%s.%s` could not be checked', status['index'],
+                            db_name, table_name)
+        elif printed != _index_definition(indexes[status['index']]):
+            raise ValueError('Index `{}` of table `{}.{}` exists with a different definition `{}`; drop it to be '
+                             'recreated on {}'.format(status['index'], db_name, table_name, status['query'],
+                                                      indexes[status['index']]))
+
+
+def _reconcile_table(db_name: str, table_name: str, spec: dict, existing_tables: List[str],
+                     conn: r.net.Connection, summary: Dict[str, List[str]]) -> None:
+    """
+    Create the table or reconfigure its shards and replicas; create the missing secondary indexes.
+
+    :raise ValueError: if an existing index has a different definition
+    """
+    table = r.db(db_name).table(table_name)
+    sharding = {key: spec[key] for key in ['shards', 'replicas'] if key in spec}
+    if table_name not in existing_tables:
+        logging.info('Creating table `%s.%s`', db_name, table_name)
+        options = dict(sharding)
+        if 'primary_key' in spec:
+            options['primary_key'] = spec['primary_key']
+        r.db(db_name).table_create(table_name, **options).run(conn)
+        summary['tables'].append('{}.{}'.format(db_name, table_name))
+    elif sharding:
+        config = table.config().run(conn)
+        current = {'shards': len(config['shards']), 'replicas': len(config['shards'][0]['replicas'])}
+        if any(current[key] != value for key, value in sharding.items()):
+            logging.info('Reconfiguring table `%s.%s` from %s to %s', db_name, table_name, current, sharding)
+            table.reconfigure(**dict(current, **sharding)).run(conn)
+            summary['reconfigured'].append('{}.{}'.format(db_name, table_name))
+
+    indexes = spec.get('indexes') or {}
+    if indexes:
+        existing_indexes = table.index_list().run(conn)
+        _check_indexes(db_name, table_name, {index_name: fields for index_name, fields in indexes.items()
+                                             if index_name in existing_indexes}, conn)
+        for index_name, fields in sorted(indexes.items()):
+            if index_name not in existing_indexes:
+                logging.info('Creating index `%s` of table `%s.%s` on %s', index_name, db_name, table_name, fields)
+                table.index_create(index_name, _index_function(fields)).run(conn)
+                summary['indexes'].append('{}.{}.{}'.format(db_name, table_name, index_name))
+
+
+def _granted(grant: dict, conn: r.net.Connection) -> dict:
+    """Permissions the user currently has on the database (or the table) of the grant."""
+    query = r.db('rethinkdb').table('permissions').filter({'user': grant['user'], 'database': grant['db']})
+    if grant.get('table') is not None:
+        query = query.filter({'table': grant['table']})
+    else:
+        query = query.filter(lambda permission: permission.has_fields('table').not_())
+    return next(iter(query['permissions'].run(conn)), {})
+
+
+def apply_manifest(credentials: dict, manifest: dict, conn: Optional[r.net.Connection]=None) -> Dict[str, List[str]]:
+    """
+    Idempotently reconcile the databases, tables, indexes, users and permissions with the manifest.
+
+    The missing objects are created, the shards and replicas of the existing tables are reconfigured if they differ;
+    nothing is ever dropped and the passwords of the existing users are kept. An existing index with a different
+    definition is refused, as it would have to be dropped. The permissions are granted only if they differ, hence
+    applying the same manifest again changes nothing and returns an empty summary. Everything runs over a single
+    connection and the function returns once all the secondary indexes are ready (``index_wait``).
+
+    :param credentials: dict containing at least `host`, `port`, `user` and `password` keys
+    :param manifest: manifest (see the module docstring)
+    :param conn: optional open (e.g. pooled) connection; a new connection is opened if not specified
+    :raise ValueError: if the manifest is invalid or an existing index has a different definition
+    :return: names of the created (or reconfigured, or granted) objects by their kind
+    """
+    validate_manifest(manifest)
+    summary = {'databases': [], 'tables': [], 'reconfigured': [], 'indexes': [], 'users': [], 'grants': []}
+    databases = manifest.get('databases') or {}
+
+    with connect(credentials, conn) as conn:
+        existing_dbs = r.db_list().run(conn)
+        for db_name, db_spec in sorted(databases.items()):
+            if db_name not in existing_dbs:
+                logging.info('Creating database `%s`', db_name)
+                r.db_create(db_name).run(conn)
+                summary['databases'].append(db_name)
+            tables = (db_spec or {}).get('tables') or {}
+            existing_tables = r.db(db_name).table_list().run(conn)
+            for table_name, table_spec in sorted(tables.items()):
+                _reconcile_table(db_name, table_name, table_spec or {}, existing_tables, conn, summary)
+
+        users = manifest.get('users') or {}
+        if users:
+            existing_users = list(r.db('rethinkdb').table('users')['id'].run(conn))
+            for user_name, user_spec in sorted(users.items()):
+                if user_name not in existing_users:
+                    logging.info('Creating user `%s`', user_name)
+                    r.db('rethinkdb').table('users').insert({'id': user_name, 'password': user_spec['password']})\
+                        .run(conn)
+                    summary['users'].append(user_name)
+
+        for grant in manifest.get('grants') or []:
+            granted = _granted(grant, conn)
+            if all(granted.get(permission) == value for permission, value in grant['permissions'].items()):
+                continue
+            query = r.db(grant['db'])
+            if grant.get('table') is not None:
+                query = query.table(grant['table'])
+            logging.info('Granting user `%s` permissions `%s` to `%s.%s`', grant['user'], grant['permissions'],
+                         grant['db'], grant.get('table'))
+            query.grant(grant['user'], grant['permissions']).run(conn)
+            summary['grants'].append('{}@{}.{}'.format(grant['user'], grant['db'], grant.get('table')))
+
+        for db_name, db_spec in sorted(databases.items()):
+            for table_name in sorted((db_spec or {}).get('tables') or {}):
+                r.db(db_name).table(table_name).index_wait().run(conn)
+        logging.info('All the indexes are ready')
+
+    return summary
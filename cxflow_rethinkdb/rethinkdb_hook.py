@@ -1,9 +1,17 @@
+import atexit
+from contextlib import contextmanager
 from datetime import datetime
+import fcntl
+from functools import partial
+from glob import glob
 import json
 import logging
+import os
 from os import path
 import pytz
-from typing import Iterable
+import time
+import uuid
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
 import numpy as np
 import rethinkdb as r
@@ -12,7 +20,27 @@ import yaml
 import cxflow as cx
 from cxflow.hooks import AbstractHook
 
-from .utils import insert
+from .array_codec import ArrayCodec
+from .artifacts import upload_artifact
+from .background_writer import BackgroundWriter
+from .batch_buffer import BatchBuffer
+from .connection_pool import get_pool
+from .hook_stats import HookStats
+from .spool import Spool
+from .utils import _stamp, append_training, config_hash, insert, insert_batches, insert_config, insert_epochs, \
+    keep_existing
+
+_PLAIN_TYPES = (float, int, str, bool)
+"""Python types which are JSON serializable as they are."""
+
+
+class _StructureChanged(Exception):
+    """The converted value does not match the structure the serialization plan was compiled from."""
+
+
+def _identity(value):
+    """Return the value as it is."""
+    return value
 
 
 class RethinkDBHook(AbstractHook):
@@ -40,6 +68,67 @@ class RethinkDBHook(AbstractHook):
         ]
     }
     -------------------------------------------------------
+
+    -------------------------------------------------------
+    The saved document structure with `storage: epochs`:
+    -------------------------------------------------------
+    {
+        id: RethinkDB id
+        timestamp: document creation timestamp
+        config: the cxflow config (after CLI application)
+        user: username
+        training: []
+        epochs_table: name of the table with the epoch documents
+    }
+
+    and one document per epoch in the `epochs_table`:
+    {
+        id: [run id, epoch id]
+        run_id: RethinkDB id of the run document
+        timestamp: epoch update timestamp
+        epoch_id: id of the epoch
+        epoch_data: the `epoch_data` object
+    }
+
+    Use `cxflow_rethinkdb.utils.select_run` to obtain the run document with the `training` list filled.
+    -------------------------------------------------------
+
+    -------------------------------------------------------
+    The saved batch chunk documents with `log_batches: true`:
+    -------------------------------------------------------
+    {
+        id: [run id, stream name, chunk id]
+        run_id: RethinkDB id of the run document
+        stream: name of the stream
+        chunk_id: id of the chunk (within the stream)
+        timestamp: chunk creation timestamp
+        downsampling: the downsampling method
+        first_batch, last_batch: ids of the first and last batch in the chunk (counted from the training start)
+        count: number of batches in the chunk
+        variables: {variable name: {batch_ids: [..], values: [..]} or {batch_ids: [..], min: [..], max: [..],
+                    mean: [..]} with `downsampling: buckets`}
+    }
+
+    The run document refers to the table with the chunks by the `batches_table` field.
+    Use `cxflow_rethinkdb.utils.select_batches` to obtain the chunks.
+    -------------------------------------------------------
+
+    -------------------------------------------------------
+    The saved documents with `shared_run: true`:
+    -------------------------------------------------------
+    The run document has the `shared: true` field and it is created by the first worker only. Every worker stores its
+    epochs (and batch chunks) to separate documents tagged with its `rank`:
+    {
+        id: [run id, epoch id, rank]
+        run_id: RethinkDB id of the run document
+        rank: rank of the worker
+        timestamp: epoch update timestamp
+        epoch_id: id of the epoch
+        epoch_data: the `epoch_data` object
+    }
+
+    The epoch documents of all the workers are merged by the server at read time (`select_run`, `select_metrics`).
+    -------------------------------------------------------
     
     -------------------------------------------------------
     Example usage in config
@@ -61,6 +150,119 @@ class RethinkDBHook(AbstractHook):
         - accuracy
     -------------------------------------------------------
 
+    -------------------------------------------------------
+    Example usage in config (write in a background thread)
+    -------------------------------------------------------
+    - cxflow_rethinkdb.RethinkDBHook:
+        credentials_file: local/rethinkdb-credentials.json
+        db: my_database
+        table: my_table
+        async_writes: true
+        queue_size: 10
+        backpressure: coalesce
+    -------------------------------------------------------
+
+    -------------------------------------------------------
+    Example usage in config (one document per epoch in `my_table_epochs`)
+    -------------------------------------------------------
+    - cxflow_rethinkdb.RethinkDBHook:
+        credentials_file: local/rethinkdb-credentials.json
+        db: my_database
+        table: my_table
+        storage: epochs
+    -------------------------------------------------------
+
+    -------------------------------------------------------
+    Example usage in config (store large arrays as compressed binary)
+    -------------------------------------------------------
+    - cxflow_rethinkdb.RethinkDBHook:
+        credentials_file: local/rethinkdb-credentials.json
+        db: my_database
+        table: my_table
+        array_encoding: binary
+        array_compression: zlib
+        array_threshold: 4096
+    -------------------------------------------------------
+
+    -------------------------------------------------------
+    Example usage in config (journal the writes locally, survive database outages)
+    -------------------------------------------------------
+    - cxflow_rethinkdb.RethinkDBHook:
+        credentials_file: local/rethinkdb-credentials.json
+        db: my_database
+        table: my_table
+        spool: true
+    -------------------------------------------------------
+
+    -------------------------------------------------------
+    Example usage in config (store the epochs in batches of 10 or at least every minute)
+    -------------------------------------------------------
+    - cxflow_rethinkdb.RethinkDBHook:
+        credentials_file: local/rethinkdb-credentials.json
+        db: my_database
+        table: my_table
+        flush_every_epochs: 10
+        flush_interval_seconds: 60
+    -------------------------------------------------------
+
+    -------------------------------------------------------
+    Example usage in config (log the batch loss, at most 200 min/max/mean buckets per 1000 batches or 30 seconds)
+    -------------------------------------------------------
+    - cxflow_rethinkdb.RethinkDBHook:
+        credentials_file: local/rethinkdb-credentials.json
+        db: my_database
+        table: my_table
+        log_batches: true
+        batch_variables: [loss]
+        batch_buffer_size: 1000
+        batch_downsampling: buckets
+        batch_points: 200
+        batch_flush_seconds: 30
+    -------------------------------------------------------
+
+    -------------------------------------------------------
+    Example usage in config (all the workers launched with the same `CXFLOW_RETHINKDB_RUN_ID` env var, or sharing the
+    output directory, log to a single run; the rank is taken from the `RANK` env var)
+    -------------------------------------------------------
+    - cxflow_rethinkdb.RethinkDBHook:
+        credentials_file: local/rethinkdb-credentials.json
+        db: my_database
+        table: my_table
+        shared_run: true
+    -------------------------------------------------------
+
+    -------------------------------------------------------
+    Example usage in config (store the config once in the `configs` table and refer to it by its hash)
+    -------------------------------------------------------
+    - cxflow_rethinkdb.RethinkDBHook:
+        credentials_file: local/rethinkdb-credentials.json
+        db: my_database
+        table: my_table
+        dedup_config: true
+    -------------------------------------------------------
+
+    -------------------------------------------------------
+    Example usage in config (upload the plots every 10 epochs and the checkpoints at the end of the training)
+    -------------------------------------------------------
+    - cxflow_rethinkdb.RethinkDBHook:
+        credentials_file: local/rethinkdb-credentials.json
+        db: my_database
+        table: my_table
+        artifacts: ['*.png', '*.ckpt']
+        artifacts_every_epochs: 10
+    -------------------------------------------------------
+
+    -------------------------------------------------------
+    Example usage in config (log the hot-path timings every 10 epochs and store them to the `_hook_stats` field)
+    -------------------------------------------------------
+    - cxflow_rethinkdb.RethinkDBHook:
+        credentials_file: local/rethinkdb-credentials.json
+        db: my_database
+        table: my_table
+        stats_every_epochs: 10
+        store_stats: true
+    -------------------------------------------------------
+
     -------------------------------------------------------
     Where `local_config/rethinkdb-credentials.json` is a text file containing:
     -------------------------------------------------------
@@ -77,9 +279,32 @@ class RethinkDBHook(AbstractHook):
     UNKNOWN_TYPE_ACTIONS = ['error', 'warn', 'ignore']
     """Posible actions to take on unknown variable type."""
 
+    STORAGE_MODES = ['document', 'epochs']
+    """Possible layouts of the stored training progress."""
+
+    RUN_ID_ENV = 'CXFLOW_RETHINKDB_RUN_ID'
+    """Environment variable with the id of the shared run."""
+
+    RANK_ENV = 'RANK'
+    """Environment variable with the rank of the worker in the shared run."""
+
+    RUN_LOCK_FILE = 'rethink_run.lock'
+    """Lock file (in the output directory) guarding the shared run creation."""
+
     def __init__(self, output_dir: str, credentials_file: str, db: str, table: str, config_file: str='config.yaml',
                  rethink_key_file: str='rethink_key.json', variables: Iterable[str]=None,
-                 on_unknown_type: str='ignore', **kwargs):
+                 on_unknown_type: str='ignore', async_writes: bool=False, queue_size: int=100,
+                 backpressure: str='block', storage: str='document', epochs_table: Optional[str]=None,
+                 array_encoding: str='list', array_compression: Optional[str]=None, array_threshold: int=1024,
+                 spool: bool=False, spool_batch_size: int=100, spool_retry_seconds: float=30.,
+                 flush_every_epochs: int=1,
+                 flush_interval_seconds: Optional[float]=None, stats_every_epochs: Optional[int]=None,
+                 store_stats: bool=False, log_batches: bool=False, batches_table: Optional[str]=None,
+                 batch_variables: Optional[Iterable[str]]=None, batch_buffer_size: int=1000,
+                 batch_downsampling: str='buckets', batch_points: int=100, batch_flush_seconds: float=10.,
+                 shared_run: bool=False, rank: Optional[int]=None, dedup_config: bool=False,
+                 configs_table: str='configs', artifacts: Optional[Iterable[str]]=None,
+                 artifacts_every_epochs: Optional[int]=None, artifacts_table: str='artifacts', **kwargs):
         """
         Save training config to database `configs`. Save the unique id generated by the database.
         :param output_dir: output (logging) directory
@@ -87,76 +312,302 @@ class RethinkDBHook(AbstractHook):
         :param credentials_file: path to JSON credentials file which contains fields: host, port, user, password, db.
                                  This file must not be included in git.
         :param table: database table in which the results will be stored
+        :param async_writes: write the epoch data in a background thread so that the training is not blocked
+        :param queue_size: maximal number of pending writes (only with ``async_writes``)
+        :param backpressure: action taken when the queue is full, one of ``BackgroundWriter.BACKPRESSURE_POLICIES``
+                             (only with ``async_writes``)
+        :param storage: ``document`` appends the epochs to the `training` list of the run document; ``epochs``
+                        stores one small document per epoch in the ``epochs_table`` so that the write cost does not
+                        grow with the number of epochs
+        :param epochs_table: database table in which the epoch documents will be stored (only with ``storage: epochs``);
+                             defaults to ``<table>_epochs``
+        :param array_encoding: ``list`` stores numpy arrays as nested lists, ``binary`` as raw dtype, shape and bytes
+                               (see ``ArrayCodec``); decode them with ``utils.select_by_id(..., decode_arrays=True)``
+        :param array_compression: compression of the binary-encoded arrays, one of ``ArrayCodec.COMPRESSIONS``
+        :param array_threshold: arrays smaller than this number of bytes are always stored as lists
+        :param spool: write everything to a local journal in the ``output_dir`` first and drain it to the database
+                      afterwards (see ``Spool``); the records which could not be stored during a database outage may
+                      be stored later with ``cx-rethinkdb replay <output_dir>``
+        :param spool_batch_size: maximal number of spooled training items stored in a single write
+        :param spool_retry_seconds: after a failed attempt to store the spooled records (or a rejected record), the
+                                    records are only appended to the spool for this number of seconds, so that the
+                                    training does not wait for the connection timeout every epoch during a database
+                                    outage
+        :param flush_every_epochs: buffer the epoch data and store them in a single write once this number of epochs
+                                   is buffered
+        :param flush_interval_seconds: store the buffered epoch data (checked after every epoch) if the oldest
+                                       of them are buffered for longer than this number of seconds
+        :param stats_every_epochs: measure the run document size and log the hot-path statistics (see ``get_stats``)
+                                   every this number of epochs
+        :param store_stats: store the hot-path statistics to the `_hook_stats` field of the run document as well
+                            (only with ``stats_every_epochs``)
+        :param log_batches: log the batch-level variables as well; they are buffered, downsampled and stored in
+                            chunks to the ``batches_table``
+        :param batches_table: database table in which the batch chunks will be stored; defaults to ``<table>_batches``
+        :param batch_variables: batch variables to be logged (the batch values are averaged); defaults to
+                                ``variables`` or to all the numeric variables of the first batch
+        :param batch_buffer_size: maximal number of batches per chunk (the buffer is reduced and stored once full)
+        :param batch_downsampling: downsampling method, one of ``BatchBuffer.DOWNSAMPLING_METHODS``
+        :param batch_points: number of values (or buckets) per variable stored in a single chunk
+        :param batch_flush_seconds: store the buffered batches of a stream (checked after every batch) if its last
+                                    chunk was stored more than this number of seconds ago
+        :param shared_run: log to a run shared by multiple workers; its id is taken from the ``RUN_ID_ENV``
+                           environment variable or from the ``rethink_key_file`` written (under a file lock) by the
+                           first worker sharing the ``output_dir``; implies ``storage: epochs``
+        :param rank: rank of the worker in the shared run; defaults to the ``RANK_ENV`` environment variable or 0
+        :param dedup_config: store the config once in the ``configs_table`` keyed by its content hash and refer to
+                             it by the `config_hash` field instead of embedding it in the run document; rehydrate it
+                             with ``utils.select_by_id(..., rehydrate_config=True)``
+        :param configs_table: database table in which the deduplicated configs will be stored
+        :param artifacts: glob patterns (relative to the ``output_dir``) of the files to be stored as artifacts (see
+                          ``artifacts.upload_artifact``) after the training; the unchanged files are not re-uploaded
+        :param artifacts_every_epochs: upload the artifacts every this number of epochs as well
+        :param artifacts_table: database table in which the artifacts will be stored (the chunks are stored in the
+                                ``<artifacts_table>_chunks`` table)
         """
 
         assert on_unknown_type in RethinkDBHook.UNKNOWN_TYPE_ACTIONS
+        assert backpressure in BackgroundWriter.BACKPRESSURE_POLICIES
+        assert storage in RethinkDBHook.STORAGE_MODES
+        assert flush_every_epochs > 0
+        assert stats_every_epochs is None or stats_every_epochs > 0
+        assert batch_downsampling in BatchBuffer.DOWNSAMPLING_METHODS
+        assert artifacts_every_epochs is None or artifacts_every_epochs > 0
 
         self._variables = variables
+        self._plan = None
         self._on_unknown_type = on_unknown_type
+        self._array_codec = ArrayCodec(encoding=array_encoding, compression=array_compression,
+                                       threshold=array_threshold)
 
         super().__init__(output_dir=output_dir, **kwargs)
 
+        if shared_run and storage != 'epochs':
+            logging.info('Shared runs are stored with `storage: epochs`')
+            storage = 'epochs'
+
         self._table = table
         self._db = db
+        self._storage = storage
+        self._shared_run = shared_run
+        self._rank = None
+        if shared_run:
+            self._rank = rank if rank is not None else int(os.environ.get(RethinkDBHook.RANK_ENV, 0))
+        self._epochs_table = epochs_table if epochs_table is not None else '{}_epochs'.format(table)
+        self._writer = None
+        self._output_dir = output_dir
+        self._spool = None
+        if spool:
+            journal_file, offset_file = Spool.file_names(self._rank)
+            self._spool = Spool(output_dir, journal_file=journal_file, offset_file=offset_file)
+        self._spool_batch_size = spool_batch_size
+        self._spool_retry_seconds = spool_retry_seconds
+        self._next_drain = 0.
+        self._flush_every_epochs = flush_every_epochs
+        self._flush_interval_seconds = flush_interval_seconds
+        self._buffer = []
+        self._buffered_since = None
+        self._stats = HookStats()
+        self._stats_every_epochs = stats_every_epochs
+        self._store_stats = store_stats
+        self._log_batches = log_batches
+        self._batches_table = batches_table if batches_table is not None else '{}_batches'.format(table)
+        self._batch_variables = batch_variables if batch_variables is not None else variables
+        self._batch_buffer_size = batch_buffer_size
+        self._batch_downsampling = batch_downsampling
+        self._batch_points = batch_points
+        self._batch_flush_seconds = batch_flush_seconds
+        self._batch_buffers = {}  # type: Dict[str, BatchBuffer]
+        self._batch_counts = {}  # type: Dict[str, int]
+        self._chunk_counts = {}  # type: Dict[str, int]
+        self._batches_stored_at = {}  # type: Dict[str, float]
+        self._batch_writer = None
+        self._artifacts = list(artifacts) if artifacts is not None else []
+        self._artifacts_every_epochs = artifacts_every_epochs
+        self._artifacts_table = artifacts_table
 
         with open(credentials_file, 'r') as file:
             self._credentials = json.load(file)
+        self._pool = get_pool(self._credentials)
 
         with open(path.join(output_dir, config_file), 'r') as config_f:
-            config = yaml.load(config_f)
-
-        logging.debug('Creating training document in the db')
-        response = insert(credentials=self._credentials, db_name=self._db, table_name=self._table,
-                          document={'config': config,
-                                    'training': [],
-                                    'timestamp': r.expr(datetime.now(pytz.utc)),
-                                    'user': self._credentials['user']})
-        if response['errors'] > 0:
-            logging.error('Error: %s', response['errors'])
-            return
-        if response['inserted'] != 1:
-            logging.error('Inserted unexpected number of documents: %s', response['inserted'])
-            return
-        self._rethink_id = response['generated_keys'][0]
-        logging.debug('Created config: %s', self._rethink_id)
+            config = yaml.safe_load(config_f)
+
+        document = {'id': str(uuid.uuid4()),
+                    'config': config,
+                    'training': [],
+                    'timestamp': datetime.now(pytz.utc),
+                    'user': self._credentials['user']}
+        if self._storage == 'epochs':
+            document['epochs_table'] = self._epochs_table
+        if self._log_batches:
+            document['batches_table'] = self._batches_table
+        if self._artifacts:
+            document['artifacts_table'] = self._artifacts_table
+        if dedup_config:
+            document['config_hash'] = config_hash(config)
+            document['configs_table'] = configs_table
+            del document['config']
 
         rethink_id_file = path.join(output_dir, rethink_key_file)
-        logging.info('Saving document id to `%s`', rethink_id_file)
-        with open(rethink_id_file, 'w') as file:
-            json.dump({'rethink_id': self._rethink_id}, file)
+        with self._run_lock():
+            if self._shared_run:
+                document['id'] = self._shared_run_id(rethink_id_file) or document['id']
+                document['shared'] = True
+                logging.info('Joining shared run `%s` as rank %d', document['id'], self._rank)
+
+            logging.debug('Creating training document in the db')
+            if self._spool is not None:
+                if dedup_config:
+                    self._spool.append({'op': 'insert_config', 'db': self._db, 'configs_table': configs_table,
+                                        'config': config})
+                self._spool.append({'op': 'insert_run', 'db': self._db, 'table': self._table, 'document': document})
+                self._drain()
+            else:
+                with self._pool.connection() as conn:
+                    if dedup_config:
+                        insert_config(credentials=self._credentials, db_name=self._db, configs_table=configs_table,
+                                      config=config, conn=conn)
+                    response = insert(credentials=self._credentials, db_name=self._db, table_name=self._table,
+                                      document=_stamp(document), conn=conn,
+                                      conflict=keep_existing if self._shared_run else 'error')
+                if response['errors'] > 0:
+                    logging.error('Error: %s', response['errors'])
+                    return
+                if response['inserted'] + response.get('unchanged', 0) != 1:
+                    logging.error('Inserted unexpected number of documents: %s', response['inserted'])
+                    return
+            self._rethink_id = document['id']
+            logging.debug('Created config: %s', self._rethink_id)
+
+            logging.info('Saving document id to `%s`', rethink_id_file)
+            with open(rethink_id_file, 'w') as file:
+                json.dump({'rethink_id': self._rethink_id}, file)
+
+        if async_writes:
+            self._writer = BackgroundWriter(write_fn=self._write_chunks, max_queue_size=queue_size,
+                                            backpressure=backpressure)
+            if self._log_batches:
+                self._batch_writer = BackgroundWriter(write_fn=self._write_chunks_of_batches,
+                                                      max_queue_size=queue_size, backpressure=backpressure,
+                                                      name='rethinkdb-batch-writer')
+        atexit.register(self._close)
+
+    @contextmanager
+    def _run_lock(self) -> Iterator[None]:
+        """Hold an exclusive lock of the output directory while joining a shared run (no-op for non-shared runs)."""
+        if not self._shared_run:
+            yield
+            return
+        with open(path.join(self._output_dir, RethinkDBHook.RUN_LOCK_FILE), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _shared_run_id(rethink_id_file: str) -> Optional[str]:
+        """Return the id of the shared run from the environment or the key file (None if it is not created yet)."""
+        if RethinkDBHook.RUN_ID_ENV in os.environ:
+            return os.environ[RethinkDBHook.RUN_ID_ENV]
+        if path.exists(rethink_id_file):
+            with open(rethink_id_file, 'r') as file:
+                return json.load(file)['rethink_id']
+        return None
 
     @staticmethod
-    def _to_json_serializable(data):
-        """Make a dict containing numpy arrays/scalars JSON serializable."""
+    def _to_json_serializable(data, array_codec: Optional[ArrayCodec]=None):
+        """Make a dict containing numpy arrays/scalars JSON serializable (encode the arrays with the given codec)."""
 
         if isinstance(data, dict):
-            return {key: RethinkDBHook._to_json_serializable(value) for key, value in data.items()}
+            return {key: RethinkDBHook._to_json_serializable(value, array_codec) for key, value in data.items()}
         elif isinstance(data, list):
-            return [RethinkDBHook._to_json_serializable(v) for v in data]
+            return [RethinkDBHook._to_json_serializable(v, array_codec) for v in data]
         elif isinstance(data, np.ndarray):
-            return data.tolist()
+            return data.tolist() if array_codec is None else array_codec.encode(data)
         if isinstance(data, np.generic):
-            return np.asscalar(data)
+            return data.item()
         elif np.isscalar(data):
             return data
         else:
             raise ValueError('Unsupported JSON type `{}` (key `{}`)'.format(type(data), data))
 
-    def _build_data_dict(self, epoch_data: cx.EpochData):
-        """TODO: doc"""
+    def _converter(self, value) -> Callable:
+        """
+        Compile the function making the values of the same structure as the given one JSON serializable.
 
-        result = {}
+        The converters of dicts check the structure of the converted values and raise ``_StructureChanged`` if it does
+        not match the given value.
+        """
+        if type(value) in _PLAIN_TYPES:
+            return _identity
+        if isinstance(value, np.generic):
+            return np.generic.item
+        if isinstance(value, np.ndarray):
+            return self._array_codec.encode
+        if isinstance(value, dict):
+            steps = [(key, type(item), self._converter(item)) for key, item in value.items()]
+
+            def convert_dict(data: dict) -> dict:
+                if len(data) != len(steps):
+                    raise _StructureChanged()
+                result = {}
+                for key, item_type, convert in steps:
+                    item = data.get(key)
+                    if type(item) is not item_type:
+                        raise _StructureChanged()
+                    result[key] = convert(item)
+                return result
+            return convert_dict
+        return partial(RethinkDBHook._to_json_serializable, array_codec=self._array_codec)
+
+    def _compile_plan(self, epoch_data: cx.EpochData) -> Dict[str, List[Tuple[str, type, Callable]]]:
+        """
+        Compile the serialization plan from the structure of the given epoch data.
+
+        :param epoch_data: epoch data to be logged
+        :raise KeyError: if a variable to be logged is missing
+        :return: dict of stream name -> list of (variable name, value type, converter)
+        """
+        plan = {}
         for stream_name in epoch_data.keys():
-            result[stream_name] = {}
             stream_data = epoch_data[stream_name]
             variables = self._variables if self._variables is not None else stream_data.keys()
+            steps = []
             for variable in variables:
                 if variable not in stream_data:
                     raise KeyError('Variable `{}` to be logged was not found in the batch data for stream `{}`. '
                                    'Available variables are `{}`.'.format(variable, stream_name, stream_data.keys()))
                 value = stream_data[variable]
+                steps.append((variable, type(value), self._converter(value)))
+            plan[stream_name] = steps
+        return plan
+
+    def _apply_plan(self, epoch_data: cx.EpochData) -> Optional[dict]:
+        """
+        Make the epoch data JSON serializable according to the compiled plan.
+
+        :param epoch_data: epoch data to be logged
+        :return: JSON serializable epoch data or None if their structure does not match the plan
+        """
+        if len(self._plan) != len(epoch_data):
+            return None
+
+        result = {}
+        for stream_name, steps in self._plan.items():
+            stream_data = epoch_data.get(stream_name)
+            if stream_data is None or (self._variables is None and len(stream_data) != len(steps)):
+                return None
+            stream_result = result[stream_name] = {}
+            for variable, value_type, convert in steps:
+                value = stream_data.get(variable)
+                if type(value) is not value_type:
+                    return None
                 try:
-                    result[stream_name][variable] = RethinkDBHook._to_json_serializable(value)
+                    stream_result[variable] = convert(value)
+                except _StructureChanged:
+                    return None
                 except ValueError as ex:
                     if self._on_unknown_type == 'error':
                         raise TypeError('Variable type `{}` can not be logged. Variable name: `{}`.'
@@ -166,24 +617,269 @@ class RethinkDBHook(AbstractHook):
                                         type(value).__name__, variable)
         return result
 
+    def _build_data_dict(self, epoch_data: cx.EpochData) -> dict:
+        """
+        Make the epoch data (filtered to the logged variables) JSON serializable.
+
+        The serialization plan is compiled from the first epoch and reused as long as the structure of the epoch data
+        (streams, variables, their types and the keys of nested dicts) does not change; it is recompiled otherwise.
+        """
+        if self._plan is not None:
+            result = self._apply_plan(epoch_data)
+            if result is not None:
+                return result
+            logging.debug('Epoch data structure changed, recompiling the serialization plan')
+        self._plan = self._compile_plan(epoch_data)
+        return self._apply_plan(epoch_data)
+
+    def _drain(self, retry: bool=False) -> None:
+        """
+        Store the spooled records in the database; keep them in the spool if the database is not accessible or
+        rejects them (see ``Spool.drain``).
+
+        After a failure, the records are kept in the spool without any attempt to store them for
+        ``spool_retry_seconds`` (unless ``retry`` is set).
+        """
+        if not retry and time.time() < self._next_drain:
+            logging.debug('RethinkDB was not accessible recently, %d record(s) kept in the spool',
+                          self._spool.pending_count)
+            return
+        try:
+            with self._stats.timer('connect'):
+                conn = self._pool.acquire(retry=retry)
+            try:
+                with self._stats.timer('query'):
+                    self._spool.drain(credentials=self._credentials, conn=conn, batch_size=self._spool_batch_size,
+                                      json_encoder=self._stats.json_encoder())
+            finally:
+                self._pool.release(conn)
+        except r.ReqlError as ex:
+            self._next_drain = time.time() + self._spool_retry_seconds
+            logging.warning('RethinkDB is not accessible, %d record(s) kept in the spool (next attempt in %.0fs): %s',
+                            self._spool.pending_count, self._spool_retry_seconds, ex)
+        else:
+            if self._spool.pending_count > 0:
+                self._next_drain = time.time() + self._spool_retry_seconds
+                logging.warning('RethinkDB rejected a spooled record, %d record(s) kept in the spool (next attempt in '
+                                '%.0fs)', self._spool.pending_count, self._spool_retry_seconds)
+
+    def _write_items(self, items: List[dict]) -> None:
+        """Store the given training items according to the storage mode."""
+
+        if self._spool is not None:
+            if self._storage == 'epochs':
+                self._spool.append({'op': 'insert_epochs', 'db': self._db, 'epochs_table': self._epochs_table,
+                                    'run_id': self._rethink_id, 'rank': self._rank, 'items': items})
+            else:
+                self._spool.append({'op': 'append_training', 'db': self._db, 'table': self._table,
+                                    'run_id': self._rethink_id, 'items': items})
+            self._drain()
+            return
+
+        with self._stats.timer('connect'):
+            conn = self._pool.acquire()
+        try:
+            with self._stats.timer('query'):
+                if self._storage == 'epochs':
+                    response = insert_epochs(credentials=self._credentials, db_name=self._db,
+                                             epochs_table=self._epochs_table, run_id=self._rethink_id, items=items,
+                                             conn=conn, rank=self._rank, json_encoder=self._stats.json_encoder())
+                else:
+                    response = append_training(credentials=self._credentials, db_name=self._db,
+                                               table_name=self._table, run_id=self._rethink_id, items=items,
+                                               conn=conn, json_encoder=self._stats.json_encoder())
+        finally:
+            self._pool.release(conn)
+
+        if response['errors'] > 0:
+            logging.error('Error: %s', response.get('first_error', response['errors']))
+            return
+        logging.debug('Stored %d training item(s) of: %s', len(items), self._rethink_id)
+
+    def _write_chunks(self, chunks: List[List[dict]]) -> None:
+        """Store the chunks of training items (coalesced by the background writer) in a single write."""
+        self._write_items([item for chunk in chunks for item in chunk])
+
+    def _write_batches(self, chunks: List[dict]) -> None:
+        """Store the given batch chunks."""
+
+        if self._spool is not None:
+            self._spool.append({'op': 'insert_batches', 'db': self._db, 'batches_table': self._batches_table,
+                                'run_id': self._rethink_id, 'rank': self._rank, 'items': chunks})
+            self._drain()
+            return
+
+        with self._stats.timer('connect'):
+            conn = self._pool.acquire()
+        try:
+            with self._stats.timer('query'):
+                response = insert_batches(credentials=self._credentials, db_name=self._db,
+                                          batches_table=self._batches_table, run_id=self._rethink_id, chunks=chunks,
+                                          conn=conn, rank=self._rank, json_encoder=self._stats.json_encoder())
+        finally:
+            self._pool.release(conn)
+
+        if response['errors'] > 0:
+            logging.error('Error: %s', response.get('first_error', response['errors']))
+            return
+        logging.debug('Stored %d batch chunk(s) of: %s', len(chunks), self._rethink_id)
+
+    def _write_chunks_of_batches(self, chunk_lists: List[List[dict]]) -> None:
+        """Store the lists of batch chunks (coalesced by the background writer) in a single write."""
+        self._write_batches([chunk for chunks in chunk_lists for chunk in chunks])
+
+    def _flush_batches(self, stream_names: Optional[Iterable[str]]=None) -> None:
+        """
+        Downsample the buffered batches and store (or enqueue) them.
+
+        :param stream_names: streams to be flushed; defaults to all the streams
+        """
+        chunks = []
+        for stream_name in (stream_names if stream_names is not None else list(self._batch_buffers)):
+            self._batches_stored_at[stream_name] = time.time()
+            chunk = self._batch_buffers[stream_name].reduce()
+            if chunk is None:
+                continue
+            chunk.update({'stream': stream_name, 'chunk_id': self._chunk_counts[stream_name],
+                          'timestamp': datetime.now(pytz.utc), 'downsampling': self._batch_downsampling})
+            self._chunk_counts[stream_name] += 1
+            chunks.append(chunk)
+        if not chunks:
+            return
+
+        if self._batch_writer is not None:
+            self._batch_writer.put(chunks)
+        else:
+            self._write_batches(chunks)
+
+    def after_batch(self, stream_name: str, batch_data: cx.Batch) -> None:
+        """Buffer the batch variables; downsample and store them once the buffer is full or due."""
+        if not self._log_batches:
+            return
+
+        buffer = self._batch_buffers.get(stream_name)
+        if buffer is None:
+            variables = self._batch_variables
+            if variables is None:
+                variables = sorted(variable for variable, value in batch_data.items()
+                                   if np.issubdtype(np.asarray(value).dtype, np.number))
+            buffer = self._batch_buffers[stream_name] = BatchBuffer(
+                variables, capacity=self._batch_buffer_size, downsampling=self._batch_downsampling,
+                points=self._batch_points)
+            self._batch_counts[stream_name] = 0
+            self._chunk_counts[stream_name] = 0
+            self._batches_stored_at[stream_name] = time.time()
+
+        values = {}
+        for variable in buffer.variables:
+            if variable in batch_data:
+                try:
+                    values[variable] = float(np.mean(batch_data[variable]))
+                except (TypeError, ValueError):
+                    pass
+        buffer.append(self._batch_counts[stream_name], values)
+        self._batch_counts[stream_name] += 1
+
+        if buffer.full or time.time() - self._batches_stored_at[stream_name] >= self._batch_flush_seconds:
+            self._flush_batches([stream_name])
+
+    def _should_flush(self) -> bool:
+        """Check whether the buffered training items are due to be stored."""
+        if len(self._buffer) >= self._flush_every_epochs:
+            return True
+        return self._flush_interval_seconds is not None and \
+            time.time() - self._buffered_since >= self._flush_interval_seconds
+
+    def _flush(self) -> None:
+        """Store (or enqueue) the buffered training items."""
+        if not self._buffer:
+            return
+        items, self._buffer, self._buffered_since = self._buffer, [], None
+
+        if self._writer is not None:
+            self._writer.put(items)
+        else:
+            self._write_items(items)
+
+    def _upload_artifacts(self) -> None:
+        """Upload the files matching the artifact patterns; log the failures."""
+        file_paths = sorted({file_path for pattern in self._artifacts
+                             for file_path in glob(path.join(self._output_dir, pattern)) if path.isfile(file_path)})
+        for file_path in file_paths:
+            name = path.relpath(file_path, self._output_dir)
+            try:
+                upload_artifact(credentials=self._credentials, db_name=self._db, run_id=self._rethink_id, name=name,
+                                file_path=file_path, table_name=self._artifacts_table, pool=self._pool)
+            except (r.ReqlError, ValueError) as ex:
+                logging.error('Failed to upload artifact `%s`: %s', name, ex)
+
+    def get_stats(self) -> dict:
+        """
+        Return the rolling statistics of the hot path.
+
+        :return: dict of phase (see ``HookStats.PHASES``) -> dict with `last`, `mean`, `max`, `total` and `count`;
+                 the times are in seconds, the sizes in bytes
+        """
+        return self._stats.summary()
+
+    def _report_stats(self) -> None:
+        """Measure the run document size, log the hot-path statistics and optionally store them."""
+        run = r.db(self._db).table(self._table).get(self._rethink_id)
+        try:
+            with self._pool.connection() as conn:
+                # the UTF-8 bytes are counted on the server, the document is not transferred
+                size = run.to_json_string().coerce_to('binary').count().run(conn)
+                if size is not None:
+                    self._stats.record('document_size', size)
+                if self._store_stats:
+                    stats = self.get_stats() if self._rank is None else {str(self._rank): self.get_stats()}
+                    run.update({'_hook_stats': stats, 'modified': r.now()}, durability='soft').run(conn)
+        except r.ReqlError as ex:
+            logging.warning('Failed to measure the run document: %s', ex)
+
+        for phase, summary in sorted(self.get_stats().items()):
+            logging.info('Rethink stats: %-13s last %.6g, mean %.6g, max %.6g', phase, summary['last'],
+                         summary['mean'], summary['max'])
+
     def after_epoch(self, epoch_id: int, epoch_data: cx.EpochData, **kwargs) -> None:
         logging.info('Rethink: after epoch %d', epoch_id)
 
-        with r.connect(**self._credentials) as conn:
-            item = {'timestamp': r.expr(datetime.now(pytz.utc)),
-                    'epoch_id': epoch_id,
-                    'epoch_data': self._build_data_dict(epoch_data)}
-
-            response = r.db(self._db)\
-                        .table(self._table)\
-                        .get(self._rethink_id)\
-                        .update({'training': r.row['training'].append(item)})\
-                        .run(conn)
-
-            if response['errors'] > 0:
-                logging.error('Error: %s', response['errors'])
-                return
-            if response['replaced'] != 1:
-                logging.error('Modified unexpected number of documents: %s instead of 1', response['replaced'])
-                return
-            logging.debug('Appended train. progress to: %s', self._rethink_id)
+        with self._stats.timer('serialize'):
+            epoch_data = self._build_data_dict(epoch_data)
+        item = {'timestamp': datetime.now(pytz.utc),
+                'epoch_id': epoch_id,
+                'epoch_data': epoch_data}
+
+        if not self._buffer:
+            self._buffered_since = time.time()
+        self._buffer.append(item)
+
+        if self._should_flush():
+            self._flush()
+
+        if self._stats_every_epochs is not None and epoch_id % self._stats_every_epochs == 0:
+            self._report_stats()
+
+        if self._artifacts_every_epochs is not None and epoch_id % self._artifacts_every_epochs == 0:
+            self._upload_artifacts()
+
+    def after_training(self, **kwargs) -> None:
+        """Store the buffered epoch data, flush the pending writes, join the writer threads and upload the artifacts."""
+        atexit.unregister(self._close)
+        self._close()
+        self._upload_artifacts()
+
+    def _close(self) -> None:
+        """Store the buffered epoch data, flush the pending writes and join the writer thread."""
+        self._flush()
+        self._flush_batches()
+        if self._writer is not None:
+            logging.info('Rethink: waiting for the pending writes')
+            self._writer.close()
+        if self._batch_writer is not None:
+            self._batch_writer.close()
+        if self._spool is not None:
+            self._drain(retry=True)
+            if self._spool.pending_count > 0:
+                logging.warning('%d record(s) were not stored in RethinkDB; store them later with '
+                                '`cx-rethinkdb replay %s`', self._spool.pending_count, self._output_dir)
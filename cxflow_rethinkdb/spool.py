@@ -0,0 +1,307 @@
+import base64
+from datetime import datetime
+import glob
+import json
+import logging
+import os
+from os import path
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import pytz
+import rethinkdb as r
+
+from .utils import _stamp, append_training, insert, insert_batches, insert_config, insert_epochs, keep_existing
+
+
+def _encode(obj):
+    """Encode the RethinkDB pseudo types (times and binaries) as JSON objects."""
+    if isinstance(obj, datetime):
+        return {'$reql_type$': 'TIME', 'epoch_time': obj.timestamp(), 'timezone': '+00:00'}
+    if isinstance(obj, r.ast.Binary):
+        return {'$reql_type$': 'BINARY', 'data': obj.base64_data.decode('ascii')}
+    raise TypeError('Object of type `{}` can not be spooled'.format(type(obj).__name__))
+
+
+def _decode(obj: dict):
+    """Decode the RethinkDB pseudo types encoded by ``_encode``."""
+    reql_type = obj.get('$reql_type$')
+    if reql_type == 'TIME':
+        return datetime.fromtimestamp(obj['epoch_time'], pytz.utc)
+    if reql_type == 'BINARY':
+        return r.binary(base64.b64decode(obj['data']))
+    return obj
+
+
+class Spool:
+    """
+    Local append-only write-ahead journal of the database writes.
+
+    Every write is appended to the JSONL journal (``rethink_spool.jsonl`` in the output directory) first and drained
+    to the database afterwards. The sequence number of the last record stored in the database is kept in the offset
+    file (``rethink_spool.offset``); hence, the records which could not be sent (e.g. during a database outage) may be
+    replayed later with ``cx-rethinkdb replay <output_dir>``. All the writes are idempotent, so replaying an already
+    sent record is harmless. Once all the records are stored, the journal is truncated.
+
+    A record rejected by the database (e.g. a too large document) is retried alone and, if rejected repeatedly, it is
+    moved to the quarantine file (``rethink_spool.rejected``), so that the records behind it are still stored.
+
+    -------------------------------------------------------
+    The journal record structure:
+    -------------------------------------------------------
+    {seq: 0, op: insert_config, db: .., configs_table: .., config: {..}}
+    {seq: 1, op: insert_run, db: .., table: .., document: {..}}
+    {seq: 2, op: append_training, db: .., table: .., run_id: .., items: [..]}
+    {seq: 3, op: insert_epochs, db: .., epochs_table: .., run_id: .., rank: .., items: [..]}
+    {seq: 4, op: insert_batches, db: .., batches_table: .., run_id: .., rank: .., items: [..]}
+
+    The `rank` is null unless the run is shared by multiple workers. The workers sharing a run (and its output
+    directory) keep separate journals, see ``file_names``.
+    -------------------------------------------------------
+    """
+
+    OPERATIONS = ['insert_config', 'insert_run', 'append_training', 'insert_epochs', 'insert_batches']
+    """Possible journal record operations."""
+
+    JOURNAL_FILE = 'rethink_spool.jsonl'
+    """Default name of the journal file."""
+
+    OFFSET_FILE = 'rethink_spool.offset'
+    """Default name of the offset file."""
+
+    def __init__(self, output_dir: str, journal_file: str=JOURNAL_FILE, offset_file: str=OFFSET_FILE,
+                 fsync: bool=True, max_rejections: int=3):
+        """
+        Open the journal and load the records which were not stored in the database yet.
+
+        :param output_dir: directory with the journal
+        :param journal_file: name of the journal file
+        :param offset_file: name of the file with the sequence number of the last record stored in the database
+        :param fsync: sync the journal to the disk after every append
+        :param max_rejections: number of the attempts to store a record rejected by the database before it is moved
+                               to the quarantine file
+        """
+        assert max_rejections > 0
+        self._journal_path = path.join(output_dir, journal_file)
+        self._offset_path = path.join(output_dir, offset_file)
+        self._rejected_path = path.splitext(self._journal_path)[0] + '.rejected'
+        self._fsync = fsync
+        self._max_rejections = max_rejections
+        self._rejections = {}  # type: Dict[int, int]
+        self._lock = threading.RLock()
+
+        self._acked = -1
+        if path.exists(self._offset_path):
+            with open(self._offset_path, 'r') as file:
+                self._acked = int(file.read().strip() or -1)
+
+        self._pending = []  # type: List[dict]
+        self._next_seq = 0
+        if path.exists(self._journal_path):
+            with open(self._journal_path, 'r') as file:
+                for line in file:
+                    if not line.strip():
+                        continue
+                    try:
+                        record = json.loads(line, object_hook=_decode)
+                    except ValueError:
+                        logging.warning('Skipping a corrupted record in `%s`', self._journal_path)
+                        continue
+                    self._next_seq = record['seq'] + 1
+                    if record['seq'] > self._acked:
+                        self._pending.append(record)
+
+    @staticmethod
+    def file_names(rank: Optional[int]=None) -> Tuple[str, str]:
+        """
+        Names of the journal and offset files of the given worker rank.
+
+        The spool of every worker sharing a run is kept in separate files (``rethink_spool.<rank>.jsonl``,
+        ``rethink_spool.<rank>.offset`` and ``rethink_spool.<rank>.rejected``), since the sequence numbers and the
+        offset are tracked per process.
+
+        :param rank: rank of the worker in a shared run; `None` if the run is not shared
+        :return: tuple of the journal and offset file names
+        """
+        if rank is None:
+            return Spool.JOURNAL_FILE, Spool.OFFSET_FILE
+        return 'rethink_spool.{}.jsonl'.format(rank), 'rethink_spool.{}.offset'.format(rank)
+
+    @staticmethod
+    def open_all(output_dir: str, **kwargs) -> List['Spool']:
+        """
+        Open all the spools (of all the worker ranks) in the given directory.
+
+        :param output_dir: directory with the journals
+        :param kwargs: additional ``Spool`` arguments
+        :return: list of the spools ordered by their journal file names
+        """
+        journals = sorted(glob.glob(path.join(output_dir, 'rethink_spool*.jsonl')))
+        return [Spool(output_dir, journal_file=path.basename(journal),
+                      offset_file=path.basename(journal)[:-len('.jsonl')] + '.offset', **kwargs)
+                for journal in journals]
+
+    @property
+    def journal_path(self) -> str:
+        """Path to the journal file."""
+        return self._journal_path
+
+    @property
+    def rejected_path(self) -> str:
+        """Path to the quarantine file with the records rejected by the database."""
+        return self._rejected_path
+
+    @property
+    def pending_count(self) -> int:
+        """Number of records not stored in the database yet."""
+        return len(self._pending)
+
+    def append(self, record: dict) -> None:
+        """
+        Append the record to the journal.
+
+        :param record: journal record without the `seq` key
+        """
+        assert record['op'] in Spool.OPERATIONS
+
+        with self._lock:
+            record = dict(record, seq=self._next_seq)
+            line = json.dumps(record, default=_encode)
+            with open(self._journal_path, 'a') as file:
+                file.write(line + '\n')
+                file.flush()
+                if self._fsync:
+                    os.fsync(file.fileno())
+            self._next_seq += 1
+            self._pending.append(record)
+
+    def _write_offset(self, seq: int) -> None:
+        """Atomically store the sequence number of the last record stored in the database."""
+        tmp_path = self._offset_path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            file.write(str(seq))
+        os.replace(tmp_path, self._offset_path)
+        self._acked = seq
+
+    def _ack(self, seq: int) -> None:
+        """Acknowledge the records up to the given sequence number."""
+        self._write_offset(seq)
+        self._pending = [record for record in self._pending if record['seq'] > seq]
+
+    def _truncate(self) -> None:
+        """
+        Empty the fully stored journal and restart the sequence numbers.
+
+        The offset is reset first; if interrupted in between, the already stored records are only replayed again.
+        """
+        self._write_offset(-1)
+        with open(self._journal_path, 'w'):
+            pass
+        self._next_seq = 0
+        self._rejections.clear()
+
+    def _reject(self, record: dict, error: str) -> bool:
+        """
+        Count the rejection of the record; move it to the quarantine file if it was rejected too many times.
+
+        :return: whether the record was quarantined
+        """
+        rejections = self._rejections[record['seq']] = self._rejections.get(record['seq'], 0) + 1
+        if rejections < self._max_rejections:
+            logging.error('Failed to store spooled record %d (attempt %d/%d): %s', record['seq'], rejections,
+                          self._max_rejections, error)
+            return False
+        logging.error('Failed to store spooled record %d, moving it to `%s`: %s', record['seq'],
+                      self._rejected_path, error)
+        with open(self._rejected_path, 'a') as file:
+            file.write(json.dumps(dict(record, error=error), default=_encode) + '\n')
+        del self._rejections[record['seq']]
+        return True
+
+    @staticmethod
+    def _same_target(record: dict, other: dict) -> bool:
+        """Check whether the two epoch records may be merged to a single write."""
+        return record['op'] == other['op'] and record['op'] not in ('insert_config', 'insert_run') and \
+            all(record.get(key) == other.get(key)
+                for key in ['db', 'table', 'epochs_table', 'batches_table', 'run_id', 'rank'])
+
+    def drain(self, credentials: dict, conn: Optional[r.net.Connection]=None, batch_size: int=100,
+              **run_kwargs) -> int:
+        """
+        Store the pending records in the database in batches of consecutive records.
+
+        The draining stops at the first failed write; the remaining records are kept in the journal. A batch rejected
+        by the database is retried record by record and a record rejected ``max_rejections`` times is quarantined
+        (see ``rejected_path``) and skipped.
+
+        :param credentials: dict containing at least `host`, `port`, `user` and `password` keys
+        :param conn: optional open (e.g. pooled) connection; a new connection is opened if not specified
+        :param batch_size: maximal number of training items (or batch chunks) stored in a single write
+        :param run_kwargs: additional ``run`` arguments, e.g. ``json_encoder``
+        :raise ReqlDriverError: if the database is not accessible
+        :raise ReqlAvailabilityError: if the database is not available
+        :return: number of records stored (or quarantined)
+        """
+        stored = 0
+        with self._lock:
+            while self._pending:
+                batch = [self._pending[0]]
+                items = list(batch[0].get('items', []))
+                for record in self._pending[1:]:
+                    if not Spool._same_target(batch[0], record) or len(items) + len(record['items']) > batch_size \
+                            or batch[0]['seq'] in self._rejections:
+                        break
+                    batch.append(record)
+                    items += record['items']
+
+                head = batch[0]
+                try:
+                    response = self._store(head, items, credentials, conn, run_kwargs)
+                except (r.ReqlDriverError, r.ReqlAvailabilityError):
+                    raise
+                except r.ReqlError as ex:
+                    response = {'errors': 1, 'first_error': str(ex)}
+
+                if response['errors'] > 0 or response.get('skipped', 0) > 0:
+                    error = response.get('first_error', 'document not found')
+                    if len(batch) > 1:
+                        logging.error('Failed to store spooled records %d-%d, retrying them one by one: %s',
+                                      head['seq'], batch[-1]['seq'], error)
+                        self._rejections[head['seq']] = 0
+                        continue
+                    if not self._reject(head, error):
+                        break
+
+                self._rejections.pop(head['seq'], None)
+                self._ack(batch[-1]['seq'])
+                stored += len(batch)
+
+            if stored and not self._pending:
+                self._truncate()
+
+        if stored:
+            logging.debug('Stored %d spooled record(s), %d pending', stored, len(self._pending))
+        return stored
+
+    @staticmethod
+    def _store(head: dict, items: List[dict], credentials: dict, conn: Optional[r.net.Connection],
+               run_kwargs: dict) -> dict:
+        """Store the batch starting with the given record (with the given items merged) and return the response."""
+        if head['op'] == 'insert_config':
+            try:
+                insert_config(credentials=credentials, db_name=head['db'], configs_table=head['configs_table'],
+                              config=head['config'], conn=conn, **run_kwargs)
+                return {'errors': 0}
+            except ValueError as ex:
+                return {'errors': 1, 'first_error': str(ex)}
+        if head['op'] == 'insert_run':
+            return insert(credentials=credentials, db_name=head['db'], table_name=head['table'],
+                          document=_stamp(head['document']), conn=conn, conflict=keep_existing, **run_kwargs)
+        if head['op'] == 'append_training':
+            return append_training(credentials=credentials, db_name=head['db'], table_name=head['table'],
+                                   run_id=head['run_id'], items=items, conn=conn, **run_kwargs)
+        if head['op'] == 'insert_batches':
+            return insert_batches(credentials=credentials, db_name=head['db'], batches_table=head['batches_table'],
+                                  run_id=head['run_id'], chunks=items, conn=conn, rank=head.get('rank'), **run_kwargs)
+        return insert_epochs(credentials=credentials, db_name=head['db'], epochs_table=head['epochs_table'],
+                             run_id=head['run_id'], items=items, conn=conn, rank=head.get('rank'), **run_kwargs)
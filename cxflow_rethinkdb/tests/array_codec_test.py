@@ -0,0 +1,40 @@
+import base64
+
+import numpy as np
+
+from cxflow.tests.test_core import CXTestCase
+from cxflow_rethinkdb.array_codec import ArrayCodec, ARRAY_MARKER, decode_arrays
+
+
+def _as_selected(document):
+    """Replace the `r.binary` term with the bytes the database would return."""
+    return dict(document, data=base64.b64decode(document['data'].base64_data))
+
+
+class ArrayCodecTest(CXTestCase):
+    """Array codec test (no database is needed)."""
+
+    def test_list(self):
+        """Test the list encoding and the threshold."""
+        array = np.arange(6, dtype=np.float32).reshape(2, 3)
+        self.assertListEqual(array.tolist(), ArrayCodec(encoding='list').encode(array))
+        self.assertListEqual(array.tolist(), ArrayCodec(encoding='binary', threshold=1000).encode(array))
+
+    def test_binary(self):
+        """Test the binary encoding round trip with all the compressions available."""
+        array = np.random.rand(10, 20, 3).astype(np.float32)[:, ::2]
+        for compression in [None, 'zlib']:
+            encoded = ArrayCodec(encoding='binary', compression=compression, threshold=0).encode(array)
+            self.assertTrue(encoded[ARRAY_MARKER])
+            self.assertEqual(compression, encoded['compression'])
+            self.assertListEqual([10, 10, 3], encoded['shape'])
+
+            decoded = decode_arrays({'train': {'embedding': _as_selected(encoded), 'loss': [1.0, 2.0]}})
+            self.assertEqual(np.float32, decoded['train']['embedding'].dtype)
+            np.testing.assert_array_equal(array, decoded['train']['embedding'])
+            self.assertListEqual([1.0, 2.0], decoded['train']['loss'])
+
+    def test_object_array(self):
+        """Test object arrays fall back to lists."""
+        array = np.array(['a', None], dtype=object)
+        self.assertListEqual(['a', None], ArrayCodec(encoding='binary', threshold=0).encode(array))
@@ -0,0 +1,71 @@
+import io
+import os
+from os import path
+
+import rethinkdb as r
+
+from cxflow.tests.test_core import CXTestCaseWithDir
+from cxflow_rethinkdb.artifacts import download_artifact, list_artifacts, upload_artifact
+from cxflow_rethinkdb.utils import create_db, create_table
+
+CREDENTIALS = {'host': 'localhost', 'port': 28015, 'user': 'admin', 'password': ''}
+DB = 'rethinktest_artifacts'
+
+
+class ArtifactsTest(CXTestCaseWithDir):
+    """
+    Artifacts test.
+
+    RethinkDB must run and be accessible as described in the configuration above.
+    """
+
+    def setUp(self):
+        super().setUp()
+        create_db(credentials=CREDENTIALS, db_name=DB)
+        create_table(credentials=CREDENTIALS, db_name=DB, table_name='artifacts')
+        create_table(credentials=CREDENTIALS, db_name=DB, table_name='artifacts_chunks')
+        self._file = path.join(self.tmpdir, 'model.ckpt')
+        with open(self._file, 'wb') as file:
+            file.write(os.urandom(10 * 1024 + 1))
+
+    def tearDown(self):
+        super().tearDown()
+        with r.connect(**CREDENTIALS) as conn:
+            r.db_drop(DB).run(conn)
+
+    def _download(self) -> bytes:
+        output = io.BytesIO()
+        download_artifact(credentials=CREDENTIALS, db_name=DB, run_id='run', name='model.ckpt', output=output)
+        return output.getvalue()
+
+    def test_roundtrip(self):
+        """Test the uploaded artifact is listed and downloaded intact."""
+        document = upload_artifact(credentials=CREDENTIALS, db_name=DB, run_id='run', name='model.ckpt',
+                                   file_path=self._file, chunk_size=1024)
+        self.assertEqual(11, document['n_chunks'])
+        self.assertListEqual(['model.ckpt'], [artifact['name'] for artifact in
+                                              list_artifacts(credentials=CREDENTIALS, db_name=DB, run_id='run')])
+        with open(self._file, 'rb') as file:
+            self.assertEqual(file.read(), self._download())
+
+    def test_corrupted(self):
+        """Test the downloaded artifact is verified against the digest of its document."""
+        upload_artifact(credentials=CREDENTIALS, db_name=DB, run_id='run', name='model.ckpt', file_path=self._file,
+                        chunk_size=1024)
+        with r.connect(**CREDENTIALS) as conn:
+            r.db(DB).table('artifacts').get(['run', 'model.ckpt']).update({'sha256': '0' * 64}).run(conn)
+        self.assertRaises(ValueError, self._download)
+
+    def test_resume(self):
+        """Test an interrupted upload is resumed and the missing chunks are uploaded."""
+        upload_artifact(credentials=CREDENTIALS, db_name=DB, run_id='run', name='model.ckpt', file_path=self._file,
+                        chunk_size=1024)
+        with r.connect(**CREDENTIALS) as conn:
+            r.db(DB).table('artifacts').get(['run', 'model.ckpt']).update({'complete': False}).run(conn)
+            r.db(DB).table('artifacts_chunks').get([['run', 'model.ckpt'], 3]).delete().run(conn)
+        self.assertRaises(ValueError, self._download)
+
+        upload_artifact(credentials=CREDENTIALS, db_name=DB, run_id='run', name='model.ckpt', file_path=self._file,
+                        chunk_size=1024)
+        with open(self._file, 'rb') as file:
+            self.assertEqual(file.read(), self._download())
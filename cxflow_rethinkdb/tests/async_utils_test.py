@@ -0,0 +1,66 @@
+import asyncio
+
+import rethinkdb as r
+
+from cxflow.tests.test_core import CXTestCase
+from cxflow_rethinkdb import async_utils
+from cxflow_rethinkdb.utils import create_db, create_table, insert
+
+CREDENTIALS = {'host': 'localhost', 'port': 28015, 'user': 'admin', 'password': ''}
+DB = 'rethinktest_async'
+
+
+class AsyncUtilsTest(CXTestCase):
+    """
+    Asyncio utils test.
+
+    RethinkDB must run and be accessible as described in the configuration above.
+    """
+
+    def setUp(self):
+        super().setUp()
+        create_db(credentials=CREDENTIALS, db_name=DB)
+        create_table(credentials=CREDENTIALS, db_name=DB, table_name='runs')
+        insert(credentials=CREDENTIALS, db_name=DB, table_name='runs',
+               document=[{'id': str(i), 'value': i} for i in range(100)])
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+
+    def tearDown(self):
+        super().tearDown()
+        self._loop.close()
+        with r.connect(**CREDENTIALS) as conn:
+            r.db_drop(DB).run(conn)
+
+    def test_select_by_ids(self):
+        """Test the documents are returned in the order of the IDs and the blocking connections are unaffected."""
+        ids = [str(i) for i in reversed(range(100))] + ['missing']
+        documents = self._loop.run_until_complete(
+            async_utils.select_by_ids(credentials=CREDENTIALS, db_name=DB, table_name='runs', doc_ids=ids,
+                                      concurrency=8))
+        self.assertListEqual(list(reversed(range(100))), [document['value'] for document in documents[:-1]])
+        self.assertIsNone(documents[-1])
+        with r.connect(**CREDENTIALS) as conn:
+            self.assertIsInstance(conn, r.net.DefaultConnection)
+
+    def test_select_all(self):
+        """Test all the documents are iterated."""
+        async def collect():
+            values = []
+            async for document in async_utils.select_all(credentials=CREDENTIALS, db_name=DB, table_name='runs'):
+                values.append(document['value'])
+            return values
+
+        self.assertListEqual(list(range(100)), sorted(self._loop.run_until_complete(collect())))
+
+    def test_select_all_break(self):
+        """Test the connection is closed when the iteration is left early."""
+        async def first():
+            async with async_utils.select_all(credentials=CREDENTIALS, db_name=DB, table_name='runs') as documents:
+                async for document in documents:
+                    break
+            return documents
+
+        documents = self._loop.run_until_complete(first())
+        self.assertFalse(documents._conn.is_open())
+        self.assertRaises(StopAsyncIteration, self._loop.run_until_complete, documents.__anext__())
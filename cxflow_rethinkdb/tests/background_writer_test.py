@@ -0,0 +1,84 @@
+import threading
+import time
+
+from cxflow.tests.test_core import CXTestCase
+from cxflow_rethinkdb.background_writer import BackgroundWriter
+
+
+class BackgroundWriterTest(CXTestCase):
+    """Background writer test (no database is needed)."""
+
+    def setUp(self):
+        super().setUp()
+        self._batches = []
+        self._release = threading.Event()
+
+    def _write(self, batch):
+        """Record the written batch once released."""
+        self._release.wait()
+        self._batches.append(batch)
+
+    @staticmethod
+    def _wait_in_flight(writer):
+        """Wait until the first batch is taken by the writer thread."""
+        while not writer._in_flight:  # pylint: disable=protected-access
+            time.sleep(0.001)
+
+    def test_block(self):
+        """Test all the items are written in order with the block policy."""
+        self._release.set()
+        writer = BackgroundWriter(write_fn=self._write, max_queue_size=1, backpressure='block')
+        for i in range(10):
+            writer.put(i)
+        writer.close()
+
+        self.assertListEqual(list(range(10)), [item for batch in self._batches for item in batch])
+
+    def test_drop_oldest(self):
+        """Test the oldest pending items are dropped."""
+        writer = BackgroundWriter(write_fn=self._write, max_queue_size=2, backpressure='drop_oldest')
+        writer.put(0)
+        self._wait_in_flight(writer)
+        for i in range(1, 5):
+            writer.put(i)
+        self._release.set()
+        writer.close()
+
+        self.assertListEqual([[0], [3], [4]], self._batches)
+        self.assertEqual(2, writer.dropped)
+
+    def test_coalesce(self):
+        """Test the items put to the full queue are coalesced into the newest batch."""
+        writer = BackgroundWriter(write_fn=self._write, max_queue_size=2, backpressure='coalesce')
+        writer.put(0)
+        self._wait_in_flight(writer)
+        for i in range(1, 5):
+            writer.put(i)
+        self._release.set()
+        writer.close()
+
+        self.assertListEqual([[0], [1], [2, 3, 4]], self._batches)
+
+    def test_closed(self):
+        """Test putting to a closed writer raises."""
+        self._release.set()
+        writer = BackgroundWriter(write_fn=self._write)
+        writer.close()
+        writer.close()
+        with self.assertRaises(RuntimeError):
+            writer.put(0)
+
+    def test_failing_write(self):
+        """Test a failing write does not kill the writer thread."""
+        def write(batch):
+            if batch == [0]:
+                raise ValueError()
+            self._batches.append(batch)
+
+        writer = BackgroundWriter(write_fn=write)
+        writer.put(0)
+        writer.put(1)
+        writer.flush()
+        writer.close()
+
+        self.assertListEqual([[1]], self._batches)
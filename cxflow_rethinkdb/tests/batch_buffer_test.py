@@ -0,0 +1,44 @@
+import numpy as np
+
+from cxflow.tests.test_core import CXTestCase
+from cxflow_rethinkdb.batch_buffer import BatchBuffer, downsample_buckets, downsample_every_k, downsample_lttb
+
+
+class BatchBufferTest(CXTestCase):
+    """Batch buffer and downsampling test (no database is needed)."""
+
+    def test_every_k(self):
+        """Test every k-th value is kept."""
+        self.assertDictEqual(downsample_every_k(np.arange(10), np.arange(10.), 4),
+                             {'batch_ids': [0, 3, 6, 9], 'values': [0., 3., 6., 9.]})
+
+    def test_buckets(self):
+        """Test the bucket statistics."""
+        self.assertDictEqual(downsample_buckets(np.arange(6), np.array([1., 3., 2., 6., 5., 4.]), 2),
+                             {'batch_ids': [0, 3], 'min': [1., 4.], 'max': [3., 6.], 'mean': [2., 5.]})
+        self.assertEqual(len(downsample_buckets(np.arange(3), np.arange(3.), 10)['mean']), 3)
+
+    def test_lttb(self):
+        """Test LTTB keeps the end points and the spike."""
+        values = np.zeros(100)
+        values[42] = 10.
+        downsampled = downsample_lttb(np.arange(100), values, 5)
+        self.assertEqual(len(downsampled['values']), 5)
+        self.assertEqual(downsampled['batch_ids'][0], 0)
+        self.assertEqual(downsampled['batch_ids'][-1], 99)
+        self.assertIn(42, downsampled['batch_ids'])
+
+    def test_buffer(self):
+        """Test the buffer is emptied by reduce and the missing values are skipped."""
+        buffer = BatchBuffer(['loss', 'accuracy'], capacity=4, downsampling='every_k', points=10)
+        self.assertIsNone(buffer.reduce())
+        for batch_id in range(4):
+            buffer.append(batch_id, {'loss': float(batch_id)} if batch_id % 2 else {'loss': 0., 'accuracy': 1.})
+        self.assertTrue(buffer.full)
+        self.assertRaises(IndexError, buffer.append, 4, {})
+
+        chunk = buffer.reduce()
+        self.assertEqual(len(buffer), 0)
+        self.assertDictEqual(chunk, {'first_batch': 0, 'last_batch': 3, 'count': 4,
+                                     'variables': {'loss': {'batch_ids': [0, 1, 2, 3], 'values': [0., 1., 0., 3.]},
+                                                   'accuracy': {'batch_ids': [0, 2], 'values': [1., 1.]}}})
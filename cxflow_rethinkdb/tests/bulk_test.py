@@ -0,0 +1,73 @@
+import gzip
+import json
+import os
+from os import path
+from unittest import mock
+
+from cxflow.tests.test_core import CXTestCaseWithDir
+from cxflow_rethinkdb.bulk import bulk_insert, export_table, iter_documents
+
+CREDENTIALS = {'host': 'localhost', 'port': 28015, 'user': 'admin', 'password': ''}
+
+
+class BulkTest(CXTestCaseWithDir):
+    """Bulk import and export test (the database is mocked, no database is needed)."""
+
+    def setUp(self):
+        super().setUp()
+        os.makedirs(path.join(self.tmpdir, 'b'))
+        with open(path.join(self.tmpdir, 'a.json'), 'w') as file:
+            json.dump({'i': 0}, file)
+        with open(path.join(self.tmpdir, 'b', 'c.json'), 'w') as file:
+            json.dump([{'i': 1}, {'i': 2}], file)
+        with open(path.join(self.tmpdir, 'b', 'd.jsonl'), 'w') as file:
+            file.write('\n'.join(json.dumps({'i': i}) for i in range(3, 10)) + '\n')
+        with open(path.join(self.tmpdir, 'ignored.txt'), 'w') as file:
+            file.write('not a document')
+
+    def test_iter_documents(self):
+        """Test the documents are streamed from JSON files, JSONL files and directories."""
+        self.assertListEqual([{'i': 0}], list(iter_documents(path.join(self.tmpdir, 'a.json'))))
+        self.assertListEqual(list(range(3, 10)),
+                             [doc['i'] for doc in iter_documents(path.join(self.tmpdir, 'b', 'd.jsonl'))])
+        self.assertListEqual(list(range(10)), [doc['i'] for doc in iter_documents(self.tmpdir)])
+
+    def test_bulk_insert(self):
+        """Test the documents are inserted in batches and the errors are counted."""
+        batches = []
+
+        def insert(document, **kwargs):
+            batches.append(document)
+            self.assertEqual('soft', kwargs['durability'])
+            errors = 1 if any(doc['i'] == 9 for doc in document) else 0
+            return {'inserted': len(document) - errors, 'errors': errors, 'first_error': 'Duplicate primary key'}
+
+        pool = mock.MagicMock()
+        with mock.patch('cxflow_rethinkdb.bulk.insert', side_effect=insert):
+            result = bulk_insert(CREDENTIALS, 'db', 'table', iter_documents(self.tmpdir), batch_size=4, workers=2,
+                                 durability='soft', pool=pool)
+
+        self.assertDictEqual({'inserted': 9, 'errors': 1}, result)
+        self.assertListEqual([4, 4, 2], sorted((len(batch) for batch in batches), reverse=True))
+        self.assertListEqual(list(range(10)), sorted(doc['i'] for batch in batches for doc in batch))
+
+    def test_export_resume(self):
+        """Test the export writes gzip members with checkpoints and resumes after the last one."""
+        documents = [{'id': '{:02}'.format(i)} for i in range(7)]
+
+        def iter_table(start_after, **_):
+            for document in documents:
+                if start_after is None or document['id'] > start_after:
+                    yield document
+
+        output_file = path.join(self.tmpdir, 'export.jsonl.gz')
+        with mock.patch('cxflow_rethinkdb.bulk.iter_table', side_effect=iter_table):
+            self.assertEqual(7, export_table(CREDENTIALS, 'db', 'table', output_file, batch_size=3))
+            with open(output_file + '.checkpoint') as file:
+                self.assertEqual('06', json.load(file)['last_id'])
+
+            documents.append({'id': '07'})
+            self.assertEqual(1, export_table(CREDENTIALS, 'db', 'table', output_file, resume=True, batch_size=3))
+
+        with gzip.open(output_file, 'rt') as file:
+            self.assertListEqual(documents, [json.loads(line) for line in file])
@@ -0,0 +1,127 @@
+from datetime import datetime, timedelta
+import gzip
+import json
+from os import path
+from unittest import mock
+
+import pytz
+import rethinkdb as r
+
+from cxflow.tests.test_core import CXTestCase, CXTestCaseWithDir
+from cxflow_rethinkdb.compact import _selector, archive_runs, downsample_runs, drop_variables
+from cxflow_rethinkdb.utils import create_db, create_table, insert, insert_epochs
+
+CREDENTIALS = {'host': 'localhost', 'port': 28015, 'user': 'admin', 'password': ''}
+DB = 'rethinktest_compact'
+CREATED = datetime(2017, 7, 14, tzinfo=pytz.utc)
+ACCURACIES = [.1, .2, .3, .9, .4, .5, .5, .6, .6, .7, .7, .8]
+KEPT = [0, 3, 5, 10, 11]  # the last two, the best one and every fifth epoch
+
+
+def _items(accuracies: list, created: datetime=CREATED) -> list:
+    """Create the training items with the given accuracies (and a bulky histogram)."""
+    return [{'epoch_id': epoch_id, 'timestamp': created + timedelta(minutes=epoch_id),
+             'epoch_data': {'valid': {'accuracy': {'mean': accuracy}}, 'train': {'loss': 1., 'histogram': [1, 2]}}}
+            for epoch_id, accuracy in enumerate(accuracies)]
+
+
+class CompactTest(CXTestCase):
+    """Compaction helpers test (no database is needed)."""
+
+    def test_selector(self):
+        """Test the variable paths are merged to a single nested selector."""
+        self.assertDictEqual(_selector(['train/histogram', 'train/loss/max', 'test/images']),
+                             {'train': {'histogram': True, 'loss': {'max': True}}, 'test': {'images': True}})
+
+
+class CompactDBTest(CXTestCaseWithDir):
+    """
+    Compaction test of the runs stored in a document, in the epochs table and shared by two workers.
+
+    RethinkDB must run and be accessible as described in the configuration above.
+    """
+
+    def setUp(self):
+        super().setUp()
+        create_db(credentials=CREDENTIALS, db_name=DB)
+        create_table(credentials=CREDENTIALS, db_name=DB, table_name='runs')
+        create_table(credentials=CREDENTIALS, db_name=DB, table_name='runs_epochs')
+        insert(credentials=CREDENTIALS, db_name=DB, table_name='runs', document=[
+            {'id': 'document', 'user': 'user', 'timestamp': CREATED, 'training': _items(ACCURACIES)},
+            {'id': 'epochs', 'user': 'user', 'timestamp': CREATED, 'training': [], 'epochs_table': 'runs_epochs'},
+            {'id': 'shared', 'user': 'user', 'timestamp': CREATED, 'training': [], 'epochs_table': 'runs_epochs',
+             'shared': True}])
+        insert_epochs(credentials=CREDENTIALS, db_name=DB, epochs_table='runs_epochs', run_id='epochs',
+                      items=_items(ACCURACIES))
+        # only the rank 1 reports the metric, the best epoch must be selected from the merged epoch data
+        rank0 = [dict(item, epoch_data={'train': item['epoch_data']['train']}) for item in _items(ACCURACIES)]
+        insert_epochs(credentials=CREDENTIALS, db_name=DB, epochs_table='runs_epochs', run_id='shared', items=rank0,
+                      rank=0)
+        insert_epochs(credentials=CREDENTIALS, db_name=DB, epochs_table='runs_epochs', run_id='shared',
+                      items=_items(ACCURACIES), rank=1)
+        self._now = datetime.now(pytz.utc)
+
+    def tearDown(self):
+        super().tearDown()
+        with r.connect(**CREDENTIALS) as conn:
+            r.db_drop(DB).run(conn)
+
+    def _epoch_ids(self, run_id: str) -> list:
+        """The epoch ids stored for the given run (in the document and the epochs table)."""
+        with r.connect(**CREDENTIALS) as conn:
+            training = r.db(DB).table('runs').get(run_id)['training']['epoch_id'].run(conn)
+            epochs = r.db(DB).table('runs_epochs').between([run_id, r.minval], [run_id, r.maxval], index='id')\
+                .order_by(index='id')['epoch_id'].run(conn)
+        return sorted(training + list(epochs))
+
+    def test_downsample(self):
+        """Test the last, the best and every n-th epochs are kept in all the storage modes."""
+        self.assertEqual(3, downsample_runs(credentials=CREDENTIALS, db_name=DB, table_name='runs', keep_last=2,
+                                            keep_best=1, metric='valid/accuracy/mean', every=5, until=self._now))
+        self.assertListEqual(KEPT, self._epoch_ids('document'))
+        self.assertListEqual(KEPT, self._epoch_ids('epochs'))
+        self.assertListEqual(sorted(KEPT * 2), self._epoch_ids('shared'))
+
+    def test_until(self):
+        """Test the runs created after the cutoff are not compacted."""
+        self.assertEqual(0, downsample_runs(credentials=CREDENTIALS, db_name=DB, table_name='runs', keep_last=2,
+                                            until=CREATED))
+        self.assertListEqual(list(range(12)), self._epoch_ids('document'))
+
+    def test_drop_variables(self):
+        """Test the variables are removed from all the epochs."""
+        self.assertEqual(3, drop_variables(credentials=CREDENTIALS, db_name=DB, table_name='runs',
+                                           variables=['train/histogram'], until=self._now))
+        with r.connect(**CREDENTIALS) as conn:
+            trains = list(r.db(DB).table('runs')['training'].concat_map(lambda training: training)
+                          .union(r.db(DB).table('runs_epochs'))['epoch_data']['train'].run(conn))
+        self.assertEqual(12 * 4, len(trains))
+        self.assertTrue(all(train == {'loss': 1.} for train in trains))
+
+    def test_archive(self):
+        """Test the runs are archived with their training rebuilt and deleted; the running ones are skipped."""
+        insert(credentials=CREDENTIALS, db_name=DB, table_name='runs', document={
+            'id': 'running', 'user': 'user', 'timestamp': CREATED, 'training': _items([.1], self._now)})
+        archive_dir = path.join(self.tmpdir, 'archive')
+        self.assertEqual(3, archive_runs(credentials=CREDENTIALS, db_name=DB, table_name='runs',
+                                         archive_dir=archive_dir, until=self._now - timedelta(days=1)))
+
+        for run_id in ['document', 'epochs', 'shared']:
+            with gzip.open(path.join(archive_dir, '{}.json.gz'.format(run_id)), 'rt', encoding='utf-8') as file:
+                document = json.load(file)
+            self.assertEqual(run_id, document['id'])
+            self.assertListEqual(list(range(12)), [item['epoch_id'] for item in document['training']])
+            self.assertEqual(.9, document['training'][3]['epoch_data']['valid']['accuracy']['mean'])
+        self.assertFalse(path.exists(path.join(archive_dir, 'running.json.gz')))
+        with r.connect(**CREDENTIALS) as conn:
+            self.assertListEqual(['running'], list(r.db(DB).table('runs')['id'].run(conn)))
+            self.assertEqual(0, r.db(DB).table('runs_epochs').count().run(conn))
+
+    def test_archive_failure(self):
+        """Test the runs are kept if their archive could not be written."""
+        with mock.patch('cxflow_rethinkdb.compact.json.dump', side_effect=OSError('No space left on device')):
+            self.assertRaises(OSError, archive_runs, credentials=CREDENTIALS, db_name=DB, table_name='runs',
+                              archive_dir=path.join(self.tmpdir, 'archive'), until=self._now)
+        with r.connect(**CREDENTIALS) as conn:
+            self.assertEqual(3, r.db(DB).table('runs').count().run(conn))
+            self.assertEqual(12 * 3, r.db(DB).table('runs_epochs').count().run(conn))
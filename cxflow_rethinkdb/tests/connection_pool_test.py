@@ -0,0 +1,85 @@
+from unittest import mock
+
+import rethinkdb as r
+
+from cxflow.tests.test_core import CXTestCase
+from cxflow_rethinkdb.connection_pool import ConnectionPool, get_pool, close_pools
+
+CREDENTIALS = {'host': 'localhost', 'port': 28015, 'user': 'admin', 'password': ''}
+
+
+class ConnectionPoolTest(CXTestCase):
+    """Connection pool test (the connections are mocked, no database is needed)."""
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch('rethinkdb.connect', side_effect=lambda **_: mock.MagicMock())
+        self._connect = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reuse(self):
+        """Test a released connection is reused."""
+        pool = ConnectionPool(CREDENTIALS)
+        with pool.connection() as conn1:
+            pass
+        with pool.connection() as conn2:
+            pass
+
+        self.assertIs(conn1, conn2)
+        self.assertEqual(1, self._connect.call_count)
+        self.assertEqual(1, pool.size)
+
+    def test_max_size(self):
+        """Test the pool does not open more than `max_size` connections."""
+        pool = ConnectionPool(CREDENTIALS, max_size=2)
+        conn1 = pool.acquire()
+        conn2 = pool.acquire()
+        self.assertIsNot(conn1, conn2)
+
+        with self.assertRaises(TimeoutError):
+            pool.acquire(timeout=0.01)
+
+        pool.release(conn1)
+        self.assertIs(conn1, pool.acquire(timeout=0.01))
+
+    def test_reconnect(self):
+        """Test a closed connection is reconnected before it is handed out."""
+        pool = ConnectionPool(CREDENTIALS)
+        with pool.connection() as conn:
+            pass
+        conn.is_open.return_value = False
+
+        with pool.connection():
+            pass
+        conn.reconnect.assert_called_once_with(noreply_wait=False)
+
+    def test_retry(self):
+        """Test the connection is retried with a backoff."""
+        attempts = []
+
+        def connect(**_):
+            attempts.append(None)
+            if len(attempts) < 3:
+                raise r.ReqlDriverError('Connection refused')
+            return mock.MagicMock()
+
+        self._connect.side_effect = connect
+        pool = ConnectionPool(CREDENTIALS, max_retries=3, backoff=0.001)
+        with pool.connection():
+            pass
+        self.assertEqual(3, len(attempts))
+
+        attempts.clear()
+        pool = ConnectionPool(CREDENTIALS, max_retries=2, backoff=0.001)
+        with self.assertRaises(r.ReqlDriverError):
+            pool.acquire()
+        self.assertEqual(0, pool.size)
+
+    def test_get_pool(self):
+        """Test the pools are shared per credentials."""
+        pool = get_pool(CREDENTIALS)
+        self.assertIs(pool, get_pool(dict(CREDENTIALS)))
+        self.assertIsNot(pool, get_pool(dict(CREDENTIALS, user='another')))
+        close_pools()
+        self.assertIsNot(pool, get_pool(CREDENTIALS))
+        close_pools()
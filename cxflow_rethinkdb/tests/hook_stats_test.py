@@ -0,0 +1,31 @@
+import json
+
+import rethinkdb as r
+
+from cxflow.tests.test_core import CXTestCase
+from cxflow_rethinkdb.hook_stats import HookStats
+
+
+class HookStatsTest(CXTestCase):
+    """Hook statistics test (no database is needed)."""
+
+    def test_summary(self):
+        """Test the rolling window and the totals."""
+        stats = HookStats(window=2)
+        self.assertDictEqual(stats.summary(), {})
+        for value in [1., 5., 3.]:
+            stats.record('query', value)
+        self.assertDictEqual(stats.summary(), {'query': {'last': 3., 'mean': 4., 'max': 5., 'total': 9., 'count': 3}})
+
+        with stats.timer('serialize'):
+            pass
+        self.assertEqual(stats.summary()['serialize']['count'], 1)
+
+    def test_json_encoder(self):
+        """Test the encoder records the size of the serialized query."""
+        stats = HookStats()
+        query = r.db('db').table('table').get('id')
+        encoded = stats.json_encoder()().encode(query)
+        self.assertEqual(json.loads(encoded), json.loads(r.ast.ReQLEncoder().encode(query)))
+        self.assertEqual(stats.summary()['bytes_sent']['last'], len(encoded))
+        self.assertIs(stats.json_encoder(), stats.json_encoder())
@@ -0,0 +1,35 @@
+import subprocess
+import sys
+from typing import Dict, List, Tuple, get_type_hints
+
+import numpy as np
+
+from cxflow.tests.test_core import CXTestCase
+
+
+class LazyImportTest(CXTestCase):
+    """Test the CLI and utils do not import the heavy dependencies of the hook."""
+
+    def test_cli(self):
+        """Test importing the CLI and utils imports neither cxflow, numpy, yaml nor pytz."""
+        imported = subprocess.check_output([sys.executable, '-W', 'ignore', '-c',
+                                            'import sys, cxflow_rethinkdb.cli, cxflow_rethinkdb.utils; '
+                                            'print(*sorted({"cxflow", "numpy", "yaml", "pytz"} & set(sys.modules)))'])
+        self.assertEqual(b'', imported.strip())
+
+    def test_hook(self):
+        """Test the hook is resolved on the first access."""
+        import cxflow_rethinkdb
+        from cxflow_rethinkdb.rethinkdb_hook import RethinkDBHook
+        self.assertIs(RethinkDBHook, cxflow_rethinkdb.RethinkDBHook)
+        self.assertIn('RethinkDBHook', dir(cxflow_rethinkdb))
+        self.assertRaises(AttributeError, getattr, cxflow_rethinkdb, 'NoSuchHook')
+
+    def test_type_hints(self):
+        """Test the numpy annotations of the lazily importing functions are resolved once numpy is provided."""
+        from cxflow_rethinkdb.mirror import LocalMirror
+        from cxflow_rethinkdb.utils import _metric_matrices, select_metrics
+        matrices = Dict[str, np.ndarray]
+        self.assertEqual(matrices, get_type_hints(_metric_matrices, localns={'np': np})['return'])
+        for function in (select_metrics, LocalMirror.select_metrics):
+            self.assertEqual(Tuple[List[str], matrices], get_type_hints(function, localns={'np': np})['return'])
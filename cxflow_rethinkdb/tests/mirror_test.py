@@ -0,0 +1,115 @@
+from datetime import datetime
+
+import numpy as np
+import pytz
+import rethinkdb as r
+
+from cxflow.tests.test_core import CXTestCaseWithDir
+from cxflow_rethinkdb.mirror import LocalMirror, _epoch_seconds
+from cxflow_rethinkdb.utils import _stamp, append_training, create_db, create_table, insert, insert_epochs
+
+CREDENTIALS = {'host': 'localhost', 'port': 28015, 'user': 'admin', 'password': ''}
+DB = 'rethinktest_mirror'
+
+_TIME = {'$reql_type$': 'TIME', 'epoch_time': 1500000000., 'timezone': '+00:00'}
+
+
+def _run(run_id: str, user: str, epoch_time: float, accuracies: list) -> dict:
+    """Create a raw-format run document."""
+    return {'id': run_id, 'user': user, 'timestamp': dict(_TIME, epoch_time=epoch_time),
+            'training': [{'epoch_id': epoch_id, 'timestamp': dict(_TIME, epoch_time=epoch_time + epoch_id),
+                          'epoch_data': {'test': {'accuracy': {'mean': accuracy}}}}
+                         for epoch_id, accuracy in enumerate(accuracies)]}
+
+
+class LocalMirrorTest(CXTestCaseWithDir):
+    """Local mirror read API test (no database is needed)."""
+
+    def setUp(self):
+        super().setUp()
+        self._mirror = LocalMirror(self.tmpdir)
+        self._mirror._store('db', 'runs', [_run('a', 'alice', 1500000000., [.5, .6]),
+                                           _run('b', 'bob', 1500000100., [.7])])
+
+    def tearDown(self):
+        self._mirror.close()
+        super().tearDown()
+
+    def test_select(self):
+        """Test the mirrored documents are decoded and filtered."""
+        run = self._mirror.select_by_id('db', 'runs', 'a')
+        self.assertEqual(datetime.fromtimestamp(1500000001., pytz.utc), run['training'][1]['timestamp'])
+        self.assertRaises(KeyError, self._mirror.select_by_id, 'db', 'other', 'a')
+        self.assertListEqual(['b'], [run['id'] for run in self._mirror.select_all('db', 'runs', user='bob')])
+        self.assertListEqual(['a'], [run['id'] for run in
+                                     self._mirror.select_all('db', 'runs', until='2017-07-14T02:41:00Z')])
+
+    def test_metrics(self):
+        """Test the metric matrices are served from the mirror."""
+        run_ids, matrices = self._mirror.select_metrics('db', 'runs', ['test/accuracy/mean'], run_ids=['b', 'a'])
+        self.assertListEqual(['b', 'a'], run_ids)
+        np.testing.assert_array_equal(np.array([[.7, np.nan], [.5, .6]]), matrices['test/accuracy/mean'])
+
+    def test_epoch_seconds(self):
+        """Test the ISO 8601 strings are converted (UTC by default)."""
+        self.assertEqual(1500000000., _epoch_seconds('2017-07-14T02:40:00'))
+        self.assertEqual(1500000000., _epoch_seconds('2017-07-14T04:40:00+02:00'))
+        self.assertEqual(1500000000., _epoch_seconds(datetime.fromtimestamp(1500000000., pytz.utc)))
+        self.assertRaises(ValueError, _epoch_seconds, 'yesterday')
+
+
+class LocalMirrorSyncTest(CXTestCaseWithDir):
+    """
+    Incremental synchronization test.
+
+    RethinkDB must run and be accessible as described in the configuration above.
+    """
+
+    def setUp(self):
+        super().setUp()
+        create_db(credentials=CREDENTIALS, db_name=DB)
+        for table_name in ['runs', 'runs_epochs']:
+            create_table(credentials=CREDENTIALS, db_name=DB, table_name=table_name)
+            with r.connect(**CREDENTIALS) as conn:
+                r.db(DB).table(table_name).index_create('modified').run(conn)
+                r.db(DB).table(table_name).index_wait().run(conn)
+        # the writer timestamps are years old, as if the writes were spooled
+        self._created = datetime.fromtimestamp(1500000000., pytz.utc)
+        insert(credentials=CREDENTIALS, db_name=DB, table_name='runs', document=[_stamp(run) for run in [
+            {'id': 'document', 'user': 'alice', 'timestamp': self._created, 'training': [self._item(0)]},
+            {'id': 'epochs', 'user': 'alice', 'timestamp': self._created, 'training': [],
+             'epochs_table': 'runs_epochs'}]])
+        insert_epochs(credentials=CREDENTIALS, db_name=DB, epochs_table='runs_epochs', run_id='epochs',
+                      items=[self._item(0)])
+        self._mirror = LocalMirror(self.tmpdir)
+
+    def tearDown(self):
+        self._mirror.close()
+        super().tearDown()
+        with r.connect(**CREDENTIALS) as conn:
+            r.db_drop(DB).run(conn)
+
+    def _item(self, epoch_id: int) -> dict:
+        """Create a training item."""
+        return {'epoch_id': epoch_id, 'timestamp': self._created, 'epoch_data': {'test': {'accuracy': .5}}}
+
+    def _sync(self) -> int:
+        """Synchronize the runs table."""
+        return self._mirror.sync(credentials=CREDENTIALS, db_name=DB, table_name='runs', overlap=0.)
+
+    def test_sync(self):
+        """Test only the runs updated since the last synchronization are shipped."""
+        self.assertEqual(2, self._sync())
+        self.assertEqual(0, self._sync())
+
+        insert_epochs(credentials=CREDENTIALS, db_name=DB, epochs_table='runs_epochs', run_id='epochs',
+                      items=[self._item(1)])
+        self.assertEqual(1, self._sync())
+        self.assertListEqual([0, 1], [item['epoch_id'] for item in
+                                      self._mirror.select_by_id(DB, 'runs', 'epochs')['training']])
+
+        append_training(credentials=CREDENTIALS, db_name=DB, table_name='runs', run_id='document',
+                        items=[self._item(1)])
+        self.assertEqual(1, self._sync())
+        self.assertListEqual([0, 1], [item['epoch_id'] for item in
+                                      self._mirror.select_by_id(DB, 'runs', 'document')['training']])
@@ -0,0 +1,108 @@
+from os import path
+
+import rethinkdb as r
+import yaml
+
+from cxflow.tests.test_core import CXTestCaseWithDir
+from cxflow_rethinkdb.provision import _index_definition, _printed_definition, apply_manifest, load_manifest, \
+    validate_manifest
+
+CREDENTIALS = {'host': 'localhost', 'port': 28015, 'user': 'admin', 'password': ''}
+DB = 'rethinktest_provision'
+
+_MANIFEST = """
+databases:
+  rethinktest_provision:
+    tables:
+      runs:
+        shards: 2
+        indexes:
+          user: user
+          user_timestamp: [user, timestamp]
+      runs_epochs:
+users:
+  my_user:
+    password: secret
+grants:
+  - {user: my_user, db: rethinktest_provision, permissions: {read: true}}
+"""
+
+
+class ProvisionTest(CXTestCaseWithDir):
+    """Manifest loading and validation test (no database is needed)."""
+
+    def test_load(self):
+        """Test a valid manifest is loaded."""
+        manifest_file = path.join(self.tmpdir, 'manifest.yaml')
+        with open(manifest_file, 'w') as file:
+            file.write(_MANIFEST)
+        manifest = load_manifest(manifest_file)
+        self.assertListEqual(['user', 'timestamp'],
+                             manifest['databases'][DB]['tables']['runs']['indexes']['user_timestamp'])
+
+    def test_invalid(self):
+        """Test the invalid manifests are refused."""
+        self.assertRaises(ValueError, validate_manifest, {'tables': {}})
+        self.assertRaises(ValueError, validate_manifest, {'databases': {'db': {'tables': {'t': {'shard': 2}}}}})
+        self.assertRaises(ValueError, validate_manifest,
+                          {'databases': {'db': {'tables': {'t': {'indexes': {'i': []}}}}}})
+        self.assertRaises(ValueError, validate_manifest, {'users': {'my_user': {}}})
+        self.assertRaises(ValueError, validate_manifest, {'grants': [{'user': 'my_user', 'db': 'db'}]})
+
+    def test_index_definition(self):
+        """Test the index definitions printed by the server are compared with the manifest."""
+        self.assertEqual(_index_definition('user'),
+                         _printed_definition("indexCreate('user', function(var1) { return var1('user'); })"))
+        self.assertEqual(_index_definition('config/model'),
+                         _printed_definition('indexCreate("m", function(var3) { return var3("config")("model"); })'))
+        self.assertEqual(_index_definition(['user', 'timestamp']), _printed_definition(
+            "indexCreate('user_timestamp', function(var1) { return [var1('user'), var1('timestamp')]; })"))
+        self.assertNotEqual(_index_definition('name'),
+                            _printed_definition("indexCreate('user', function(var1) { return var1('user'); })"))
+        self.assertNotEqual(_index_definition(['config', 'model']),
+                            _printed_definition("indexCreate('m', function(var1) { return var1('config')('model'); })"))
+        self.assertIsNone(_printed_definition(''))
+
+
+class ProvisionDBTest(CXTestCaseWithDir):
+    """
+    Manifest application test.
+
+    RethinkDB must run and be accessible as described in the configuration above.
+    """
+
+    def tearDown(self):
+        super().tearDown()
+        with r.connect(**CREDENTIALS) as conn:
+            r.db_drop(DB).run(conn)
+            r.db('rethinkdb').table('users').get('my_user').delete().run(conn)
+
+    def test_apply_twice(self):
+        """Test the manifest is applied and applying it again changes nothing."""
+        manifest = yaml.safe_load(_MANIFEST)
+        summary = apply_manifest(credentials=CREDENTIALS, manifest=manifest)
+        self.assertListEqual([DB], summary['databases'])
+        self.assertListEqual(['{}.runs'.format(DB), '{}.runs_epochs'.format(DB)], summary['tables'])
+        self.assertListEqual(['{}.runs.user'.format(DB), '{}.runs.user_timestamp'.format(DB)], summary['indexes'])
+        self.assertListEqual(['my_user'], summary['users'])
+        self.assertListEqual(['my_user@{}.None'.format(DB)], summary['grants'])
+
+        summary = apply_manifest(credentials=CREDENTIALS, manifest=manifest)
+        self.assertTrue(all(not names for names in summary.values()), summary)
+
+        with r.connect(**CREDENTIALS) as conn:
+            self.assertListEqual(['user', 'user_timestamp'], sorted(r.db(DB).table('runs').index_list().run(conn)))
+            self.assertEqual(2, len(r.db(DB).table('runs').config().run(conn)['shards']))
+            permissions = list(r.db('rethinkdb').table('permissions').filter({'user': 'my_user', 'database': DB})
+                               .run(conn))
+        self.assertEqual(1, len(permissions))
+        self.assertDictEqual({'read': True}, permissions[0]['permissions'])
+
+    def test_changed_index(self):
+        """Test an existing index with a different definition is refused."""
+        manifest = yaml.safe_load(_MANIFEST)
+        apply_manifest(credentials=CREDENTIALS, manifest=manifest)
+        manifest['databases'][DB]['tables']['runs']['indexes']['user'] = 'name'
+        self.assertRaises(ValueError, apply_manifest, credentials=CREDENTIALS, manifest=manifest)
+        with r.connect(**CREDENTIALS) as conn:
+            self.assertListEqual(['user', 'user_timestamp'], sorted(r.db(DB).table('runs').index_list().run(conn)))
@@ -1,11 +1,16 @@
+import atexit
 import json
 from os import path
+import socket
+import time
 
+import numpy as np
 import rethinkdb as r
 
 from cxflow.tests.test_core import CXTestCaseWithDir
 from cxflow_rethinkdb import RethinkDBHook
-from cxflow_rethinkdb.utils import create_db, create_table, select_by_id
+from cxflow_rethinkdb.utils import config_hash, create_db, create_table, select_batches, select_by_id, select_metrics, \
+    select_run
 
 HOST = 'localhost'
 PORT = 28015
@@ -13,6 +18,8 @@ USER = 'admin'
 PASSWORD = ''
 DB = 'rethinktest'
 TABLE = 'tabletest'
+EPOCHS_TABLE = 'tabletest_epochs'
+BATCHES_TABLE = 'tabletest_batches'
 
 CONFIG = {'a': 'b', 'c': ['d', 'e']}
 
@@ -44,6 +51,8 @@ class RethinkDBHookTest(CXTestCaseWithDir):
 
         create_db(credentials=self._credentials, db_name=DB)
         create_table(credentials=self._credentials, db_name=DB, table_name=TABLE)
+        create_table(credentials=self._credentials, db_name=DB, table_name=EPOCHS_TABLE)
+        create_table(credentials=self._credentials, db_name=DB, table_name=BATCHES_TABLE)
 
         with open(path.join(self.tmpdir, self._credentials_file), 'w') as cred_f:
             json.dump(self._credentials, cred_f)
@@ -57,13 +66,15 @@ class RethinkDBHookTest(CXTestCaseWithDir):
 
         with r.connect(**self._credentials) as conn:
             r.db(DB).table_drop(TABLE).run(conn)
+            r.db(DB).table_drop(EPOCHS_TABLE).run(conn)
+            r.db(DB).table_drop(BATCHES_TABLE).run(conn)
             r.db_drop(DB).run(conn)
 
-    def _create_hook(self, rethink_key_file, variables=None):
+    def _create_hook(self, rethink_key_file, variables=None, **kwargs):
         """Create the hook."""
         return RethinkDBHook(output_dir=self.tmpdir, credentials_file=path.join(self.tmpdir, self._credentials_file),
                              db=DB, table=TABLE, rethink_key_file=rethink_key_file, variables=variables,
-                             on_unknown_type='error')
+                             on_unknown_type='error', **kwargs)
 
     def test_id_file(self):
         """Test the document id is correctly dumped."""
@@ -137,3 +148,166 @@ class RethinkDBHookTest(CXTestCaseWithDir):
 
         self.assertTrue('bb' not in document['training'][0]['epoch_data']['train'])
         self.assertTrue('bb' not in document['training'][0]['epoch_data']['test'])
+
+    def test_structure_change(self):
+        """Test the serialization plan is recompiled when the structure of the epoch data changes."""
+        hook = self._create_hook(rethink_key_file='rethink_key.json')
+        self.assertDictEqual(hook._build_data_dict({'train': {'loss': np.float32(1), 'acc': {'mean': 2.}}}),
+                             {'train': {'loss': 1., 'acc': {'mean': 2.}}})
+        self.assertDictEqual(hook._build_data_dict({'train': {'loss': 1, 'acc': {'mean': 2., 'std': 3.}}}),
+                             {'train': {'loss': 1, 'acc': {'mean': 2., 'std': 3.}}})
+        self.assertDictEqual(hook._build_data_dict({'train': {'loss': np.arange(2)}, 'test': {}}),
+                             {'train': {'loss': [0, 1]}, 'test': {}})
+        hook.after_training()
+
+    def test_epochs_storage(self):
+        """Test saving the epoch data as separate epoch documents."""
+
+        hook = self._create_hook(rethink_key_file='rethink_key.json', storage='epochs')
+        for epoch_id in range(3):
+            hook.after_epoch(epoch_id=epoch_id, epoch_data={'train': {'aa': {'mean': float(epoch_id)}}})
+
+        document = select_by_id(credentials=self._credentials, db_name=DB, table_name=TABLE, doc_id=hook._rethink_id)
+        self.assertListEqual([], document['training'])
+        self.assertEqual(EPOCHS_TABLE, document['epochs_table'])
+
+        document = select_run(credentials=self._credentials, db_name=DB, table_name=TABLE, run_id=hook._rethink_id)
+        self.assertListEqual([0, 1, 2], [item['epoch_id'] for item in document['training']])
+        self.assertDictContainsSubset({'epoch_data': {'train': {'aa': {'mean': 2.0}}}, 'epoch_id': 2},
+                                      document['training'][2])
+
+    def test_shared_run(self):
+        """Test the workers sharing the output directory log to a single run merged at read time."""
+
+        hooks = [self._create_hook(rethink_key_file='rethink_key.json', shared_run=True, rank=rank)
+                 for rank in range(2)]
+        self.assertEqual(hooks[0]._rethink_id, hooks[1]._rethink_id)
+        for rank, hook in enumerate(hooks):
+            hook.after_epoch(epoch_id=0, epoch_data={'train': {'loss': float(rank), 'rank{}'.format(rank): 1.}})
+            hook.after_training()
+
+        document = select_run(credentials=self._credentials, db_name=DB, table_name=TABLE, run_id=hooks[0]._rethink_id)
+        self.assertTrue(document['shared'])
+        self.assertEqual(1, len(document['training']))
+        self.assertListEqual([0, 1], document['training'][0]['ranks'])
+        self.assertDictEqual({'train': {'loss': 0., 'rank0': 1., 'rank1': 1.}}, document['training'][0]['epoch_data'])
+        self.assertDictEqual({'train': {'loss': 1., 'rank1': 1.}},
+                             document['training'][0]['epoch_data_by_rank']['1'])
+
+    def test_dedup_config(self):
+        """Test the config is stored once and rehydrated on select."""
+
+        create_table(credentials=self._credentials, db_name=DB, table_name='configs')
+        hooks = [self._create_hook(rethink_key_file='rethink_key{}.json'.format(i), dedup_config=True)
+                 for i in range(2)]
+
+        document = select_by_id(credentials=self._credentials, db_name=DB, table_name=TABLE,
+                                doc_id=hooks[0]._rethink_id)
+        self.assertNotIn('config', document)
+        self.assertEqual(config_hash(CONFIG), document['config_hash'])
+        with r.connect(**self._credentials) as conn:
+            self.assertEqual(1, r.db(DB).table('configs').count().run(conn))
+
+        document = select_by_id(credentials=self._credentials, db_name=DB, table_name=TABLE,
+                                doc_id=hooks[1]._rethink_id, rehydrate_config=True)
+        self.assertDictEqual(CONFIG, document['config'])
+
+    def test_flush_every_epochs(self):
+        """Test the epoch data are buffered and stored in batches."""
+
+        hook = self._create_hook(rethink_key_file='rethink_key.json', flush_every_epochs=2)
+        for epoch_id in range(3):
+            hook.after_epoch(epoch_id=epoch_id, epoch_data={'train': {'aa': {'mean': float(epoch_id)}}})
+
+        document = select_by_id(credentials=self._credentials, db_name=DB, table_name=TABLE, doc_id=hook._rethink_id)
+        self.assertListEqual([0, 1], [item['epoch_id'] for item in document['training']])
+
+        hook.after_training()
+        document = select_by_id(credentials=self._credentials, db_name=DB, table_name=TABLE, doc_id=hook._rethink_id)
+        self.assertListEqual([0, 1, 2], [item['epoch_id'] for item in document['training']])
+
+    def _select_batch_counts(self, hook, stream_name):
+        """Select the numbers of batches in the stored chunks of the given stream."""
+        return [chunk['count'] for chunk in select_batches(credentials=self._credentials, db_name=DB,
+                                                           batches_table=BATCHES_TABLE, run_id=hook._rethink_id,
+                                                           stream_name=stream_name)]
+
+    def test_batches_full(self):
+        """Test the batches are stored once the buffer is full and the rest of them after the training."""
+
+        hook = self._create_hook(rethink_key_file='rethink_key.json', log_batches=True, batch_buffer_size=4,
+                                 batch_points=4, batch_flush_seconds=1000)
+        for batch_id in range(6):
+            hook.after_batch(stream_name='train', batch_data={'loss': [float(batch_id), 1.]})
+        self.assertListEqual([4], self._select_batch_counts(hook, 'train'))
+
+        hook.after_training()
+        self.assertListEqual([4, 2], self._select_batch_counts(hook, 'train'))
+        chunks = select_batches(credentials=self._credentials, db_name=DB, batches_table=BATCHES_TABLE,
+                                run_id=hook._rethink_id, stream_name='train')
+        self.assertListEqual([0, 4], [chunk['first_batch'] for chunk in chunks])
+        self.assertListEqual([0.5, 1.0, 1.5, 2.0], chunks[0]['variables']['loss']['mean'])
+
+    def test_batches_flush_seconds(self):
+        """Test the batches of each stream are stored once its last chunk is older than ``batch_flush_seconds``."""
+
+        hook = self._create_hook(rethink_key_file='rethink_key.json', log_batches=True, batch_flush_seconds=0.5)
+        hook.after_batch(stream_name='train', batch_data={'loss': [1.]})
+        time.sleep(0.3)
+        hook.after_batch(stream_name='valid', batch_data={'loss': [2.]})
+        time.sleep(0.3)
+        hook.after_batch(stream_name='train', batch_data={'loss': [3.]})
+        self.assertListEqual([2], self._select_batch_counts(hook, 'train'))
+        self.assertListEqual([], self._select_batch_counts(hook, 'valid'))
+
+        time.sleep(0.3)
+        hook.after_batch(stream_name='valid', batch_data={'loss': [4.]})  # flushing `train` must not delay `valid`
+        self.assertListEqual([2], self._select_batch_counts(hook, 'valid'))
+
+        hook.after_training()
+        self.assertListEqual([2], self._select_batch_counts(hook, 'train'))
+        self.assertListEqual([2], self._select_batch_counts(hook, 'valid'))
+
+    def test_select_metrics(self):
+        """Test selecting the metric matrices of multiple runs."""
+
+        hook1 = self._create_hook(rethink_key_file='rethink_key.json')
+        hook2 = self._create_hook(rethink_key_file='rethink_key.json', storage='epochs')
+        for epoch_id in range(3):
+            hook1.after_epoch(epoch_id=epoch_id, epoch_data={'test': {'aa': {'mean': float(epoch_id)}}})
+        hook2.after_epoch(epoch_id=1, epoch_data={'test': {'aa': {'mean': 5.0}}})
+
+        run_ids, matrices = select_metrics(credentials=self._credentials, db_name=DB, table_name=TABLE,
+                                           metrics=['test/aa/mean', 'test/bb/mean'],
+                                           run_ids=[hook2._rethink_id, hook1._rethink_id])
+        self.assertListEqual([hook2._rethink_id, hook1._rethink_id], run_ids)
+        np.testing.assert_array_equal([[np.nan, 5.0, np.nan], [0.0, 1.0, 2.0]], matrices['test/aa/mean'])
+        self.assertTrue(np.all(np.isnan(matrices['test/bb/mean'])))
+
+
+class RethinkDBHookOutageTest(CXTestCaseWithDir):
+    """Spooling hook test with an unreachable database (no database is needed)."""
+
+    def test_spool_backoff(self):
+        """Test the epochs are only spooled (without waiting for the connection timeout) after a failed drain."""
+        server = socket.socket()  # accepts the connections, but never answers the handshake
+        server.bind(('localhost', 0))
+        server.listen(16)
+        self.addCleanup(server.close)
+
+        credentials_file = path.join(self.tmpdir, 'rethink_credentials.json')
+        with open(credentials_file, 'w') as cred_f:
+            json.dump({'host': 'localhost', 'port': server.getsockname()[1], 'user': USER, 'password': PASSWORD,
+                       'timeout': 1}, cred_f)
+        with open(path.join(self.tmpdir, 'config.yaml'), 'w') as config_f:
+            json.dump(CONFIG, config_f)
+
+        hook = RethinkDBHook(output_dir=self.tmpdir, credentials_file=credentials_file, db=DB, table=TABLE,
+                             spool=True)
+        atexit.unregister(hook._close)
+
+        start = time.time()
+        for epoch_id in range(5):
+            hook.after_epoch(epoch_id=epoch_id, epoch_data={'train': {'aa': {'mean': float(epoch_id)}}})
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(6, hook._spool.pending_count)
@@ -0,0 +1,135 @@
+from datetime import datetime
+import json
+from os import path
+from unittest import mock
+
+import pytz
+import rethinkdb as r
+
+from cxflow.tests.test_core import CXTestCaseWithDir
+from cxflow_rethinkdb.spool import Spool
+
+CREDENTIALS = {'host': 'localhost', 'port': 28015, 'user': 'admin', 'password': ''}
+OK = {'errors': 0, 'inserted': 1, 'replaced': 1}
+
+
+def _item(epoch_id):
+    return {'timestamp': datetime(2017, 1, 1, tzinfo=pytz.utc), 'epoch_id': epoch_id,
+            'epoch_data': {'train': {'loss': float(epoch_id), 'hist': r.binary(b'\x00\x01')}}}
+
+
+class SpoolTest(CXTestCaseWithDir):
+    """Spool test (the database writes are mocked, no database is needed)."""
+
+    def setUp(self):
+        super().setUp()
+        self._calls = []
+        for name in ['insert', 'append_training', 'insert_epochs']:
+            patcher = mock.patch('cxflow_rethinkdb.spool.' + name,
+                                 side_effect=lambda name=name, **kwargs: self._record(name, kwargs))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self._response = OK
+
+    def _record(self, name, kwargs):
+        self._calls.append((name, kwargs))
+        return self._response(kwargs) if callable(self._response) else self._response
+
+    def _fill(self, spool):
+        spool.append({'op': 'insert_run', 'db': 'db', 'table': 'runs', 'document': {'id': 'abc', 'training': []}})
+        for epoch_id in range(5):
+            spool.append({'op': 'append_training', 'db': 'db', 'table': 'runs', 'run_id': 'abc',
+                          'items': [_item(epoch_id)]})
+
+    def test_persistence(self):
+        """Test the pending records survive reopening the spool including the times and binaries."""
+        self._fill(Spool(self.tmpdir))
+
+        spool = Spool(self.tmpdir)
+        self.assertEqual(6, spool.pending_count)
+        spool.drain(CREDENTIALS, batch_size=3)
+
+        self.assertListEqual(['insert', 'append_training', 'append_training'], [name for name, _ in self._calls])
+        items = self._calls[1][1]['items']
+        self.assertListEqual([0, 1, 2], [item['epoch_id'] for item in items])
+        self.assertEqual(datetime(2017, 1, 1, tzinfo=pytz.utc), items[0]['timestamp'])
+        self.assertEqual(r.binary(b'\x00\x01').base64_data, items[0]['epoch_data']['train']['hist'].base64_data)
+
+        self.assertEqual(0, Spool(self.tmpdir).pending_count)
+
+    def test_failure(self):
+        """Test the draining stops at the first failed write and keeps the remaining records."""
+        spool = Spool(self.tmpdir)
+        self._fill(spool)
+
+        self._response = {'errors': 1, 'first_error': 'table not found'}
+        self.assertEqual(0, spool.drain(CREDENTIALS))
+        self.assertEqual(6, spool.pending_count)
+
+        self._response = OK
+        self.assertEqual(6, spool.drain(CREDENTIALS))
+        self.assertEqual(0, spool.pending_count)
+
+        spool.append({'op': 'append_training', 'db': 'db', 'table': 'runs', 'run_id': 'abc', 'items': [_item(5)]})
+        self.assertEqual(1, Spool(self.tmpdir).pending_count)
+
+    def test_poison(self):
+        """Test a record rejected repeatedly is quarantined and the records behind it are stored."""
+        def respond(kwargs):
+            if 2 in [item['epoch_id'] for item in kwargs.get('items', [])]:
+                raise r.ReqlQueryLogicError('Array over size limit')
+            return OK
+
+        spool = Spool(self.tmpdir, max_rejections=2)
+        self._fill(spool)
+        self._response = respond
+        self.assertEqual(3, spool.drain(CREDENTIALS))
+        self.assertEqual(3, spool.pending_count)
+        self.assertFalse(path.exists(spool.rejected_path))
+
+        self.assertEqual(3, spool.drain(CREDENTIALS))
+        self.assertEqual(0, spool.pending_count)
+        stored = [item['epoch_id'] for name, kwargs in self._calls if name == 'append_training'
+                  for item in kwargs['items'] if item['epoch_id'] != 2]
+        self.assertListEqual([0, 1, 3, 4], sorted(set(stored)))
+        with open(spool.rejected_path) as file:
+            rejected = [json.loads(line) for line in file]
+        self.assertListEqual([[2]], [[item['epoch_id'] for item in record['items']] for record in rejected])
+        self.assertEqual('Array over size limit', rejected[0]['error'])
+
+    def test_truncate(self):
+        """Test the journal is truncated once all the records are stored and the new records are still pending."""
+        spool = Spool(self.tmpdir)
+        self._fill(spool)
+        self.assertEqual(6, spool.drain(CREDENTIALS))
+        self.assertEqual(0, path.getsize(spool.journal_path))
+
+        spool.append({'op': 'append_training', 'db': 'db', 'table': 'runs', 'run_id': 'abc', 'items': [_item(5)]})
+        reopened = Spool(self.tmpdir)
+        self.assertEqual(1, reopened.pending_count)
+        self.assertEqual(1, reopened.drain(CREDENTIALS))
+        self.assertListEqual([5], [item['epoch_id'] for item in self._calls[-1][1]['items']])
+
+    def test_ranks(self):
+        """Test the epoch records of different ranks are not merged and the rank is passed to the write."""
+        spool = Spool(self.tmpdir)
+        for rank in [0, 0, 1]:
+            spool.append({'op': 'insert_epochs', 'db': 'db', 'epochs_table': 'epochs', 'run_id': 'abc', 'rank': rank,
+                          'items': [_item(0)]})
+        self.assertEqual(3, spool.drain(CREDENTIALS))
+        self.assertListEqual([(0, 2), (1, 1)], [(kwargs['rank'], len(kwargs['items'])) for _, kwargs in self._calls])
+
+    def test_shared_directory(self):
+        """Test the spools of two ranks sharing the output directory keep separate journals and offsets."""
+        spools = [Spool(self.tmpdir, *Spool.file_names(rank)) for rank in [0, 1]]
+        for epoch_id in range(3):
+            for rank, spool in enumerate(spools):
+                spool.append({'op': 'insert_epochs', 'db': 'db', 'epochs_table': 'epochs', 'run_id': 'abc',
+                              'rank': rank, 'items': [_item(epoch_id)]})
+        self.assertEqual(3, spools[0].drain(CREDENTIALS))
+
+        reopened = Spool.open_all(self.tmpdir)
+        self.assertListEqual([0, 3], [spool.pending_count for spool in reopened])
+        self.assertEqual(3, reopened[1].drain(CREDENTIALS))
+        self.assertListEqual([(0, 3), (1, 3)], [(kwargs['rank'], len(kwargs['items'])) for _, kwargs in self._calls])
+        self.assertListEqual([0, 0], [spool.pending_count for spool in Spool.open_all(self.tmpdir)])
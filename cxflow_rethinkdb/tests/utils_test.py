@@ -0,0 +1,132 @@
+from datetime import datetime, timedelta
+import threading
+
+import pytz
+import rethinkdb as r
+
+from cxflow.tests.test_core import CXTestCase
+from cxflow_rethinkdb.utils import append_training, create_db, create_table, insert, insert_epochs, \
+    select_leaderboard, watch_runs
+
+CREDENTIALS = {'host': 'localhost', 'port': 28015, 'user': 'admin', 'password': ''}
+DB = 'rethinktest_utils'
+
+
+def _items(accuracies: list, created: datetime) -> list:
+    """Create the training items with the given accuracies (`None` for a missing one) and losses."""
+    return [{'epoch_id': epoch_id, 'timestamp': created + timedelta(minutes=epoch_id),
+             'epoch_data': {'test': {'loss': 10. + epoch_id, 'accuracy': accuracy}}}
+            for epoch_id, accuracy in enumerate(accuracies)]
+
+
+class LeaderboardTest(CXTestCase):
+    """
+    Leaderboard test of the runs stored in a document, in the epochs table and shared by two workers.
+
+    RethinkDB must run and be accessible as described in the configuration above.
+    """
+
+    def setUp(self):
+        super().setUp()
+        create_db(credentials=CREDENTIALS, db_name=DB)
+        create_table(credentials=CREDENTIALS, db_name=DB, table_name='runs')
+        create_table(credentials=CREDENTIALS, db_name=DB, table_name='runs_epochs')
+        days = [datetime(2017, 7, day, tzinfo=pytz.utc) for day in [14, 15, 16, 17]]
+        insert(credentials=CREDENTIALS, db_name=DB, table_name='runs', document=[
+            {'id': 'document', 'user': 'alice', 'timestamp': days[0], 'training': _items([.5, .9, .7], days[0])},
+            {'id': 'epochs', 'user': 'bob', 'timestamp': days[1], 'training': [], 'epochs_table': 'runs_epochs'},
+            {'id': 'shared', 'user': 'alice', 'timestamp': days[2], 'training': [], 'epochs_table': 'runs_epochs',
+             'shared': True},
+            {'id': 'no_metric', 'user': 'alice', 'timestamp': days[3], 'training': _items([None, 'n/a'], days[3])}])
+        insert_epochs(credentials=CREDENTIALS, db_name=DB, epochs_table='runs_epochs', run_id='epochs',
+                      items=_items([.6, .8], days[1]))
+        # only the rank 1 reports the accuracy, the loss is taken from the rank 0
+        insert_epochs(credentials=CREDENTIALS, db_name=DB, epochs_table='runs_epochs', run_id='shared',
+                      items=[dict(item, epoch_data={'test': {'loss': item['epoch_data']['test']['loss']}})
+                             for item in _items([None, None], days[2])], rank=0)
+        insert_epochs(credentials=CREDENTIALS, db_name=DB, epochs_table='runs_epochs', run_id='shared',
+                      items=[dict(item, epoch_data={'test': {'accuracy': item['epoch_data']['test']['accuracy']}})
+                             for item in _items([.95, .3], days[2])], rank=1)
+
+    def tearDown(self):
+        super().tearDown()
+        with r.connect(**CREDENTIALS) as conn:
+            r.db_drop(DB).run(conn)
+
+    def _leaderboard(self, **kwargs) -> list:
+        """The (id, epoch_id, value) triplets of the leaderboard ranked by the test accuracy."""
+        rows = select_leaderboard(credentials=CREDENTIALS, db_name=DB, table_name='runs', metric='test/accuracy',
+                                  **kwargs)
+        return [(row['id'], row['epoch_id'], row['value']) for row in rows]
+
+    def test_mode(self):
+        """Test the runs are ranked by their best epochs; the runs without a numeric metric are left out."""
+        self.assertListEqual([('shared', 0, .95), ('document', 1, .9), ('epochs', 1, .8)], self._leaderboard())
+        self.assertListEqual([('shared', 1, .3), ('document', 0, .5), ('epochs', 0, .6)],
+                             self._leaderboard(mode='min'))
+        self.assertListEqual([('shared', 0, .95), ('document', 1, .9)], self._leaderboard(top=2))
+
+    def test_columns(self):
+        """Test the columns are reported from the best epoch (merged over the ranks of a shared run)."""
+        rows = select_leaderboard(credentials=CREDENTIALS, db_name=DB, table_name='runs', metric='test/accuracy',
+                                  columns=['test/loss', 'test/missing'])
+        self.assertListEqual([{'test/loss': 10., 'test/missing': None}, {'test/loss': 11., 'test/missing': None},
+                              {'test/loss': 11., 'test/missing': None}], [row['columns'] for row in rows])
+        self.assertListEqual(['alice', 'alice', 'bob'], [row['user'] for row in rows])
+
+    def test_filters(self):
+        """Test only the runs of the user and created in the time range are ranked."""
+        self.assertListEqual([('epochs', 1, .8)], self._leaderboard(user='bob'))
+        self.assertListEqual([('shared', 0, .95), ('epochs', 1, .8)], self._leaderboard(since='2017-07-15'))
+        self.assertListEqual([('document', 1, .9)], self._leaderboard(until='2017-07-15T00:00:00Z'))
+
+
+class WatchRunsTest(CXTestCase):
+    """
+    Changefeed test of the runs stored in a document and in the epochs table.
+
+    RethinkDB must run and be accessible as described in the configuration above.
+    """
+
+    def setUp(self):
+        super().setUp()
+        create_db(credentials=CREDENTIALS, db_name=DB)
+        create_table(credentials=CREDENTIALS, db_name=DB, table_name='runs')
+        create_table(credentials=CREDENTIALS, db_name=DB, table_name='runs_epochs')
+        self._created = datetime(2017, 7, 14, tzinfo=pytz.utc)
+        insert(credentials=CREDENTIALS, db_name=DB, table_name='runs', document=[
+            {'id': 'document', 'user': 'alice', 'timestamp': self._created, 'training': _items([.5], self._created)},
+            {'id': 'epochs', 'user': 'alice', 'timestamp': self._created, 'training': [],
+             'epochs_table': 'runs_epochs'},
+            {'id': 'other', 'user': 'bob', 'timestamp': self._created, 'training': [], 'epochs_table': 'runs_epochs'}])
+        for run_id in ['epochs', 'other']:
+            insert_epochs(credentials=CREDENTIALS, db_name=DB, epochs_table='runs_epochs', run_id=run_id,
+                          items=_items([.5], self._created))
+
+    def tearDown(self):
+        super().tearDown()
+        with r.connect(**CREDENTIALS) as conn:
+            r.db_drop(DB).run(conn)
+
+    def _append(self) -> None:
+        """Append the second epoch to all the runs."""
+        item = _items([.5, .6], self._created)[1:]
+        append_training(credentials=CREDENTIALS, db_name=DB, table_name='runs', run_id='document', items=item)
+        for run_id in ['other', 'epochs']:
+            insert_epochs(credentials=CREDENTIALS, db_name=DB, epochs_table='runs_epochs', run_id=run_id, items=item)
+
+    def test_new_epochs(self):
+        """Test only the epochs appended to the runs of the user after the feed is started arrive."""
+        deltas = watch_runs(credentials=CREDENTIALS, db_name=DB, table_name='runs', user='alice',
+                            epochs_table='runs_epochs', include_initial=False)
+        timer = threading.Timer(1., self._append)
+        timer.start()
+        try:
+            received = sorted([next(deltas), next(deltas)], key=lambda delta: delta['id'])
+        finally:
+            timer.join()
+            deltas.close()
+        self.assertListEqual([('document', False, [1]), ('epochs', False, [1])],
+                             [(delta['id'], delta['new_run'], [item['epoch_id'] for item in delta['epochs']])
+                              for delta in received])
+        self.assertEqual(.6, received[1]['epochs'][0]['epoch_data']['test']['accuracy'])
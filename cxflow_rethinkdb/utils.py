@@ -1,54 +1,81 @@
 import rethinkdb as r
 
+from contextlib import contextmanager
+from datetime import datetime
+import hashlib
+import json
 import logging
-from typing import Optional, Iterable
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
+if TYPE_CHECKING:
+    import numpy as np  # annotations only; imported lazily, see the package docstring
 
-def create_db(credentials: dict, db_name: str) -> dict:
+
+@contextmanager
+def connect(credentials: dict, conn: Optional[r.net.Connection]=None, **kwargs) -> Iterator[r.net.Connection]:
+    """
+    Use the given (e.g. pooled) connection or open a new one which is closed afterwards.
+
+    :param credentials: dict containing at least `host`, `port`, `user` and `password` keys
+    :param conn: already open connection to be used; it is left open
+    :param kwargs: additional ``r.connect`` arguments used when a new connection is opened
+    """
+    if conn is not None:
+        yield conn
+    else:
+        with r.connect(**credentials, **kwargs) as new_conn:
+            yield new_conn
+
+
+def create_db(credentials: dict, db_name: str, conn: Optional[r.net.Connection]=None) -> dict:
     """
     Create a database.
 
     :param credentials: dict containing at least `host`, `port`, `user` and `password` keys
     :param db_name: name of the database to be created
+    :param conn: optional open (e.g. pooled) connection; a new connection is opened if not specified
     :return: RethinkDB response
     """
     logging.info('Creating database `%s`', db_name)
 
-    with r.connect(**credentials) as conn:
+    with connect(credentials, conn) as conn:
         return r.db_create(db_name).run(conn)
 
 
-def create_table(credentials: dict, db_name: str, table_name: str) -> dict:
+def create_table(credentials: dict, db_name: str, table_name: str, conn: Optional[r.net.Connection]=None) -> dict:
     """
     Create a table.
 
     :param credentials: dict containing at least `host`, `port`, `user` and `password` keys
     :param db_name: name of the database in which the table will be created
     :param table_name: name of the table to be created
+    :param conn: optional open (e.g. pooled) connection; a new connection is opened if not specified
     :return: RethinkDB response
     """
     logging.info('Creating table `%s.%s`', db_name, table_name)
 
-    with r.connect(db=db_name, **credentials) as conn:
+    with connect(credentials, conn, db=db_name) as conn:
         return r.db(db_name).table_create(table_name).run(conn)
 
 
-def create_user(credentials: dict, user: str, password: str) -> dict:
+def create_user(credentials: dict, user: str, password: str, conn: Optional[r.net.Connection]=None) -> dict:
     """
     Create a user.
 
     :param credentials: dict containing at least `host`, `port`, `user` and `password` keys
     :param user: name of new user to be created
     :param password: password to be set to the new user
+    :param conn: optional open (e.g. pooled) connection; a new connection is opened if not specified
     :return: RethinkDB response
     """
     logging.info('Creating user `%s`', user)
 
-    with r.connect(**credentials) as conn:
+    with connect(credentials, conn) as conn:
         return r.db('rethinkdb').table('users').insert({'id': user, 'password': password}).run(conn)
 
 
-def grant_permission(credentials: dict, user: str, permissions: dict, db_name: str, table_name: Optional[str]=None) -> dict:
+def grant_permission(credentials: dict, user: str, permissions: dict, db_name: str, table_name: Optional[str]=None,
+                     conn: Optional[r.net.Connection]=None) -> dict:
     """
     Grand permission to a user.
 
@@ -60,11 +87,12 @@ def grant_permission(credentials: dict, user: str, permissions: dict, db_name: s
     :param db_name: name of the database to which the permissions will be granted
     :param table_name: name of the table to which the permissions will be granted. If `None`, the permissions will
                        be applied to the whole database.
+    :param conn: optional open (e.g. pooled) connection; a new connection is opened if not specified
     :return: RethinkDB response
     """
     logging.info('Grating user `%s` permissions `%s` to `%s.%s`', user, permissions, db_name, table_name)
 
-    with r.connect(**credentials) as conn:
+    with connect(credentials, conn) as conn:
         query = r.db(db_name)
         if table_name is not None:
             query = query.table(table_name)
@@ -72,38 +100,213 @@ def grant_permission(credentials: dict, user: str, permissions: dict, db_name: s
         return query.grant(user, permissions).run(conn)
 
 
-def insert(credentials: dict, db_name: str, table_name: str, document: dict) -> dict:
+def keep_existing(_, old_document, __):
+    """Insert conflict resolution keeping the already inserted document."""
+    return old_document
+
+
+def insert(credentials: dict, db_name: str, table_name: str, document: Union[dict, List[dict]],
+           conn: Optional[r.net.Connection]=None, conflict: Union[str, Callable]='error',
+           durability: str='hard', **run_kwargs) -> dict:
     """
     Create new document in the specified table.
 
     :param credentials: dict containing at least `host`, `port`, `user` and `password` keys
     :param db_name: name of the database in which the document will be inserted
     :param table_name: name of the table in which the document will be inserted
-    :param document: document to be inserted
+    :param document: document (or list of documents) to be inserted
+    :param conn: optional open (e.g. pooled) connection; a new connection is opened if not specified
+    :param conflict: standard RethinkDB conflict resolution (`error`, `replace`, `update` or a function)
+    :param durability: `hard` (acknowledge the write once it is on disk) or `soft` (once it is in memory)
+    :param run_kwargs: additional ``run`` arguments, e.g. ``json_encoder``
     :return: RethinkDB response
     """
     logging.info('Inserting a document to %s.%s', db_name, table_name)
 
-    with r.connect(db=db_name, **credentials) as conn:
-        return r.db(db_name).table(table_name).insert(document).run(conn)
+    with connect(credentials, conn, db=db_name) as conn:
+        return r.db(db_name).table(table_name).insert(document, conflict=conflict, durability=durability)\
+            .run(conn, **run_kwargs)
+
+
+def config_hash(config: dict) -> str:
+    """
+    Compute the content hash of the config.
+
+    The config is canonicalized (sorted keys, compact separators) first, hence equal configs have equal hashes
+    regardless of the key order.
+
+    :param config: the cxflow config
+    :return: hex SHA-256 digest
+    """
+    canonical = json.dumps(config, sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def insert_config(credentials: dict, db_name: str, configs_table: str, config: dict,
+                  conn: Optional[r.net.Connection]=None, **run_kwargs) -> str:
+    """
+    Store the config once in the configs table keyed by its content hash (see ``config_hash``).
+
+    The insert uses ``conflict='update'``, hence storing the same config repeatedly is idempotent.
+
+    :param credentials: dict containing at least `host`, `port`, `user` and `password` keys
+    :param db_name: name of the database with the configs table
+    :param configs_table: name of the table with the configs
+    :param config: the cxflow config
+    :param conn: optional open (e.g. pooled) connection; a new connection is opened if not specified
+    :param run_kwargs: additional ``run`` arguments, e.g. ``json_encoder``
+    :raise ValueError: if the config could not be stored
+    :return: hash of the config
+    """
+    digest = config_hash(config)
+    response = insert(credentials=credentials, db_name=db_name, table_name=configs_table,
+                      document={'id': digest, 'config': config}, conn=conn, conflict='update', **run_kwargs)
+    if response['errors'] > 0:
+        raise ValueError('Failed to store config `{}`: {}'.format(digest, response.get('first_error')))
+    return digest
+
+
+def _stamp(document):
+    """ReQL expression of the document with the `modified` field set to the server time of the write."""
+    return r.expr(document).merge({'modified': r.now()})
+
+
+def append_training(credentials: dict, db_name: str, table_name: str, run_id: str, items: List[dict],
+                    conn: Optional[r.net.Connection]=None, **run_kwargs) -> dict:
+    """
+    Append the training items to the `training` list of the specified run document.
+
+    The items with `epoch_id` already present in the `training` list are skipped, hence the call is idempotent.
+    The `modified` field of the run document is set to the server time.
+
+    :param credentials: dict containing at least `host`, `port`, `user` and `password` keys
+    :param db_name: name of the database with the run document
+    :param table_name: name of the table with the run document
+    :param run_id: ID of the run document
+    :param items: training items (dicts with `timestamp`, `epoch_id` and `epoch_data` keys)
+    :param conn: optional open (e.g. pooled) connection; a new connection is opened if not specified
+    :param run_kwargs: additional ``run`` arguments, e.g. ``json_encoder``
+    :return: RethinkDB response
+    """
+    logging.debug('Appending %d training item(s) to %s in %s.%s', len(items), run_id, db_name, table_name)
+
+    with connect(credentials, conn, db=db_name) as conn:
+        return r.db(db_name).table(table_name).get(run_id)\
+            .update(lambda doc: {'training': doc['training'].add(r.expr(items).filter(
+                lambda item: doc['training']['epoch_id'].contains(item['epoch_id']).not_())), 'modified': r.now()})\
+            .run(conn, **run_kwargs)
+
+
+def insert_epochs(credentials: dict, db_name: str, epochs_table: str, run_id: str, items: List[dict],
+                  conn: Optional[r.net.Connection]=None, rank: Optional[int]=None, **run_kwargs) -> dict:
+    """
+    Insert the training items as separate epoch documents with the primary key ``[run_id, epoch_id]``
+    (``[run_id, epoch_id, rank]`` if the worker rank is specified).
+
+    The existing epoch documents are replaced, hence the call is idempotent. Their `modified` field is set to the server
+    time.
+
+    :param credentials: dict containing at least `host`, `port`, `user` and `password` keys
+    :param db_name: name of the database with the epochs table
+    :param epochs_table: name of the table with the epoch documents
+    :param run_id: ID of the run document
+    :param items: training items (dicts with `timestamp`, `epoch_id` and `epoch_data` keys)
+    :param conn: optional open (e.g. pooled) connection; a new connection is opened if not specified
+    :param rank: rank of the worker in a run shared by multiple workers
+    :param run_kwargs: additional ``run`` arguments, e.g. ``json_encoder``
+    :return: RethinkDB response
+    """
+    if rank is None:
+        documents = [dict(item, id=[run_id, item['epoch_id']], run_id=run_id) for item in items]
+    else:
+        documents = [dict(item, id=[run_id, item['epoch_id'], rank], run_id=run_id, rank=rank) for item in items]
+    return insert(credentials=credentials, db_name=db_name, table_name=epochs_table,
+                  document=r.expr(documents).map(_stamp), conn=conn, conflict='replace', **run_kwargs)
+
+
+def insert_batches(credentials: dict, db_name: str, batches_table: str, run_id: str, chunks: List[dict],
+                   conn: Optional[r.net.Connection]=None, rank: Optional[int]=None, **run_kwargs) -> dict:
+    """
+    Insert the downsampled batch chunks as separate documents with the primary key ``[run_id, stream, chunk_id]``
+    (``[run_id, stream, chunk_id, rank]`` if the worker rank is specified).
+
+    The existing chunk documents are replaced, hence the call is idempotent.
+
+    :param credentials: dict containing at least `host`, `port`, `user` and `password` keys
+    :param db_name: name of the database with the batches table
+    :param batches_table: name of the table with the batch chunk documents
+    :param run_id: ID of the run document
+    :param chunks: batch chunks (dicts with `stream`, `chunk_id` and the ``BatchBuffer.reduce`` keys)
+    :param conn: optional open (e.g. pooled) connection; a new connection is opened if not specified
+    :param rank: rank of the worker in a run shared by multiple workers
+    :param run_kwargs: additional ``run`` arguments, e.g. ``json_encoder``
+    :return: RethinkDB response
+    """
+    if rank is None:
+        documents = [dict(chunk, id=[run_id, chunk['stream'], chunk['chunk_id']], run_id=run_id) for chunk in chunks]
+    else:
+        documents = [dict(chunk, id=[run_id, chunk['stream'], chunk['chunk_id'], rank], run_id=run_id, rank=rank)
+                     for chunk in chunks]
+    return insert(credentials=credentials, db_name=db_name, table_name=batches_table, document=documents, conn=conn,
+                  conflict='replace', **run_kwargs)
 
 
-def select_all(credentials: dict, db_name: str, table_name: str) -> Iterable[dict]:
+def select_all(credentials: dict, db_name: str, table_name: str,
+               conn: Optional[r.net.Connection]=None) -> Iterator[dict]:
     """
     Select all documents from the specified table.
 
+    The documents are streamed; the connection is kept open until the returned iterator is exhausted.
+
     :param credentials: dict containing at least `host`, `port`, `user` and `password` keys
     :param db_name: name of the database from which the documents will be selected
     :param table_name: name of the table from which the documents will be selected
-    :return: RethinkDB response
+    :param conn: optional open (e.g. pooled) connection; a new connection is opened if not specified
+    :return: iterator of documents
     """
     logging.info('Selecting all documents from %s.%s', db_name, table_name)
 
-    with r.connect(db=db_name, **credentials) as conn:
-        return r.db(db_name).table(table_name).run(conn)
+    with connect(credentials, conn, db=db_name) as conn:
+        yield from r.db(db_name).table(table_name).run(conn)
 
 
-def select_by_id(credentials: dict, db_name: str, table_name: str, doc_id: str) -> dict:
+def iter_table(credentials: dict, db_name: str, table_name: str, start_after: Optional[str]=None,
+               batch_size: int=1000, conn: Optional[r.net.Connection]=None, **run_kwargs) -> Iterator[dict]:
+    """
+    Stream all documents from the specified table ordered by their primary key.
+
+    The documents are fetched in batches of ``batch_size``; hence, the memory consumption does not depend on the
+    table size. An interrupted iteration may be resumed by passing the last seen primary key as ``start_after``.
+
+    :param credentials: dict containing at least `host`, `port`, `user` and `password` keys
+    :param db_name: name of the database from which the documents will be selected
+    :param table_name: name of the table from which the documents will be selected
+    :param start_after: stream only the documents with the primary key greater than this one
+    :param batch_size: maximal number of documents fetched in a single round trip
+    :param conn: optional open (e.g. pooled) connection; a new connection is opened if not specified
+    :param run_kwargs: additional ``run`` arguments, e.g. ``time_format='raw'``
+    :return: iterator of documents
+    """
+    logging.info('Streaming documents from %s.%s (after `%s`)', db_name, table_name, start_after)
+
+    query = r.db(db_name).table(table_name)
+    if start_after is not None:
+        query = query.between(start_after, r.maxval, left_bound='open')
+    with connect(credentials, conn, db=db_name) as conn:
+        yield from query.order_by(index='id').run(conn, max_batch_rows=batch_size, **run_kwargs)
+
+
+def _rehydrate_config(db_name: str, document):
+    """ReQL expression replacing the `config_hash` reference of the run document by the config it refers to."""
+    return r.branch(document.has_fields('config_hash'),
+                    document.merge({'config': r.db(db_name).table(document['configs_table'])
+                                   .get(document['config_hash'])['config'].default(None)}),
+                    document)
+
+
+def select_by_id(credentials: dict, db_name: str, table_name: str, doc_id: str,
+                 conn: Optional[r.net.Connection]=None, decode_arrays: bool=False,
+                 rehydrate_config: bool=False) -> dict:
     """
     Select a document with a specified ID (from the specified table).
 
@@ -111,13 +314,351 @@ def select_by_id(credentials: dict, db_name: str, table_name: str, doc_id: str)
     :param db_name: name of the database from which the document will be selected
     :param table_name: name of the table from which the document will be selected
     :param doc_id: document ID
+    :param conn: optional open (e.g. pooled) connection; a new connection is opened if not specified
+    :param decode_arrays: convert the binary-encoded arrays (see ``ArrayCodec``) to numpy arrays
+    :param rehydrate_config: fill the `config` of a run document stored with a deduplicated config (the config is
+                             looked up by the server in the same query)
     :return: RethinkDB response
     """
     logging.info('Selecting document with ID `%s` from %s.%s', doc_id, db_name, table_name)
 
-    with r.connect(db=db_name, **credentials) as conn:
-        document = r.db(db_name).table(table_name).get(doc_id).run(conn)
+    with connect(credentials, conn, db=db_name) as conn:
+        query = r.db(db_name).table(table_name).get(doc_id)
+        if rehydrate_config:
+            query = query.do(lambda document: r.branch(document.eq(None), None,
+                                                       _rehydrate_config(db_name, document)))
+        document = query.run(conn)
 
     if document is None:
         raise KeyError('Document with ID `{}` was not found in `{}.{}`'.format(doc_id, db_name, table_name))
+    if decode_arrays:
+        from .array_codec import decode_arrays as _decode_arrays  # imported lazily, see the package docstring
+        document = _decode_arrays(document)
     return document
+
+
+def _merge_ranks(epochs):
+    """
+    ReQL expression merging the rank-tagged epoch documents of a shared run to a single training item per epoch.
+
+    The `epoch_data` of all the ranks are merged (rank 0 takes precedence), the original ones are kept in
+    `epoch_data_by_rank` (rank string -> epoch data).
+    """
+    return epochs.group('epoch_id').ungroup().map(lambda group: {
+        'epoch_id': group['group'],
+        'timestamp': group['reduction']['timestamp'].max(),
+        'ranks': group['reduction']['rank'].order_by(lambda rank: rank),
+        'epoch_data': group['reduction'].order_by(r.desc('rank'))
+                      .fold({}, lambda merged, epoch: merged.merge(epoch['epoch_data'])),
+        'epoch_data_by_rank': group['reduction'].map(lambda epoch: [epoch['rank'].coerce_to('string'),
+                                                                    epoch['epoch_data']]).coerce_to('object')})
+
+
+def select_epochs(credentials: dict, db_name: str, epochs_table: str, run_id: str,
+                  conn: Optional[r.net.Connection]=None, merge_ranks: bool=False) -> Iterable[dict]:
+    """
+    Select all the epoch documents of the specified run ordered by the epoch id.
+
+    The epoch documents are stored by ``RethinkDBHook`` with ``storage: epochs``; their primary key is
+    ``[run_id, epoch_id]`` (or ``[run_id, epoch_id, rank]`` in a shared run), hence the selection is a single primary
+    index range scan.
+
+    :param credentials: dict containing at least `host`, `port`, `user` and `password` keys
+    :param db_name: name of the database from which the documents will be selected
+    :param epochs_table: name of the table with the epoch documents
+    :param run_id: ID of the run document
+    :param conn: optional open (e.g. pooled) connection; a new connection is opened if not specified
+    :param merge_ranks: merge the epoch documents of all the workers of a shared run on the server
+                        (see ``_merge_ranks``)
+    :return: list of epoch documents
+    """
+    logging.info('Selecting epochs of run `%s` from %s.%s', run_id, db_name, epochs_table)
+
+    with connect(credentials, conn, db=db_name) as conn:
+        epochs = r.db(db_name).table(epochs_table)\
+            .between([run_id, r.minval], [run_id, r.maxval], index='id')\
+            .order_by(index='id')
+        if merge_ranks:
+            epochs = _merge_ranks(epochs)
+        return list(epochs.run(conn))
+
+
+def select_batches(credentials: dict, db_name: str, batches_table: str, run_id: str, stream_name: str,
+                   conn: Optional[r.net.Connection]=None) -> List[dict]:
+    """
+    Select all the batch chunk documents of the specified run and stream ordered by the chunk id.
+
+    The chunk documents are stored by ``RethinkDBHook`` with ``log_batches: true``.
+
+    :param credentials: dict containing at least `host`, `port`, `user` and `password` keys
+    :param db_name: name of the database from which the documents will be selected
+    :param batches_table: name of the table with the batch chunk documents
+    :param run_id: ID of the run document
+    :param stream_name: name of the stream
+    :param conn: optional open (e.g. pooled) connection; a new connection is opened if not specified
+    :return: list of batch chunk documents
+    """
+    logging.info('Selecting `%s` batches of run `%s` from %s.%s', stream_name, run_id, db_name, batches_table)
+
+    with connect(credentials, conn, db=db_name) as conn:
+        return list(r.db(db_name).table(batches_table)
+                    .between([run_id, stream_name, r.minval], [run_id, stream_name, r.maxval], index='id')
+                    .order_by(index='id')
+                    .run(conn))
+
+
+def select_run(credentials: dict, db_name: str, table_name: str, run_id: str,
+               conn: Optional[r.net.Connection]=None, decode_arrays: bool=False,
+               rehydrate_config: bool=False) -> dict:
+    """
+    Select a run document and rebuild its `training` list regardless of the storage mode it was written with.
+
+    :param credentials: dict containing at least `host`, `port`, `user` and `password` keys
+    :param db_name: name of the database from which the document will be selected
+    :param table_name: name of the table from which the document will be selected
+    :param run_id: ID of the run document
+    :param conn: optional open (e.g. pooled) connection; a new connection is opened if not specified
+    :param decode_arrays: convert the binary-encoded arrays (see ``ArrayCodec``) to numpy arrays
+    :param rehydrate_config: fill the `config` of a run document stored with a deduplicated config
+    :return: run document with the `training` list in the ``RethinkDBHook`` document layout
+    """
+    with connect(credentials, conn, db=db_name) as conn:
+        document = select_by_id(credentials=credentials, db_name=db_name, table_name=table_name, doc_id=run_id,
+                                conn=conn, rehydrate_config=rehydrate_config)
+        if 'epochs_table' in document:
+            epochs = select_epochs(credentials=credentials, db_name=db_name, epochs_table=document['epochs_table'],
+                                   run_id=run_id, conn=conn, merge_ranks=document.get('shared', False))
+            document['training'] = document.get('training', []) + \
+                [{key: value for key, value in epoch.items() if key not in ('id', 'run_id')} for epoch in epochs]
+    if decode_arrays:
+        from .array_codec import decode_arrays as _decode_arrays  # imported lazily, see the package docstring
+        document = _decode_arrays(document)
+    return document
+
+
+def _time(value: Union[datetime, str]):
+    """Convert the ISO 8601 string (UTC if no timezone is specified) to a ReQL time; keep datetimes untouched."""
+    return r.iso8601(value, default_timezone='+00:00') if isinstance(value, str) else value
+
+
+def _run_filter(query, user: Optional[str]=None, since: Optional[Union[datetime, str]]=None,
+                until: Optional[Union[datetime, str]]=None):
+    """Filter the run documents by the user and the creation timestamp."""
+    if user is not None:
+        query = query.filter({'user': user})
+    if since is not None:
+        query = query.filter(r.row['timestamp'] >= _time(since))
+    if until is not None:
+        query = query.filter(r.row['timestamp'] < _time(until))
+    return query
+
+
+def _training_items(db_name: str, run):
+    """ReQL expression of the training items of the run regardless of the storage mode it was written with."""
+    epochs = r.db(db_name).table(run['epochs_table'])\
+        .between([run['id'], r.minval], [run['id'], r.maxval], index='id')\
+        .order_by(index='id').coerce_to('array')
+    return r.branch(run.has_fields('epochs_table'),
+                    run['training'].add(r.branch(run['shared'].default(False), _merge_ranks(epochs), epochs)),
+                    run['training'])
+
+
+def _metric_value(item, metric: str):
+    """ReQL expression of the metric (`/`-separated path in the `epoch_data`) value in the training item."""
+    expression = item['epoch_data']
+    for key in metric.split('/'):
+        expression = expression[key]
+    return expression.default(None)
+
+
+def select_metrics(credentials: dict, db_name: str, table_name: str, metrics: List[str],
+                   run_ids: Optional[List[str]]=None, user: Optional[str]=None,
+                   since: Optional[Union[datetime, str]]=None, until: Optional[Union[datetime, str]]=None,
+                   conn: Optional[r.net.Connection]=None) \
+        -> Tuple[List[str], Dict[str, 'np.ndarray']]:
+    """
+    Select the given metrics of the specified runs as dense (runs x epochs) matrices.
+
+    The projection is evaluated by the server, so only the selected values are transferred.
+    The metrics are given as `/`-separated paths in the `epoch_data`, e.g. ``test/accuracy/mean``.
+    The matrix columns correspond to the epoch ids; missing and non-numeric values are NaN.
+
+    :param credentials: dict containing at least `host`, `port`, `user` and `password` keys
+    :param db_name: name of the database with the run documents
+    :param table_name: name of the table with the run documents
+    :param metrics: list of metric paths
+    :param run_ids: select only the runs with these IDs (in this order)
+    :param user: select only the runs of this user
+    :param since: select only the runs created at or after this time (timezone-aware datetime or ISO 8601 string)
+    :param until: select only the runs created before this time (timezone-aware datetime or ISO 8601 string)
+    :param conn: optional open (e.g. pooled) connection; a new connection is opened if not specified
+    :return: tuple of the list of run IDs (matrix rows) and dict of metric matrices
+    """
+    logging.info('Selecting metrics %s from %s.%s', metrics, db_name, table_name)
+
+    query = r.db(db_name).table(table_name)
+    if run_ids is not None:
+        query = query.get_all(*run_ids)
+    query = _run_filter(query, user=user, since=since, until=until)
+    query = query.map(lambda run: {'id': run['id'],
+                                   'values': _training_items(db_name, run).map(
+                                       lambda item: [item['epoch_id']] +
+                                       [_metric_value(item, metric) for metric in metrics])})
+
+    with connect(credentials, conn, db=db_name) as conn:
+        rows = list(query.run(conn))
+    if run_ids is not None:
+        order = {run_id: i for i, run_id in enumerate(run_ids)}
+        rows.sort(key=lambda row: order[row['id']])
+    return [row['id'] for row in rows], _metric_matrices(rows, metrics)
+
+
+def _metric_matrices(rows: List[dict], metrics: List[str]) -> Dict[str, 'np.ndarray']:
+    """Convert the rows of ``[epoch_id, *metric values]`` lists (one row per run) to dense metric matrices."""
+    import numpy as np  # imported lazily, see the package docstring
+    n_epochs = 1 + max((values[0] for row in rows for values in row['values']), default=-1)
+    matrices = {metric: np.full((len(rows), n_epochs), np.nan) for metric in metrics}
+    for i, row in enumerate(rows):
+        for values in row['values']:
+            for metric, metric_value in zip(metrics, values[1:]):
+                if isinstance(metric_value, (int, float)) and not isinstance(metric_value, bool):
+                    matrices[metric][i, values[0]] = metric_value
+    return matrices
+
+
+def select_leaderboard(credentials: dict, db_name: str, table_name: str, metric: str, mode: str='max', top: int=10,
+                       columns: Optional[List[str]]=None, user: Optional[str]=None,
+                       since: Optional[Union[datetime, str]]=None, until: Optional[Union[datetime, str]]=None,
+                       conn: Optional[r.net.Connection]=None) -> List[dict]:
+    """
+    Rank the runs by the best value of the given metric over their epochs.
+
+    The best epoch of every run, the ranking and the top-K selection are all evaluated by the server; only the
+    result rows are transferred. The runs without any numeric value of the metric are not ranked.
+
+    -------------------------------------------------------
+    The result row structure:
+    -------------------------------------------------------
+    {
+        id: run id
+        user: user who ran the training
+        timestamp: run creation timestamp
+        epoch_id: id of the best epoch
+        value: metric value in the best epoch
+        columns: {column path: value in the best epoch (or None)}
+    }
+    -------------------------------------------------------
+
+    :param credentials: dict containing at least `host`, `port`, `user` and `password` keys
+    :param db_name: name of the database with the run documents
+    :param table_name: name of the table with the run documents
+    :param metric: `/`-separated path of the ranking metric in the `epoch_data`, e.g. ``test/accuracy/mean``
+    :param mode: `max` if the higher values are better, `min` otherwise
+    :param top: number of the best runs to be selected
+    :param columns: other metric paths to be reported from the best epoch, e.g. ``test/loss/mean``
+    :param user: rank only the runs of this user
+    :param since: rank only the runs created at or after this time (timezone-aware datetime or ISO 8601 string)
+    :param until: rank only the runs created before this time (timezone-aware datetime or ISO 8601 string)
+    :param conn: optional open (e.g. pooled) connection; a new connection is opened if not specified
+    :return: list of the result rows ordered from the best one
+    """
+    assert mode in ['min', 'max']
+    logging.info('Selecting top %d runs by %s of %s from %s.%s', top, mode, metric, db_name, table_name)
+    columns = columns or []
+
+    def best_item(run):
+        """ReQL expression of the training item with the best metric value (or None)."""
+        items = _training_items(db_name, run).filter(lambda item: _metric_value(item, metric).type_of().eq('NUMBER'))
+        best = items.max(lambda item: _metric_value(item, metric)) if mode == 'max' else \
+            items.min(lambda item: _metric_value(item, metric))
+        return r.branch(items.is_empty(), None, best)
+
+    query = _run_filter(r.db(db_name).table(table_name), user=user, since=since, until=until)\
+        .map(lambda run: best_item(run).do(lambda item: r.branch(item.eq(None), None, {
+            'id': run['id'], 'user': run['user'].default(None), 'timestamp': run['timestamp'].default(None),
+            'epoch_id': item['epoch_id'], 'value': _metric_value(item, metric),
+            'columns': r.object(*[value for column in columns for value in (column, _metric_value(item, column))])})))\
+        .filter(lambda row: row.ne(None))\
+        .order_by(r.desc('value') if mode == 'max' else r.asc('value'))\
+        .limit(top)
+
+    with connect(credentials, conn, db=db_name) as conn:
+        return list(query.run(conn))
+
+
+def _run_delta(change):
+    """ReQL expression of the run change reduced to the training items not present in the old run document."""
+    old = change['old_val'].default(None)
+    new = change['new_val']
+    old_ids = r.branch(old.eq(None), [], old['training'].default([])['epoch_id'])
+    return {'id': new['id'], 'new_run': old.eq(None),
+            'epochs': new['training'].default([]).filter(lambda item: old_ids.contains(item['epoch_id']).not_())}
+
+
+def watch_runs(credentials: dict, db_name: str, table_name: str, run_ids: Optional[List[str]]=None,
+               user: Optional[str]=None, epochs_table: Optional[str]=None, include_initial: bool=True,
+               conn: Optional[r.net.Connection]=None) -> Iterator[dict]:
+    """
+    Follow the runs with changefeeds and yield only their newly appended epochs.
+
+    The deltas are computed by the server, so a run appending an epoch costs the transfer of that epoch only,
+    regardless of the size of its `training` list. All the runs are followed over a single connection.
+
+    The runs stored with ``storage: epochs`` are followed only if their ``epochs_table`` is given. Their epoch documents
+    are filtered by ``run_ids`` on the server; by ``user`` on the client (the runs seen by the run changefeed are
+    followed, hence the runs started later are followed once their run document is inserted).
+
+    -------------------------------------------------------
+    The delta structure:
+    -------------------------------------------------------
+    {
+        id: run id
+        new_run: whether the run was just inserted (or is reported by ``include_initial``)
+        epochs: list of the new training items (dicts with `timestamp`, `epoch_id` and `epoch_data` keys)
+    }
+    -------------------------------------------------------
+
+    :param credentials: dict containing at least `host`, `port`, `user` and `password` keys
+    :param db_name: name of the database with the run documents
+    :param table_name: name of the table with the run documents
+    :param run_ids: follow only the runs with these IDs
+    :param user: follow only the runs of this user
+    :param epochs_table: name of the table with the epoch documents of the runs stored with ``storage: epochs``
+    :param include_initial: yield the current state of the followed runs first (all their epochs so far)
+    :param conn: optional open (e.g. pooled) connection; a new connection is opened if not specified;
+                 it is occupied until the returned iterator is closed
+    :return: infinite iterator of the run deltas
+    """
+    logging.info('Watching runs from %s.%s', db_name, table_name)
+
+    runs = r.db(db_name).table(table_name)
+    if run_ids is not None:
+        runs = runs.get_all(*run_ids)
+    runs = _run_filter(runs, user=user)
+    feed = runs.changes(include_initial=include_initial)\
+        .filter(lambda change: change['new_val'].ne(None))\
+        .map(_run_delta)\
+        .filter(lambda delta: delta['new_run'].or_(delta['epochs'].is_empty().not_()))
+
+    watched = None
+    if epochs_table is not None:
+        epochs = r.db(db_name).table(epochs_table)
+        if run_ids is not None:
+            epochs = epochs.filter(lambda epoch: r.expr(run_ids).contains(epoch['run_id']))
+        feed = r.union(feed, epochs.changes(include_initial=include_initial)
+                       .filter(lambda change: change['old_val'].default(None).eq(None).and_(change['new_val'].ne(None)))
+                       .map(lambda change: {'id': change['new_val']['run_id'], 'new_run': False,
+                                            'epochs': [change['new_val'].without('id', 'run_id', 'modified')]}))
+
+    with connect(credentials, conn, db=db_name) as conn:
+        cursor = feed.run(conn)
+        if epochs_table is not None and user is not None and run_ids is None:
+            # listed once the feed is started, hence every run is either listed or its insertion is reported
+            watched = set(runs['id'].run(conn))
+        for delta in cursor:
+            if watched is not None:
+                if delta['new_run']:
+                    watched.add(delta['id'])
+                elif delta['id'] not in watched:
+                    continue
+            yield delta